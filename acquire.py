@@ -0,0 +1,210 @@
+"""
+Continuous data taking.
+
+Runs source scans back to back, for as long as needed, and streams the
+hits to disk as they come in, as rolling `lt3maps.history` files. Memory
+use is bounded: the scanner only holds one scan at a time, and at most
+`queue_size` scans wait to be written.
+
+A background thread writes the scans, and makes sure they are on the
+disk every `fsync_interval` seconds, so at most that much data is lost
+if the computer crashes. A new file is started every `scans_per_file`
+scan cycles.
+
+Run it with
+
+    $ python acquire.py --sleep 0.5 --output-dir data
+
+and stop it with Ctrl-C (or SIGTERM).
+
+"""
+import scan_inject as scan
+from lt3maps.history import HistoryWriter
+import Queue
+import argparse
+import logging
+import os
+import signal
+import threading
+import time
+
+
+class Acquisition(object):
+    """
+    Take scans continuously and write them to rolling history files.
+
+    Each scan cycle becomes one record in a file named
+    `<prefix>_<date>_<time>_<number>.t3h` in `output_dir`.
+
+    """
+
+    def __init__(self, scanner, output_dir, sleep=0.5, cycles=1,
+                 global_threshold=150, hardware_repeat=False,
+                 scans_per_file=100000, fsync_interval=5.0, queue_size=64,
+                 prefix="acquisition"):
+        self.scanner = scanner
+        self.output_dir = output_dir
+        self.sleep = sleep
+        self.cycles = cycles
+        self.global_threshold = global_threshold
+        self.hardware_repeat = hardware_repeat
+        self.scans_per_file = scans_per_file
+        self.fsync_interval = fsync_interval
+        self.prefix = prefix
+        self.files = []
+        self.num_scans = 0
+        self.num_written = 0
+        self._queue = Queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._writer_thread = None
+        self._writer_error = None
+        self._file_number = 0
+
+    def stop(self):
+        """
+        Ask `run` to stop after the current scan.
+
+        """
+        self._stop.set()
+
+    def run(self, duration=None, max_scans=None):
+        """
+        Take scans until `stop` is called, `duration` seconds have
+        passed, or `max_scans` scans have been taken.
+
+        All scans are written when this method returns.
+
+        """
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        self._stop.clear()
+        self._writer_thread = threading.Thread(target=self._write_loop,
+                                               name="acquisition writer")
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+        stop_time = None if duration is None else time.time() + duration
+        try:
+            while not self._stop.is_set():
+                if max_scans is not None and self.num_scans >= max_scans:
+                    break
+                if stop_time is not None and time.time() >= stop_time:
+                    break
+                self._take_scan()
+        finally:
+            while self._writer_thread.is_alive():
+                try:
+                    self._queue.put(None, timeout=1)
+                    break
+                except Queue.Full:
+                    pass
+            self._writer_thread.join()
+        if self._writer_error is not None:
+            raise self._writer_error
+
+    def _take_scan(self):
+        """
+        Take one scan and queue it for writing.
+
+        """
+        scanner = self.scanner
+        scanner.reset()
+        scanner.scan(self.sleep, self.cycles, self.global_threshold,
+                     self.hardware_repeat)
+        store = scanner.hit_store
+        # the scanner starts a new store on reset, so no copy is needed
+        frame = (scanner.cycle_start_times, store.occupancy, store.times)
+        while True:
+            if self._writer_error is not None:
+                raise self._writer_error
+            try:
+                self._queue.put(frame, timeout=1)
+                break
+            except Queue.Full:
+                logging.warning("acquisition: writer is falling behind")
+        self.num_scans += 1
+
+    def _open_file(self):
+        self._file_number += 1
+        name = "%s_%s_%04i.t3h" % (self.prefix,
+                                   time.strftime("%Y%m%d_%H%M%S"),
+                                   self._file_number)
+        filename = os.path.join(self.output_dir, name)
+        self.files.append(filename)
+        logging.info("acquisition: writing to %s", filename)
+        chip = self.scanner.chip
+        return HistoryWriter(filename, chip.num_columns, chip.num_rows)
+
+    def _write_loop(self):
+        """
+        Write queued scans until None is queued.
+
+        """
+        writer = None
+        last_sync = time.time()
+        try:
+            while True:
+                try:
+                    frame = self._queue.get(timeout=self.fsync_interval)
+                except Queue.Empty:
+                    frame = False
+                if frame is None:
+                    break
+                if frame:
+                    start_times, occupancy, times = frame
+                    for start_time, cycle_occupancy, cycle_times in zip(
+                            start_times, occupancy, times):
+                        if (writer is not None and
+                                writer.num_records >= self.scans_per_file):
+                            writer.sync()
+                            writer.close()
+                            writer = None
+                        if writer is None:
+                            writer = self._open_file()
+                        end_time = cycle_times.max()
+                        writer.append(start_time, end_time, cycle_occupancy)
+                    self.num_written += 1
+                if (writer is not None and
+                        time.time() - last_sync >= self.fsync_interval):
+                    writer.sync()
+                    last_sync = time.time()
+        except Exception as e:
+            logging.exception("acquisition: writer failed")
+            self._writer_error = e
+            self._stop.set()
+        finally:
+            if writer is not None:
+                writer.sync()
+                writer.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sleep", type=float, default=0.5)
+    parser.add_argument("--cycles", type=int, default=1)
+    parser.add_argument("--threshold", type=int, default=150)
+    parser.add_argument("--hardware-repeat", action="store_true")
+    parser.add_argument("--output-dir", default="data")
+    parser.add_argument("--scans-per-file", type=int, default=100000)
+    parser.add_argument("--fsync-interval", type=float, default=5.0)
+    parser.add_argument("--duration", type=float, default=None)
+    parser.add_argument("--tdac", default=None,
+                        help="TDAC map to apply before taking data")
+    parser.add_argument("--emulate", action="store_true")
+    args = parser.parse_args()
+
+    scanner = scan.Scanner("lt3maps/lt3maps.yaml", emulate=args.emulate)
+    if args.tdac:
+        scanner.chip.import_TDAC(args.tdac)
+    acquisition = Acquisition(scanner, args.output_dir, args.sleep,
+                              args.cycles, args.threshold,
+                              args.hardware_repeat, args.scans_per_file,
+                              args.fsync_interval)
+    signal.signal(signal.SIGTERM, lambda signum, frame: acquisition.stop())
+    try:
+        acquisition.run(args.duration)
+    except KeyboardInterrupt:
+        acquisition.stop()
+    print "%i scans written to %s" % (acquisition.num_written,
+                                      ", ".join(acquisition.files))
@@ -0,0 +1,299 @@
+"""
+Host-side benchmarks.
+
+Times the parts of the software which run on the host, against the chip
+emulator, so that no hardware is needed:
+
+- build_blocks: `write_global_reg` and `write_pixel_reg` for a readout
+  of every column
+- write_blocks_to_seq: `_write_blocks_to_seq` for the same blocks
+- decode_sr_output, decode_sr_output_packed: `_decode_sr_output` of the
+  FIFO words of 10 readouts (recorded from the emulator, or from a .npy
+  file of FIFO words given with --fifo-data)
+- scan_postprocess: what `Scanner.scan` does with the output of 10
+  readouts (`output_by_column`, the hit store and the accumulator)
+- TDAC_planning: `_apply_pixel_TDAC_to_chip` for a full new TDAC map,
+  without running it (nothing is sent to the chip)
+- tuner_round: one round of the binary search `Tuner`, including its
+  emulated scan
+- viewer_frame: drawing a new frame with `ChipRenderer`, and the
+  heatmap levels it shows
+
+Each benchmark is run `number` times in a row, `repeat` times over, and
+the fastest time per call is what counts. The results are written to a
+YAML file, which a later run can be compared against:
+
+    $ python benchmark.py --output before.yaml
+    $ python benchmark.py --output after.yaml --compare before.yaml
+
+With --compare, the exit status is 1 if any benchmark got slower by
+more than --tolerance.
+
+"""
+import scan_inject as scan
+import scan_analysis
+import tune
+from lt3maps.hits import HitStore
+from collections import OrderedDict
+import argparse
+import logging
+import platform
+import sys
+import time
+import timeit
+import numpy as np
+import yaml
+
+BENCHMARKS = OrderedDict()
+"""
+The benchmarks, by name. Each is a function which takes a `Scanner`,
+sets up what it needs and returns (function to time, number of items
+the function handles per call).
+
+"""
+
+
+def benchmark(name):
+    """
+    Register a benchmark under `name`.
+
+    """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def _queue_readout(driver, num_columns):
+    for column in range(num_columns):
+        driver.set_global_register(column_address=column)
+        driver.write_global_reg()
+        driver.set_pixel_register("0" * len(driver['PIXEL_REG']))
+        driver.write_pixel_reg()
+
+
+def _record_readout(scanner, cycles=10):
+    """
+    Return the FIFO words of `cycles` readouts of every column.
+
+    """
+    chip = scanner.chip
+    words = []
+    for _ in range(cycles):
+        scanner._reset_hit_configuration(0)
+        scanner._read_column_hits(0, chip.num_columns)
+        pending = chip.run_async()
+        chip.flush()
+        words.append(pending._words)
+        pending.result()
+    return np.concatenate(words)
+
+
+@benchmark('build_blocks')
+def _build_blocks(scanner, fifo_data=None):
+    driver = scanner.chip._driver
+    num_columns = scanner.chip.num_columns
+    def function():
+        _queue_readout(driver, num_columns)
+        driver.reset_seq()
+    return function, 2 * num_columns
+
+
+@benchmark('write_blocks_to_seq')
+def _write_blocks_to_seq(scanner, fifo_data=None):
+    driver = scanner.chip._driver
+    driver.reset_seq()
+    _queue_readout(driver, scanner.chip.num_columns)
+    return driver._write_blocks_to_seq, len(driver._blocks)
+
+
+@benchmark('decode_sr_output')
+def _decode_sr_output(scanner, fifo_data=None):
+    driver = scanner.chip._driver
+    words = _record_readout(scanner) if fifo_data is None else fifo_data
+    return lambda: driver._decode_sr_output(words), 16 * len(words)
+
+
+@benchmark('decode_sr_output_packed')
+def _decode_sr_output_packed(scanner, fifo_data=None):
+    driver = scanner.chip._driver
+    words = _record_readout(scanner) if fifo_data is None else fifo_data
+    return (lambda: driver._decode_sr_output(words, packed=True),
+            16 * len(words))
+
+
+@benchmark('scan_postprocess')
+def _scan_postprocess(scanner, fifo_data=None):
+    chip = scanner.chip
+    output = chip._driver._decode_sr_output(_record_readout(scanner))
+    def function():
+        columns = chip.output_by_column(output)
+        store = HitStore(chip.num_columns, chip.num_rows)
+        store.append(columns, np.zeros(len(columns)))
+        scanner.accumulator.add(columns, 1.0)
+        store.pixel_counts()
+    return function, len(output)
+
+
+@benchmark('TDAC_planning')
+def _TDAC_planning(scanner, fifo_data=None):
+    chip = scanner.chip
+    random = np.random.RandomState(0)
+    shape = (chip.num_columns, chip.num_rows)
+    maps = [random.randint(0, 32, shape) for _ in range(2)]
+    state = {'index': 0}
+    def function():
+        state['index'] ^= 1
+        chip._import_TDAC_to_pixels(maps[state['index']])
+        chip._apply_pixel_TDAC_to_chip(run=False)
+        chip._driver.reset_seq()
+    return function, chip.num_columns * chip.num_rows
+
+
+@benchmark('tuner_round')
+def _tuner_round(scanner, fifo_data=None):
+    tuner = tune.Tuner(view=False, method='binary', scanner=scanner)
+    tuner.integration_time = 0
+    tuner.calm_down_time = 0
+    tuner.num_iterations = 1
+    def function():
+        tuner.iteration = 1
+        tuner.get_binary_search_function()()
+    return function, tuner.num_pixels_total
+
+
+class _NullWindow(object):
+    def addstr(self, y, x, text):
+        pass
+
+    def refresh(self):
+        pass
+
+
+@benchmark('viewer_frame')
+def _viewer_frame(scanner, fifo_data=None):
+    random = np.random.RandomState(0)
+    counts = [random.poisson(3, (18, 64)) for _ in range(2)]
+    renderer = scan_analysis.ChipRenderer(_NullWindow(), 0, 0)
+    state = {'index': 0, 'now': 0}
+    def function():
+        state['index'] ^= 1
+        state['now'] += 1
+        renderer.show(scan_analysis.heatmap_levels(counts[state['index']]))
+        renderer.update(now=state['now'])
+    return function, 18 * 64
+
+
+def run_benchmarks(scanner, names=None, repeat=5, number=20, fifo_data=None):
+    """
+    Run the benchmarks (all, or those in `names`) and return the results
+    by name.
+
+    """
+    driver = scanner.chip._driver
+    driver.flush()
+    results = OrderedDict()
+    for name in names or BENCHMARKS.keys():
+        # start from an empty sequence
+        driver.reset_seq()
+        function, items = BENCHMARKS[name](scanner, fifo_data)
+        # once to warm up caches
+        function()
+        times = [total / number for total in
+                 timeit.Timer(function).repeat(repeat, number)]
+        driver.reset_seq()
+        # nothing may be left over for the next benchmark
+        assert not driver._batch_starts and driver._pending_run is None, name
+        best = min(times)
+        results[name] = {
+            'best': best,
+            'median': float(np.median(times)),
+            'repeat': repeat,
+            'number': number,
+            'items': items,
+            'items_per_second': items / best if best > 0 else 0.0,
+        }
+    return results
+
+
+def save_results(filename, results):
+    """
+    Write benchmark results to a YAML file, with the environment they
+    were measured in.
+
+    """
+    data = {
+        'created': time.time(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'benchmarks': dict(results),
+    }
+    with open(filename, 'w') as outfile:
+        outfile.write(yaml.safe_dump(data, default_flow_style=False))
+
+
+def load_results(filename):
+    with open(filename) as infile:
+        return yaml.load(infile, Loader=yaml.SafeLoader)['benchmarks']
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare results against a baseline.
+
+    Returns a table as a string, and the names of the benchmarks which
+    are more than `tolerance` (a fraction) slower than the baseline.
+
+    """
+    lines = ["%-25s %12s %12s %8s" % ("benchmark", "baseline us", "now us",
+                                      "ratio")]
+    slower = []
+    for name, result in results.iteritems():
+        if name not in baseline:
+            lines.append("%-25s %12s %12.1f" % (name, "-",
+                                                1e6 * result['best']))
+            continue
+        before = baseline[name]['best']
+        ratio = result['best'] / before if before > 0 else float('inf')
+        flag = ""
+        if ratio > 1 + tolerance:
+            slower.append(name)
+            flag = "  SLOWER"
+        lines.append("%-25s %12.1f %12.1f %8.2f%s" %
+                     (name, 1e6 * before, 1e6 * result['best'], ratio, flag))
+    return "\n".join(lines), slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help="benchmarks to run "
+                        "(default: all of %s)" % ", ".join(BENCHMARKS))
+    parser.add_argument("--output", default="benchmark.yaml")
+    parser.add_argument("--compare", default=None,
+                        help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20)
+    parser.add_argument("--fifo-data", default=None,
+                        help=".npy file of recorded FIFO words to decode")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fifo_data = None
+    if args.fifo_data:
+        fifo_data = np.load(args.fifo_data)
+    scanner = scan.Scanner("lt3maps/lt3maps.yaml", emulate={'seed': 0})
+    results = run_benchmarks(scanner, args.names, args.repeat, args.number,
+                             fifo_data)
+    save_results(args.output, results)
+    for name, result in results.iteritems():
+        print "%-25s %12.1f us %14.0f items/s" % (
+            name, 1e6 * result['best'], result['items_per_second'])
+    if args.compare:
+        table, slower = compare(results, load_results(args.compare),
+                                args.tolerance)
+        print
+        print table
+        if slower:
+            sys.exit(1)
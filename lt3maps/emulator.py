@@ -0,0 +1,496 @@
+"""
+Module emulator.
+
+A pure-Python/NumPy model of a T3MAPS chip and of the FPGA modules
+(`seq_gen`, `fast_spi_rx`, `sram_fifo`) that T3MAPSDriver talks to.
+
+The emulator lets T3MAPSDriver, T3MAPSChip, Scanner and Tuner run end to
+end without a board attached, e.g. to measure the host-side throughput
+of the software. It is selected by passing `emulate=True` (or a dict of
+keyword arguments for `T3MAPSModel`) to T3MAPSDriver:
+
+>>> driver = T3MAPSDriver("lt3maps.yaml", emulate=True)
+
+In that mode every transfer layer is replaced by an `EmulatedBoard`, and
+the hardware drivers listed in `EMULATED_DRIVERS` are replaced by their
+emulated versions. Registers (GLOBAL_REG, PIXEL_REG, SEQ) are the usual
+BASIL registers, so the host does exactly the same work as it would
+with real hardware, minus the network transfers.
+
+"""
+import math
+import time
+import logging
+import numpy as np
+from basil.HL.HardwareLayer import HardwareLayer
+from basil.TL.TransferLayer import TransferLayer
+from normal import normal_cdf
+
+
+class T3MAPSModel(object):
+    """
+    A behavioural model of the T3MAPS chip.
+
+    The model knows about the global shift register and its control and
+    DAC shadow registers, the pixel shift register, the per-pixel hit,
+    inject, hitor and TDAC latches, and the hit memory which is read out
+    through the pixel shift register (SR_OUT).
+
+    Hits come from three sources:
+
+    - noise, which fires a pixel once per integration window with a
+      probability that depends on how far the pixel's threshold sits
+      above the noise floor,
+    - injections (low-to-high edges on the INJECTION track), which fire
+      pixels whose inject latch is set with a probability given by the
+      injected charge relative to the threshold (an S-curve), and
+    - an optional uniform source with rate `source_rate` (hits per pixel
+      per second of integration).
+
+    The threshold of a pixel, in arbitrary units, is
+
+        vth_gain * (vth - vth_offset) + tdac_gain * TDAC + offset
+
+    where `offset` is drawn once per pixel from a normal distribution
+    with mean `threshold_mean` and width `threshold_dispersion`. The
+    TDAC gain scales with the VbpThStep DAC relative to its default of
+    25.
+
+    """
+
+    def __init__(self, global_fields, num_columns=18, num_rows=64,
+                 seed=None, threshold_mean=-12.0, threshold_dispersion=3.0,
+                 noise=1.5, vth_gain=0.5, vth_offset=60, tdac_gain=1.0,
+                 injection_charge=20.0, source_rate=0.0):
+        self.num_columns = num_columns
+        self.num_rows = num_rows
+        self.noise = noise
+        self.vth_gain = vth_gain
+        self.vth_offset = vth_offset
+        self.tdac_gain = tdac_gain
+        self.injection_charge = injection_charge
+        self.source_rate = source_rate
+        self._random = np.random.RandomState(seed)
+
+        # (start, stop) index of each field in the global shift register
+        self._global_fields = {}
+        for field in global_fields:
+            start = field['offset'] - field['size'] + 1
+            self._global_fields[field['name']] = (start, field['offset'] + 1)
+        self._global_size = max(stop for _, stop in
+                                self._global_fields.values())
+
+        shape = (num_columns, num_rows)
+        self.threshold_offset = self._random.normal(threshold_mean,
+                                                    threshold_dispersion,
+                                                    shape)
+        self.global_sr = np.zeros(self._global_size, dtype=np.uint8)
+        # pixel_sr[0] is the next bit out (row num_rows - 1)
+        self.pixel_sr = np.zeros(num_rows, dtype=np.uint8)
+        self.control = dict.fromkeys(self._global_fields, 0)
+        self.dac = dict.fromkeys(self._global_fields, 0)
+        self.hit_enable = np.zeros(shape, dtype=np.bool_)
+        self.inject_enable = np.zeros(shape, dtype=np.bool_)
+        self.hitor_enable = np.zeros(shape, dtype=np.bool_)
+        self.tdac = np.zeros(shape, dtype=np.uint8)
+        self.hits = np.zeros(shape, dtype=np.bool_)
+        self.integrating = False
+        self._integration_start = None
+
+    def thresholds(self):
+        """
+        Return the current threshold of every pixel as a matrix.
+
+        """
+        step = self.dac['VbpThStep'] / 25.0 if self.dac['VbpThStep'] else 1.0
+        return (self.vth_gain * (self.dac['vth'] - self.vth_offset) +
+                self.tdac_gain * step * self.tdac + self.threshold_offset)
+
+    def shift_global(self, bits):
+        """
+        Clock the given bits into the global shift register.
+
+        """
+        self.global_sr = np.concatenate((self.global_sr,
+                                         bits))[-self._global_size:]
+
+    def shift_pixel(self, bits):
+        """
+        Clock the given bits into the pixel shift register.
+
+        Returns the bits that come out of the register, first bit out
+        first.
+
+        """
+        stream = np.concatenate((self.pixel_sr, bits))
+        self.pixel_sr = stream[len(bits):]
+        return stream[:len(bits)]
+
+    def _decode_global(self):
+        """
+        Return a dict of the field values held by the global shift register.
+
+        Each field is sent most significant bit first.
+
+        """
+        values = {}
+        for name, (start, stop) in self._global_fields.iteritems():
+            value = 0
+            for bit in self.global_sr[start:stop]:
+                value = (value << 1) | int(bit)
+            values[name] = value
+        return values
+
+    def _pixel_rows(self):
+        """
+        Return the pixel shift register contents indexed by row.
+
+        """
+        return self.pixel_sr[::-1].astype(np.bool_)
+
+    def load_control(self):
+        """
+        Load the control shadow register and act on its contents.
+
+        """
+        control = self._decode_global()
+        self.control = control
+        column = control['column_address']
+        if control['SRCLR_SEL']:
+            self.hits[:] = False
+        integrating = bool(control['S0'] and control['HITLD_IN'])
+        if integrating and not self.integrating:
+            self._integration_start = time.time()
+        elif self.integrating and not integrating:
+            self._end_integration()
+        self.integrating = integrating
+
+        if column >= self.num_columns:
+            return
+        if control['enable_strobes']:
+            rows = self._pixel_rows()
+            if control['hit_strobe']:
+                self.hit_enable[column] = rows
+            if control['inject_strobe']:
+                self.inject_enable[column] = rows
+            if control['hitor_strobe']:
+                self.hitor_enable[column] = rows
+            for bit in range(5):
+                if control['TDAC_strobes'] & (1 << bit):
+                    self.tdac[column] &= ~np.uint8(1 << bit)
+                    self.tdac[column] |= rows.astype(np.uint8) << bit
+        elif not integrating:
+            # load the column's hit memory into the pixel shift register
+            self.pixel_sr = self.hits[column][::-1].astype(np.uint8)
+
+    def load_dac(self):
+        """
+        Load the DAC shadow register.
+
+        """
+        self.dac = self._decode_global()
+
+    def inject(self):
+        """
+        Inject charge into every pixel whose inject latch is set.
+
+        """
+        if not self.integrating:
+            return
+        probability = normal_cdf((self.injection_charge - self.thresholds()) /
+                                 self.noise)
+        fired = self._random.random_sample(probability.shape) < probability
+        self.hits |= fired & self.inject_enable & self.hit_enable
+
+    def _end_integration(self):
+        """
+        Add noise and source hits collected during an integration window.
+
+        """
+        probability = normal_cdf(-self.thresholds() / self.noise)
+        if self.source_rate:
+            duration = time.time() - self._integration_start
+            source = 1 - math.exp(-self.source_rate * duration)
+            probability = 1 - (1 - probability) * (1 - source)
+        fired = self._random.random_sample(probability.shape) < probability
+        self.hits |= fired & self.hit_enable
+
+
+class EmulatedBoard(TransferLayer):
+    """
+    Stand-in for the transfer layer and the FPGA behind it.
+
+    The board owns the chip model and the data path between the emulated
+    modules: `seq_gen` plays its memory into the chip, `fast_spi_rx`
+    samples SR_OUT while the pixel shift register is clocked, and the
+    resulting 16-bit words are stored for `sram_fifo`.
+
+    `driver_conf` is the configuration dict of the whole T3MAPSDriver, from
+    which the global register layout and the SEQ track positions are
+    taken. `model_options` are passed on to `T3MAPSModel`.
+
+    """
+
+    _header = 0x00010000
+    """
+    Upper bits of each FIFO word. The host discards them.
+
+    """
+
+    def __init__(self, conf, driver_conf, model_options=None):
+        super(EmulatedBoard, self).__init__(conf)
+        registers = dict((reg['name'], reg) for reg in
+                         driver_conf['registers'])
+        self._track_positions = dict((track['name'], track['position'])
+                                     for track in
+                                     registers['SEQ']['tracks'])
+        self.chip = T3MAPSModel(registers['GLOBAL_REG']['fields'],
+                                num_rows=registers['PIXEL_REG']['size'],
+                                **(model_options or {}))
+        self.receiver_enabled = False
+        self.fifo = []
+        self._pending_bits = np.zeros(0, dtype=np.uint8)
+        self._mem = {}
+
+    def read(self, addr, size):
+        return [self._mem.get(curr_addr, 0) for curr_addr in
+                range(addr, addr + size)]
+
+    def write(self, addr, data):
+        for curr_addr, byte in enumerate(data, start=addr):
+            self._mem[curr_addr] = byte
+
+    def _track(self, tracks, name):
+        return tracks[:, self._track_positions[name]]
+
+    def execute(self, image, repeat=1):
+        """
+        Play a SEQ memory image (one byte per clock cycle) into the chip.
+
+        """
+        image = np.asarray(image, dtype=np.uint8)
+        tracks = (image[:, np.newaxis] >> np.arange(8, dtype=np.uint8)) & 1
+        shift_in = self._track(tracks, 'SHIFT_IN')
+        injection = self._track(tracks, 'INJECTION')
+        # an injection happens when INJECTION returns high (idle is high)
+        inject_edges = np.zeros(len(image), dtype=np.uint8)
+        inject_edges[1:] = injection[1:] & ~injection[:-1] & 1
+
+        codes = (self._track(tracks, 'GLOBAL_SHIFT_EN') |
+                 self._track(tracks, 'PIXEL_SHIFT_EN') << 1 |
+                 self._track(tracks, 'GLOBAL_CTR_LD') << 2 |
+                 self._track(tracks, 'GLOBAL_DAC_LD') << 3 |
+                 inject_edges << 4)
+        active = np.flatnonzero(codes)
+        if not len(active):
+            return
+        # split the active cycles into runs of the same kind of action
+        breaks = np.flatnonzero((np.diff(active) != 1) |
+                                (np.diff(codes[active]) != 0)) + 1
+        starts = np.concatenate(([0], breaks))
+        stops = np.concatenate((breaks, [len(active)]))
+
+        for _ in range(max(repeat, 1)):
+            for start, stop in zip(starts, stops):
+                first, last = active[start], active[stop - 1] + 1
+                code = codes[first]
+                if code & 1:
+                    self.chip.shift_global(shift_in[first:last])
+                if code & 2:
+                    out = self.chip.shift_pixel(shift_in[first:last])
+                    if self.receiver_enabled:
+                        self._receive(out)
+                if code & 4:
+                    self.chip.load_control()
+                if code & 8:
+                    self.chip.load_dac()
+                if code & 16:
+                    self.chip.inject()
+
+    def _receive(self, bits):
+        """
+        Sample SR_OUT and pack the bits into FIFO words.
+
+        SR_OUT is active low, so the line carries the inverted bits.
+
+        """
+        bits = np.concatenate((self._pending_bits, 1 - bits))
+        num_words = len(bits) // 16
+        self._pending_bits = bits[num_words * 16:]
+        if num_words:
+            weights = 1 << np.arange(15, -1, -1, dtype=np.uint32)
+            words = bits[:num_words * 16].reshape(num_words, 16).dot(weights)
+            self.fifo.append(words.astype(np.uint32) | self._header)
+
+
+class EmulatedSeqGen(HardwareLayer):
+    """
+    Emulated `seq_gen`: stores a sequence and plays it into the board.
+
+    Sequences execute synchronously in `start`, so `get_done` is always
+    True by the time anyone asks.
+
+    """
+
+    def __init__(self, intf, conf):
+        super(EmulatedSeqGen, self).__init__(intf, conf)
+        self._mem_size = conf.get('mem_size', 8192)
+        self._mem = np.zeros(self._mem_size, dtype=np.uint8)
+        self._size = 0
+        self._repeat = 1
+        self._wait = 0
+        self._clk_divide = 1
+
+    def reset(self):
+        self._size = 0
+        self._repeat = 1
+
+    def set_data(self, data, addr=0):
+        if self._mem_size < addr + len(data):
+            raise ValueError('Size of data (%d bytes) is too big for memory '
+                             '(%d bytes)' % (len(data), self._mem_size))
+        self._mem[addr:addr + len(data)] = np.frombuffer(
+            bytearray(data), dtype=np.uint8)
+
+    def get_data(self, size=None, addr=0):
+        size = size or self._mem_size
+        return self._mem[addr:addr + size].copy()
+
+    def get_mem_size(self):
+        return self._mem_size
+
+    def set_size(self, value):
+        self._size = value
+
+    def get_size(self):
+        return self._size
+
+    def set_repeat(self, value):
+        self._repeat = value
+
+    def get_repeat(self):
+        return self._repeat
+
+    def set_wait(self, value):
+        self._wait = value
+
+    def get_wait(self):
+        return self._wait
+
+    def set_clk_divide(self, value):
+        self._clk_divide = value
+
+    def get_clk_divide(self):
+        return self._clk_divide
+
+    def start(self):
+        if self._repeat == 0:
+            logging.warning("Emulated seq_gen cannot loop forever, "
+                            "running the sequence once.")
+        self._intf.execute(self._mem[:self._size], self._repeat)
+
+    @property
+    def is_ready(self):
+        return True
+
+    def is_done(self):
+        return True
+
+    def get_done(self):
+        return True
+
+
+class EmulatedFastSpiRx(HardwareLayer):
+    """
+    Emulated `fast_spi_rx`: gates the sampling of SR_OUT.
+
+    """
+
+    def reset(self):
+        self._intf._pending_bits = self._intf._pending_bits[:0]
+
+    def set_en(self, value):
+        self._intf.receiver_enabled = bool(value)
+
+    def get_en(self):
+        return self._intf.receiver_enabled
+
+    def get_lost_count(self):
+        return 0
+
+
+class EmulatedSramFifo(HardwareLayer):
+    """
+    Emulated `sram_fifo`: hands out the words collected by the board.
+
+    """
+
+    def reset(self):
+        del self._intf.fifo[:]
+
+    def get_fifo_size(self):
+        """
+        Get the FIFO size in bytes.
+
+        """
+        return 4 * sum(len(words) for words in self._intf.fifo)
+
+    def get_fifo_int_size(self):
+        return self.get_fifo_size() / 4
+
+    def get_read_error_counter(self):
+        return 0
+
+    def get_data(self):
+        fifo = self._intf.fifo
+        if not fifo:
+            return np.zeros(0, dtype=np.uint32)
+        data = np.concatenate(fifo)
+        del fifo[:]
+        return data
+
+
+class EmulatedNullDriver(HardwareLayer):
+    """
+    Stand-in for hardware drivers the chip model does not need.
+
+    Every method call is accepted and returns 0.
+
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: 0
+
+
+EMULATED_DRIVERS = {
+    'seq_gen': EmulatedSeqGen,
+    'fast_spi_rx': EmulatedFastSpiRx,
+    'sram_fifo': EmulatedSramFifo,
+}
+"""
+The hardware driver types which have a functional emulation.
+
+Any other hardware driver type is replaced by `EmulatedNullDriver`.
+
+"""
+
+
+def create_module(importname, driver_conf, model_options=None, **kwargs):
+    """
+    Create the emulated replacement for a BASIL module.
+
+    `importname` is the module name BASIL would import, e.g.
+    "basil.HL.seq_gen". Transfer layers and hardware drivers are
+    replaced; for anything else (registers) None is returned, meaning the
+    real BASIL module should be used.
+
+    """
+    layer, module_type = importname.split('.')[-2:]
+    if layer == 'TL':
+        return EmulatedBoard(kwargs['conf'], driver_conf, model_options)
+    elif layer == 'HL':
+        cls = EMULATED_DRIVERS.get(module_type, EmulatedNullDriver)
+        return cls(kwargs['intf'], kwargs['conf'])
+    return None
@@ -0,0 +1,417 @@
+"""
+Module history.
+
+An indexed binary format for scan history, and converters from the
+text formats written by `ChipViewer` (history.txt) and `scan_inject.py`
+(out.yaml).
+
+A history file is a 64-byte header followed by one fixed-size record
+per scan:
+
+- start: start time of the scan (float64, from time.time())
+- end: end time of the scan (float64)
+- num_hits: number of pixels hit (uint32)
+- flags: reserved, 0 (uint32)
+- bitmap: the hit pixels, packed 8 to a byte, column by column, row 0
+  of each column first, in the most significant bit
+
+All numbers are little endian. Since every record has the same size,
+the file is its own index: scan i starts at byte 64 + i * record_size,
+and the whole file can be opened with numpy.memmap. Files are only
+ever appended to.
+
+For example,
+
+>>> with HistoryWriter("history.t3h") as writer:
+...     writer.append(start, end, column_hits)
+>>> history = History("history.t3h")
+>>> history.num_hits[-100:]       # hit counts of the last 100 scans
+>>> history.occupancy(42)[3]      # hit bitmap of column 3 in scan 42
+
+The text formats can be read one scan at a time, without loading the
+whole file, with `iter_history_txt` and `iter_out_yaml`. Both can start
+at a given scan number without parsing the scans before it.
+
+"""
+import os
+import re
+import numpy as np
+import yaml
+
+# the C implementation is much faster, but not always installed
+YAMLLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+MAGIC = "T3MHIST\0"
+VERSION = 1
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u2'),
+    ('num_columns', '<u2'),
+    ('num_rows', '<u2'),
+    ('record_size', '<u2'),
+    ('reserved', 'V48'),
+])
+"""
+The layout of the file header.
+
+"""
+
+
+def record_dtype(num_columns=18, num_rows=64):
+    """
+    Return the layout of one scan record for a chip of the given size.
+
+    """
+    num_bytes = (num_columns * num_rows + 7) // 8
+    return np.dtype([
+        ('start', '<f8'),
+        ('end', '<f8'),
+        ('num_hits', '<u4'),
+        ('flags', '<u4'),
+        ('bitmap', 'u1', (num_bytes,)),
+    ])
+
+
+def _occupancy(hits, num_columns, num_rows):
+    """
+    Return a (column, row) bitmap from a bitmap or from lists of rows.
+
+    """
+    if isinstance(hits, np.ndarray) and hits.shape == (num_columns,
+                                                       num_rows):
+        return hits.astype(bool)
+    occupancy = np.zeros((num_columns, num_rows), dtype=bool)
+    for column, rows in enumerate(hits):
+        occupancy[column, list(rows)] = True
+    return occupancy
+
+
+class HistoryWriter(object):
+    """
+    Append scans to a history file, creating it if needed.
+
+    If the file exists, its header must match the chip size.
+
+    """
+
+    def __init__(self, filename, num_columns=18, num_rows=64):
+        self.filename = filename
+        self.num_columns = num_columns
+        self.num_rows = num_rows
+        self.dtype = record_dtype(num_columns, num_rows)
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['num_columns'] = num_columns
+        header['num_rows'] = num_rows
+        header['record_size'] = self.dtype.itemsize
+
+        self._file = open(filename, 'ab+')
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0:
+            self._file.write(header.tostring())
+        else:
+            self._file.seek(0)
+            existing = np.fromstring(self._file.read(HEADER_DTYPE.itemsize),
+                                     dtype=HEADER_DTYPE)
+            if existing.tostring() != header.tostring():
+                self._file.close()
+                raise ValueError("%s is not a history file for a %ix%i "
+                                 "chip" % (filename, num_columns, num_rows))
+            # drop a partially written record
+            size = os.path.getsize(filename) - HEADER_DTYPE.itemsize
+            self._file.truncate(HEADER_DTYPE.itemsize + size -
+                                size % self.dtype.itemsize)
+        self._file.seek(0, os.SEEK_END)
+        self.num_records = ((self._file.tell() - HEADER_DTYPE.itemsize) //
+                            self.dtype.itemsize)
+
+    def append(self, start, end, hits):
+        """
+        Append one scan.
+
+        `hits` is either a (column, row) bitmap or a list, by column, of
+        the rows hit.
+
+        """
+        occupancy = _occupancy(hits, self.num_columns, self.num_rows)
+        record = np.zeros(1, dtype=self.dtype)
+        record['start'] = start
+        record['end'] = end
+        record['num_hits'] = occupancy.sum()
+        record['bitmap'] = np.packbits(occupancy.ravel())
+        self._file.write(record.tostring())
+        self.num_records += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def sync(self):
+        """
+        Flush the file and make sure it has reached the disk.
+
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class History(object):
+    """
+    Random access to a history file through numpy.memmap.
+
+    `records` is the memory-mapped array of scan records. `start`,
+    `end` and `num_hits` are views of its fields.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        header = np.fromfile(filename, dtype=HEADER_DTYPE, count=1)
+        if len(header) != 1 or header['magic'][0] != MAGIC.rstrip("\0"):
+            raise ValueError("%s is not a history file" % filename)
+        if header['version'][0] != VERSION:
+            raise ValueError("%s has unsupported version %i" %
+                             (filename, header['version'][0]))
+        self.num_columns = int(header['num_columns'][0])
+        self.num_rows = int(header['num_rows'][0])
+        self.dtype = record_dtype(self.num_columns, self.num_rows)
+        size = os.path.getsize(filename) - HEADER_DTYPE.itemsize
+        num_records = size // self.dtype.itemsize
+        if num_records:
+            self.records = np.memmap(filename, dtype=self.dtype, mode='r',
+                                     offset=HEADER_DTYPE.itemsize,
+                                     shape=(num_records,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def start(self):
+        return self.records['start']
+
+    @property
+    def end(self):
+        return self.records['end']
+
+    @property
+    def num_hits(self):
+        return self.records['num_hits']
+
+    def occupancy(self, index):
+        """
+        Return the hit bitmap of a scan, or of a slice of scans.
+
+        The bitmap is indexed by (column, row), or by (scan, column, row)
+        for a slice.
+
+        """
+        bitmap = self.records['bitmap'][index]
+        num_bits = self.num_columns * self.num_rows
+        bits = np.unpackbits(bitmap, axis=-1)[..., :num_bits]
+        return bits.reshape(bitmap.shape[:-1] +
+                            (self.num_columns, self.num_rows)).astype(bool)
+
+    def column_hits(self, index):
+        """
+        Return the rows hit in each column of a scan, as lists.
+
+        """
+        return [np.flatnonzero(column).tolist()
+                for column in self.occupancy(index)]
+
+
+_HISTORY_TXT_START = re.compile(r"BEGIN SCAN #(\d+)")
+_OUT_YAML_START = re.compile(r"- cycle: (\d+)")
+_SEEK_BLOCK_SIZE = 65536
+
+
+def _next_record(infile, position, pattern):
+    """
+    Find the first record which starts on a line at or after `position`.
+
+    Returns its number and offset, or (None, None) at the end of the file.
+
+    """
+    if position > 0:
+        # finish the line which contains position - 1
+        infile.seek(position - 1)
+        infile.readline()
+    else:
+        infile.seek(0)
+    while True:
+        offset = infile.tell()
+        line = infile.readline()
+        if not line:
+            return None, None
+        match = pattern.match(line)
+        if match:
+            return int(match.group(1)), offset
+
+
+def _seek_record(infile, pattern, number):
+    """
+    Move to the first record numbered `number` or higher.
+
+    Records must be numbered in increasing order. The file is bisected,
+    so only a few blocks of it are read.
+
+    """
+    infile.seek(0, os.SEEK_END)
+    low, high = 0, infile.tell()
+    while high - low > _SEEK_BLOCK_SIZE:
+        middle = (low + high) // 2
+        found, offset = _next_record(infile, middle, pattern)
+        if found is None or found >= number:
+            high = middle
+        else:
+            low = offset + 1
+    found, offset = _next_record(infile, low, pattern)
+    while found is not None and found < number:
+        found, offset = _next_record(infile, offset + 1, pattern)
+    infile.seek(offset if found is not None else high)
+
+
+def _records(infile, pattern):
+    """
+    Yield the text of each record from the current position on.
+
+    """
+    lines = []
+    for line in iter(infile.readline, ''):
+        if pattern.match(line) and lines:
+            yield ''.join(lines)
+            lines = []
+        lines.append(line)
+    if lines:
+        yield ''.join(lines)
+
+
+def _parse_history_txt(lines):
+    """
+    Yield (scan number, start, end, column hits) from history.txt lines.
+
+    Understands both scans with "START TIME"/"END TIME" sections and
+    older scans with a single time stamp.
+
+    """
+    expect_time = False
+    for line in lines:
+        line = line.strip()
+        if line.startswith("BEGIN SCAN"):
+            number = int(line.rsplit("#", 1)[1])
+            times = []
+            columns = []
+            expect_time = True
+        elif line.startswith("END SCAN"):
+            yield number, times[0], times[-1], columns
+        elif line in ("START TIME", "END TIME"):
+            expect_time = True
+        elif expect_time:
+            times.append(float(line))
+            expect_time = False
+        else:
+            columns.append([int(row) for row in line.split()])
+
+
+def iter_history_txt(filename, first_scan=0):
+    """
+    Yield the scans of a history.txt file one at a time.
+
+    Each scan is a tuple (scan number, start time, end time, column
+    hits), where column hits lists the rows hit in each column. Starts
+    at scan number `first_scan`.
+
+    """
+    with open(filename, 'rb') as infile:
+        if first_scan:
+            _seek_record(infile, _HISTORY_TXT_START, first_scan)
+        for scan in _parse_history_txt(iter(infile.readline, '')):
+            yield scan
+
+
+def iter_out_yaml(filename, first_cycle=0):
+    """
+    Yield the cycles of an out.yaml file (from scan_inject.py) one at a
+    time.
+
+    Each cycle is a dict like the items of `Scanner.hits`. Starts at
+    cycle `first_cycle`. Only one cycle is in memory at a time, unless
+    the file is not laid out as scan_inject.py writes it, in which case
+    it is loaded whole.
+
+    """
+    with open(filename, 'rb') as infile:
+        if not _OUT_YAML_START.match(infile.readline()):
+            infile.seek(0)
+            for cycle in yaml.load(infile, Loader=YAMLLoader):
+                if cycle['cycle'] >= first_cycle:
+                    yield cycle
+            return
+        _seek_record(infile, _OUT_YAML_START, first_cycle)
+        for text in _records(infile, _OUT_YAML_START):
+            for cycle in yaml.load(text, Loader=YAMLLoader):
+                yield cycle
+
+
+def convert_history_txt(text_filename, filename, num_columns=18,
+                        num_rows=64):
+    """
+    Append the scans of a history.txt file to a history file.
+
+    Returns the number of scans converted.
+
+    """
+    count = 0
+    with HistoryWriter(filename, num_columns, num_rows) as writer:
+        for _, start, end, columns in iter_history_txt(text_filename):
+            writer.append(start, end, columns)
+            count += 1
+    return count
+
+
+def convert_out_yaml(yaml_filename, filename, num_columns=18, num_rows=64):
+    """
+    Append the cycles of an out.yaml file (from scan_inject.py) to a
+    history file, one scan per cycle.
+
+    The start and end times of a scan are the earliest and latest
+    readout times of its columns. Returns the number of cycles converted.
+
+    """
+    count = 0
+    with HistoryWriter(filename, num_columns, num_rows) as writer:
+        for cycle in iter_out_yaml(yaml_filename):
+            columns = [[] for _ in range(num_columns)]
+            times = []
+            for column in cycle['data']:
+                columns[column['column']] = column['hit_rows']
+                times.append(column['time'])
+            writer.append(min(times), max(times), columns)
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Convert history.txt or out.yaml to a history file.")
+    parser.add_argument("infile")
+    parser.add_argument("outfile")
+    args = parser.parse_args()
+    if args.infile.endswith((".yaml", ".yml")):
+        count = convert_out_yaml(args.infile, args.outfile)
+    else:
+        count = convert_history_txt(args.infile, args.outfile)
+    print "converted %i scans" % count
@@ -0,0 +1,184 @@
+"""
+Module hits.
+
+Columnar storage for the hits found by scans.
+
+A `HitStore` keeps one occupancy bitmap per scan cycle, with the time
+each column was read out. The hits can also be seen as a structured
+array with one (cycle, column, row, time) record per hit, or, for code
+written against the old format of `Scanner.hits`, as a list of dicts.
+
+For example,
+
+>>> scanner.scan(0, 10)
+>>> store = scanner.hit_store
+>>> store.pixel_counts()[3, 12]   # how often pixel (3, 12) was hit
+>>> store.column_hits(4, 3)       # rows hit in column 3 in cycle 4
+>>> store.cycles(5, 10).num_hits()
+
+"""
+import numpy as np
+
+HIT_DTYPE = np.dtype([
+    ('cycle', '<u4'),
+    ('column', 'u1'),
+    ('row', 'u1'),
+    ('time', '<f8'),
+])
+"""
+The record type of `HitStore.hits`.
+
+"""
+
+
+class HitStore(object):
+    """
+    The hits of a sequence of scan cycles.
+
+    `occupancy` is a boolean array indexed by (cycle, column, row), and
+    `times` a float array indexed by (cycle, column) holding the time
+    (from time.time()) at which each column was read out.
+
+    """
+
+    def __init__(self, num_columns=18, num_rows=64, occupancy=None,
+                 times=None, first_cycle=0):
+        self.num_columns = num_columns
+        self.num_rows = num_rows
+        self.first_cycle = first_cycle
+        self._chunks = []
+        self._occupancy = occupancy
+        self._times = times
+        self._hits = None
+        if occupancy is None:
+            self._occupancy = np.zeros((0, num_columns, num_rows), bool)
+            self._times = np.zeros((0, num_columns))
+
+    def append(self, occupancy, times):
+        """
+        Add cycles to the store.
+
+        `occupancy` is indexed by (cycle, column, row) and `times` by
+        cycle, or by (cycle, column). A single cycle may also be given
+        without the cycle index.
+
+        """
+        occupancy = np.asarray(occupancy, dtype=bool)
+        if occupancy.ndim == 2:
+            occupancy = occupancy[np.newaxis]
+        times = np.asarray(times, dtype=float)
+        times = np.broadcast_to(times.reshape(times.shape +
+                                              (1,) * (2 - times.ndim)),
+                                occupancy.shape[:2])
+        self._chunks.append((occupancy, times))
+        self._hits = None
+
+    def _collect(self):
+        if self._chunks:
+            self._occupancy = np.concatenate(
+                [self._occupancy] + [chunk[0] for chunk in self._chunks])
+            self._times = np.concatenate(
+                [self._times] + [chunk[1] for chunk in self._chunks])
+            self._chunks = []
+
+    @property
+    def occupancy(self):
+        """
+        The hit bitmap, indexed by (cycle, column, row).
+
+        """
+        self._collect()
+        return self._occupancy
+
+    @property
+    def times(self):
+        """
+        The readout times, indexed by (cycle, column).
+
+        """
+        self._collect()
+        return self._times
+
+    def __len__(self):
+        return len(self.occupancy)
+
+    @property
+    def hits(self):
+        """
+        A structured array of `HIT_DTYPE` with one record per hit.
+
+        The records are ordered by cycle, then column, then row.
+
+        """
+        if self._hits is None:
+            cycle, column, row = np.nonzero(self.occupancy)
+            hits = np.empty(len(cycle), dtype=HIT_DTYPE)
+            hits['cycle'] = cycle + self.first_cycle
+            hits['column'] = column
+            hits['row'] = row
+            hits['time'] = self.times[cycle, column]
+            self._hits = hits
+        return self._hits
+
+    def column_hits(self, cycle, column):
+        """
+        Return the rows hit in the given column and cycle.
+
+        """
+        return np.flatnonzero(self.occupancy[cycle - self.first_cycle,
+                                             column])
+
+    def num_hits(self, cycle=None):
+        """
+        Return the number of hits in a cycle, or in all cycles.
+
+        """
+        if cycle is None:
+            return int(self.occupancy.sum())
+        return int(self.occupancy[cycle - self.first_cycle].sum())
+
+    def pixel_counts(self):
+        """
+        Return how many cycles each pixel was hit in, by (column, row).
+
+        """
+        return self.occupancy.sum(axis=0)
+
+    def cycles(self, start=None, stop=None):
+        """
+        Return a `HitStore` of the cycles in [start, stop).
+
+        The occupancy and times are views of this store's arrays.
+
+        """
+        first = self.first_cycle
+        start = first if start is None else start
+        stop = first + len(self) if stop is None else stop
+        return HitStore(self.num_columns, self.num_rows,
+                        self.occupancy[start - first:stop - first],
+                        self.times[start - first:stop - first], start)
+
+    def as_dicts(self):
+        """
+        Return the hits in the format `Scanner.hits` used to have.
+
+        That is, a list with one dict per cycle, {'cycle': cycle, 'data':
+        columns}, where each column is a dict with the keys 'column',
+        'num_hits', 'hit_rows' and 'time'.
+
+        """
+        result = []
+        occupancy = self.occupancy
+        times = self.times.tolist()
+        for index in range(len(occupancy)):
+            data = []
+            for column in range(self.num_columns):
+                rows = np.flatnonzero(occupancy[index, column]).tolist()
+                data.append({
+                    "column": column,
+                    "num_hits": len(rows),
+                    "hit_rows": rows,
+                    "time": times[index][column],
+                })
+            result.append({'cycle': index + self.first_cycle, 'data': data})
+        return result
@@ -12,22 +12,104 @@ See the class T3MAPSDriver description for more information.
 import yaml
 import numpy as np
 import time
+import array
+from collections import namedtuple, OrderedDict
 from bitarray import bitarray
 import logging
-from pprint import pprint
 from basil.dut import Dut
+import emulator
+from timing import RunStats
+from tdac_map import TDACMap, checksum
 
 
-class Block(dict):
+class Block(namedtuple('Block', ['type', 'data', 'load_DAC'])):
     """
-    A class for storing patterns to be written to the chip.
+    A command to be written to the chip.
+
+    `type` stores whether this `Block` is a pixel, global, or inject
+    block. For pixel and global blocks, `data` holds the bits to shift
+    in, packed into a string (first bit in the most significant bit of
+    the first byte), and `load_DAC` tells whether a global block also
+    loads the DAC shadow register. For inject blocks, `data` is the delay
+    until the injection signal rises again.
+
+    Blocks are immutable, so identical commands compare (and hash) equal.
 
     """
-    type = None
+    __slots__ = ()
+
+
+class SeqImage(namedtuple('SeqImage', ['key', 'data', 'num_bits'])):
     """
-    Store whether this `Block` is a pixel, global, or inject block.
+    A compiled sequence, ready to be written to the sequencer.
+
+    `key` is the tuple of `Block`s it was compiled from, `data` the SEQ
+    memory contents (an array of bytes) and `num_bits` its length.
 
     """
+    __slots__ = ()
+
+
+class PendingRun(object):
+    """
+    A sequence which has been sent to the chip by `T3MAPSDriver.run_async`.
+
+    `start_time` and `end_time` record when the sequence was started
+    and when it was found to be finished (None until then).
+    `uploaded_bytes` is the number of bytes which had to be written to
+    the sequencer's memory to start it.
+
+    `batches` lists the runs which were started before this one, by the
+    same `run_async`, because the commands did not fit into the SEQ
+    memory at once (see `T3MAPSDriver.auto_batch`). Their outputs come
+    first in `result`.
+
+    """
+
+    def __init__(self, driver, num_bits, num_executions, wait, get_output,
+                 start_time, uploaded_bytes=0):
+        self._driver = driver
+        self.uploaded_bytes = uploaded_bytes
+        self.num_bits = num_bits
+        self.num_executions = num_executions
+        self.wait = wait
+        self.get_output = get_output
+        self.start_time = start_time
+        self.end_time = None
+        self.batches = []
+        self._words = None
+        self._packed = None
+        self._output = None
+
+    @property
+    def done(self):
+        return self.end_time is not None
+
+    def result(self, packed=False):
+        """
+        Return the output of the sequence, waiting for it if necessary.
+
+        The output is the same as `T3MAPSDriver.run` returns, i.e. None
+        if the run was started with `get_output=False`. If `packed` is
+        True, the bits are returned packed 8 to a byte instead.
+
+        """
+        if not self.done:
+            self._driver.flush()
+        if self._words is not None:
+            self._packed = self._driver._decode_sr_output(self._words,
+                                                          packed=True)
+            self._words = None
+        if self.batches:
+            outputs = [run.result(packed=True) for run in self.batches]
+            self.batches = []
+            if self.get_output:
+                self._packed = np.concatenate(outputs + [self._packed])
+        if not self.get_output or packed:
+            return self._packed
+        if self._output is None:
+            self._output = np.unpackbits(self._packed)
+        return self._output
 
 
 class T3MAPSDriver(Dut):
@@ -82,19 +164,133 @@ class T3MAPSDriver(Dut):
     Command types could be e.g. "inject," "global" (register) or "pixel"
     (register). The size of the command is in bits.
 
+    """
+    _block_gap = 40
+    """
+    The number of idle bits between two blocks in the SEQ memory.
+
     """
     _global_dropped_bits = 0
     """
     For debugging only. Changes the offset of configuration commands.
 
     """
+    auto_batch = True
+    """
+    Whether to split commands which do not fit into the SEQ memory.
+
+    If True, the commands are split wherever the next block would
+    overflow the SEQ memory, and `run` starts the parts one after the
+    other, joining their outputs in order. Nothing is sent to the chip
+    before `run` or `run_async` is called. If False, a block which does
+    not fit raises ValueError instead, and is not queued; the blocks
+    queued before it can still be run.
+
+    """
+    _queued_bits = 0
+    """
+    The number of SEQ bits the queued blocks since the last batch start
+    take up, including gaps.
+
+    """
+    _batch_starts = []
+    """
+    The indices in `_blocks` at which `auto_batch` starts a new run.
+
+    """
+    seq_clock_frequency = 12e6
+    """
+    The rate (in Hz) at which the sequencer plays the SEQ memory.
+
+    Used to predict how long a sequence takes, so that `_run_seq` can
+    sleep through most of it instead of polling. It should match the
+    firmware; if it is too high, `_run_seq` simply polls for longer.
+
+    """
+    seq_max_wait = 0xffff
+    """
+    The largest number of clock cycles the sequencer can wait between
+    repetitions of a sequence (size of its WAIT register).
+
+    """
+    seq_max_repeat = 0xffff
+    """
+    The largest number of times the sequencer can repeat a sequence
+    (size of its REPEAT register).
+
+    """
+    seq_wait_margin = 0.0005
+    """
+    How long (in s) before the predicted end of a sequence to start
+    polling the sequencer.
+
+    """
+    seq_poll_interval = 0.0001
+    """
+    The time (in s) to sleep between polls of the sequencer once the
+    predicted end of a sequence is near. Set to 0 to poll back to back.
+
+    """
+    _seq_wait = 0
+    """
+    The number of cycles the sequencer currently waits between
+    repetitions, to avoid rewriting the register when it has not changed.
+
+    """
+    seq_cache_size = 64
+    """
+    The number of compiled sequences kept by the driver.
+
+    A sequence of commands which has been run recently is not assembled
+    again, and not even written to the sequencer if it is still in the
+    sequencer's memory. Set to 0 to disable the cache.
+
+    """
+    _resident_seq = None
+    """
+    The key of the `SeqImage` currently in the sequencer's memory.
+
+    """
+    seq_merge_gap = 32
+    """
+    Changed ranges of the SEQ memory closer than this many bytes are
+    written to the sequencer in one transfer, since every transfer has
+    an overhead of its own.
+
+    """
+    last_upload_bytes = 0
+    """
+    The number of bytes written to the sequencer's memory by the last run.
+
+    """
+    _pending_run = None
+    """
+    The `PendingRun` started by `run_async` whose output has not been
+    read yet.
+
+    """
+    stats = None
+    """
+    A `timing.RunStats` object with the timings of each phase of the
+    commands and runs sent by this object.
 
-    def __init__(self, conf_file_name=None, voltage=1.5, conf_dict=None):
+    Replace it with `RunStats(histograms=True)` to also record
+    histograms of the durations.
+
+    """
+
+    def __init__(self, conf_file_name=None, voltage=1.5, conf_dict=None,
+                 emulate=False):
         """
         Initializes the chip, including turning on power.
 
         Exactly one of conf_file_name and conf_dict must be specified.
 
+        If `emulate` is True, or a dict of keyword arguments for
+        `emulator.T3MAPSModel`, the transfer layer and hardware drivers
+        are replaced by the in-process emulator in `lt3maps.emulator`,
+        so no board is needed.
+
         This method also initializes the block lengths to their
         appropriate values.
         """
@@ -107,6 +303,13 @@ class T3MAPSDriver(Dut):
         else:  # conf_dict must be specified
             pass
 
+        # Options for the emulator, or None to talk to real hardware
+        self._emulator_options = None
+        if emulate:
+            self._emulator_options = emulate if isinstance(emulate,
+                                                           dict) else {}
+        self._emulator_conf = conf_dict
+
         # Create the T3MAPSDriver object
         Dut.__init__(self, conf_dict)
 
@@ -135,9 +338,107 @@ class T3MAPSDriver(Dut):
         # arbitrary length, but long enough to be detected by discriminator.
         self._block_lengths['inject'] = 500
 
+        # The SEQ memory holds one byte per clock cycle, one bit per track.
+        # Commands are assembled directly into this image.
+        seq_conf = self['SEQ']._conf
+        if seq_conf['seq_width'] != 8:
+            raise NotImplementedError("Only 8-track sequences are supported.")
+        self._seq_driver = self[seq_conf['hw_driver']]
+        self._track_masks = dict((track['name'], 1 << track['position'])
+                                 for track in seq_conf['tracks'])
+        seq_size = min(seq_conf['seq_size'],
+                       self._seq_driver._conf.get('mem_size',
+                                                  seq_conf['seq_size']))
+        self._seq_image = np.zeros(seq_size, dtype=np.uint8)
+        # bytes of the image which may be non-zero
+        self._seq_image_used = 0
+        # what the sequencer's memory holds, valid up to _seq_memory_valid
+        self._seq_memory = np.zeros(seq_size, dtype=np.uint8)
+        self._seq_memory_valid = 0
+        # the INJECTION signal idles high
+        self._seq_idle = self._track_masks['INJECTION']
+
+        # For reversing the bits of each global register field at once
+        gr_size = len(self['GLOBAL_REG'])
+        self._global_reverse_index = np.arange(gr_size)
+        for field in self['GLOBAL_REG']._conf['fields']:
+            start = field['offset'] - field['size'] + 1
+            stop = field['offset'] + 1
+            self._global_reverse_index[start:stop] =\
+                self._global_reverse_index[start:stop][::-1]
+        self._build_block_templates()
+
+        self.stats = RunStats()
+        self._seq_cache = OrderedDict()
+        self.seq_cache_hits = 0
+        self.seq_cache_misses = 0
+
         # Make sure the chip is reset
         self.reset_seq()
 
+    def _factory(self, importname, *args, **kargs):
+        """
+        Create a BASIL module, substituting the emulator if requested.
+
+        """
+        if self._emulator_options is not None:
+            module = emulator.create_module(importname, self._emulator_conf,
+                                            self._emulator_options, **kargs)
+            if module is not None:
+                return module
+        return Dut._factory(self, importname, *args, **kargs)
+
+    def _build_block_templates(self):
+        """
+        Build the SEQ image of each kind of register block.
+
+        A template holds everything except the bits shifted in, which
+        are patched in by `_write_blocks_to_seq`. Templates are stored
+        in `_block_templates` keyed by (block type, load_DAC), together
+        with the location and size of the shift-in data. Injection
+        templates depend on the delay, and are added by
+        `_block_template` as they are needed.
+
+        """
+        masks = self._track_masks
+        gr_size = len(self['GLOBAL_REG'])
+        px_size = len(self['PIXEL_REG'])
+        dropped = self._global_dropped_bits
+
+        # the global register is clocked in, then the shadow registers load
+        global_image = np.empty(self._block_lengths['global'], np.uint8)
+        global_image[:] = self._seq_idle
+        global_image[:gr_size + dropped] |= masks['GLOBAL_SHIFT_EN']
+        global_image[gr_size + 1 + dropped] |= masks['GLOBAL_CTR_LD']
+        global_DAC_image = global_image.copy()
+        global_DAC_image[gr_size + 1 + dropped] |= masks['GLOBAL_DAC_LD']
+
+        # the pixel register is clocked in (12MHz)
+        pixel_image = np.empty(self._block_lengths['pixel'], np.uint8)
+        pixel_image[:] = self._seq_idle | masks['PIXEL_SHIFT_EN']
+
+        self._block_templates = {
+            ('global', False): (global_image, dropped, gr_size),
+            ('global', True): (global_DAC_image, dropped, gr_size),
+            ('pixel', False): (pixel_image, 0, px_size),
+        }
+
+    def _block_template(self, block):
+        """
+        Return the (image, data offset, data size) template for a block.
+
+        """
+        if block.type == 'inject':
+            key = ('inject', block.data)
+            if key not in self._block_templates:
+                # low until `delay_until_rise`, then back to the idle level
+                image = np.empty(self._block_lengths['inject'], np.uint8)
+                image[:] = self._seq_idle
+                image[:block.data] = 0
+                self._block_templates[key] = (image, 0, 0)
+            return self._block_templates[key]
+        return self._block_templates[(block.type, block.load_DAC)]
+
     def write_global_reg(self, load_DAC=False):
         """
         Add the global register to the command to send to the chip.
@@ -147,49 +448,13 @@ class T3MAPSDriver(Dut):
         loaded. To load it, set the load_DAC parameter to True.
 
         """
-
-        gr_size = len(self['GLOBAL_REG'][:])  # get the size
-        # define start and stop indices in the array
-        seq = {
-            'SHIFT_IN': bitarray('0' * (gr_size + self._global_dropped_bits)),
-            'GLOBAL_SHIFT_EN': bitarray('0' * (gr_size +
-                                        self._global_dropped_bits)),
-            'GLOBAL_CTR_LD': bitarray('0' * (gr_size + 2 +
-                                      self._global_dropped_bits)),
-            'GLOBAL_DAC_LD': bitarray('0' * (gr_size + 2 +
-                                      self._global_dropped_bits)),
-        }
-        seq = Block(seq)
-        seq.type = 'global'
-
+        start = time.time()
         # input is the contents of global register
-        seq['SHIFT_IN'][self._global_dropped_bits:gr_size +
-                        self._global_dropped_bits] =\
-            self._global_reg_reversed()
-        # Enable the clock
-        seq['GLOBAL_SHIFT_EN'][0:gr_size + self._global_dropped_bits] =\
-            bitarray(gr_size * '1')
-        # load signals into the shadow register
-        seq['GLOBAL_CTR_LD'][gr_size + 1 +
-                             self._global_dropped_bits:gr_size + 2 +
-                             self._global_dropped_bits] = bitarray("1")
-        if load_DAC:
-            seq['GLOBAL_DAC_LD'][gr_size + 1 +
-                                 self._global_dropped_bits:gr_size + 2 +
-                                 self._global_dropped_bits] = bitarray("1")
-
-        # Make all patterns the same length
-        # Find the max of all lengths of all patterns
-        max_length = len(max(seq.values(), key=len))
-        # Adjust the length of each pattern
-        for value in seq.itervalues():
-            length = len(value)
-            relative_length = max_length - length
-            value += '0' * relative_length
-
-        # add the block to the list of blocks to write
-        self._blocks.append(seq)
-        pprint(self._blocks)
+        data = np.packbits(self._global_reg_reversed()).tostring()
+        block = Block('global', data, bool(load_DAC))
+        self.stats.add('build', time.time() - start,
+                       self._block_lengths['global'])
+        self._queue_block(block)
 
     def write_pixel_reg(self):
         """
@@ -198,21 +463,13 @@ class T3MAPSDriver(Dut):
         Includes enabling the clock.
 
         """
-        px_size = len(self['PIXEL_REG'][:])  # get the size
-        seq = {
-            'SHIFT_IN': bitarray('0' * px_size),
-            'PIXEL_SHIFT_EN': bitarray('0' * px_size),
-        }
-        seq = Block(seq)
-        seq.type = 'pixel'
-
+        start = time.time()
         # this will be shifted out
-        seq['SHIFT_IN'][0:px_size] = self['PIXEL_REG'][:]
-        # this is to enable clock (12MHz)
-        seq['PIXEL_SHIFT_EN'][0:px_size] = bitarray(px_size * '1')
-
-        # add the block to the list of blocks to write
-        self._blocks.append(seq)
+        data = bitarray(self['PIXEL_REG'][:], endian='big').tobytes()
+        block = Block('pixel', data, False)
+        self.stats.add('build', time.time() - start,
+                       self._block_lengths['pixel'])
+        self._queue_block(block)
 
     def write_injection(self, delay_until_rise):
         """
@@ -225,14 +482,54 @@ class T3MAPSDriver(Dut):
             raise ValueError("delay must be <= " +
                              str(self._block_lengths['inject']))
 
-        filler = self._block_lengths['inject'] - delay_until_rise
-        injection_sequence = Block({
-            "INJECTION": bitarray('0'*delay_until_rise + '1' * filler)
-            })
-        injection_sequence.type = 'inject'
-        self._blocks.append(injection_sequence)
+        start = time.time()
+        block = Block('inject', delay_until_rise, False)
+        self.stats.add('build', time.time() - start,
+                       self._block_lengths['inject'])
+        self._queue_block(block)
+
+    def _block_size(self, block_type, first=False):
+        """
+        Return the number of SEQ bits a block of the given type takes up.
+
+        This includes the gap after the block, and, for an injection at
+        the start of a sequence (`first`), the idle injection-length
+        block which `_write_blocks_to_seq` puts in front of it.
+
+        """
+        size = self._block_lengths[block_type] + self._block_gap
+        if first and block_type == 'inject':
+            size += self._block_lengths['inject']
+        return size
+
+    def _queue_block(self, block):
+        """
+        Add a block to the commands, starting a new batch if needed.
+
+        If the block would not fit into the SEQ memory together with the
+        blocks queued since the last batch start and `auto_batch` is set,
+        the next run starts with this block (see `_batch_starts`).
+        Otherwise, the block is rejected with ValueError.
 
-    def run(self, get_output=True):
+        """
+        capacity = len(self._seq_image)
+        first = self._queued_bits == 0
+        size = self._block_size(block.type, first)
+        if self._queued_bits + size > capacity:
+            if not self.auto_batch:
+                raise ValueError("Commands do not fit into the SEQ memory "
+                                 "(%i bits)" % capacity)
+            if not first:
+                self._batch_starts.append(len(self._blocks))
+                self._queued_bits = 0
+                size = self._block_size(block.type, True)
+            if size > capacity:
+                raise ValueError("A %s block does not fit into the SEQ "
+                                 "memory (%i bits)" % (block.type, capacity))
+        self._blocks.append(block)
+        self._queued_bits += size
+
+    def run(self, get_output=True, num_executions=1, wait=0, packed=False):
         """
         Send current commands to the chip and return the output.
 
@@ -241,18 +538,105 @@ class T3MAPSDriver(Dut):
         first bit corresponds to the last bit in the shift register, since the
         last bit is out first.
 
+        Commands which do not fit into the SEQ memory at once are run in
+        several parts (see `auto_batch`); the output still covers all of
+        them.
+
+        The sequencer plays the commands `num_executions` times, waiting
+        `wait` clock cycles after each execution. The output of all
+        executions is returned back to back.
+
+        The output has one uint8 per bit, or, if `packed` is True, 8 bits
+        per byte, first bit out in the most significant bit.
+
         """
-        # run
-        self._run_seq()
+        start = time.time()
+        pending = self.run_async(get_output, num_executions, wait)
+        output = pending.result(packed)
+        self.stats.add('run', time.time() - start,
+                       0 if output is None else 8 * len(output) if packed
+                       else len(output))
+        return output
 
-        output = None
-        if get_output:
-            # capture the output from earlier shift registers
-            output = self._get_sr_output(invert=True)
+    def run_async(self, get_output=True, num_executions=1, wait=0):
+        """
+        Send current commands to the chip without waiting for the output.
+
+        Returns a `PendingRun`, whose `result` method returns what `run`
+        would have returned.
+
+        This is the pipelined version of `run`. The commands are
+        assembled and staged while the previous sequence is still
+        executing on the chip. Only then does this method wait for the
+        previous sequence to finish and read its output, before starting
+        the new sequence. The output of the previous sequence is decoded
+        while the new one executes. Between calls, the caller is free to
+        set up the next commands while the chip is busy.
+
+        The current blocks are erased in the process.
 
-        # reset the sequence to start again
+        """
+        bounds = [0] + self._batch_starts + [len(self._blocks)]
+        if len(bounds) > 2 and (num_executions != 1 or wait):
+            self.reset_seq()
+            raise ValueError("Commands to be repeated by the sequencer must "
+                             "fit into the SEQ memory at once")
+        blocks = self._blocks
+        batches = []
+        for start, stop in zip(bounds[:-2], bounds[1:-1]):
+            self._blocks = blocks[start:stop]
+            batches.append(self._start_run(True, 1, 0))
+        self._blocks = blocks[bounds[-2]:]
+        pending = self._start_run(get_output, num_executions, wait)
+        pending.batches = batches
+        return pending
+
+    def _start_run(self, get_output, num_executions, wait):
+        """
+        Start the current blocks as one run, as in `run_async`.
+
+        """
+        # assemble and stage while the previous sequence executes
+        image = self._stage_seq()
         self.reset_seq()
-        return output
+
+        previous = self._pending_run
+        self.flush()
+        started = self._start_seq(image, num_executions, wait=wait)
+        self._pending_run = PendingRun(self, image.num_bits, num_executions,
+                                       wait, get_output, started,
+                                       self.last_upload_bytes)
+
+        if previous is not None:
+            # decode while the new sequence executes
+            previous.result()
+        return self._pending_run
+
+    def flush(self):
+        """
+        Wait for the sequence started by `run_async` and read its output.
+
+        This happens automatically before the next sequence is started,
+        or when the output of the pending run is requested.
+
+        """
+        pending = self._pending_run
+        if pending is None:
+            return
+        self._pending_run = None
+
+        start = time.time()
+        num_bits = ((pending.num_bits + pending.wait) *
+                    max(pending.num_executions, 1))
+        self._wait_for_seq(num_bits, pending.start_time)
+        pending.end_time = time.time()
+        self.stats.add('wait', pending.end_time - start, num_bits)
+        logging.debug("done with writing seq (%i bits, %i bytes uploaded)",
+                      pending.num_bits, pending.uploaded_bytes)
+
+        if pending.get_output:
+            # capture the output from earlier shift registers
+            pending._words = self._read_fifo()
 
     def _run_seq(self, num_executions=1, enable_receiver=True):
         """
@@ -266,62 +650,202 @@ class T3MAPSDriver(Dut):
         if num_executions == 0, loop indefinitely.
 
         """
+        image = self._stage_seq()
+        self.flush()
+        started = self._start_seq(image, num_executions, enable_receiver)
+        self._pending_run = PendingRun(self, image.num_bits, num_executions,
+                                       0, False, started,
+                                       self.last_upload_bytes)
+        self.flush()
+
+    def _stage_seq(self):
+        """
+        Compile the blocks into a `SeqImage`, ready to be sent.
+
+        Recently compiled sequences are taken from the cache instead of
+        being assembled again, unless `seq_cache_size` is 0.
+
+        """
+        start = time.time()
+        key = tuple(self._blocks)
+        image = None
+        if self.seq_cache_size:
+            image = self._seq_cache.pop(key, None)
+        if image is None:
+            self.seq_cache_misses += 1
+            # Assemble the blocks into the SEQ image
+            num_bits = self._write_blocks_to_seq()
+            image = SeqImage(key, array.array('B', self._seq_image[:num_bits]
+                                              .tostring()), num_bits)
+        else:
+            self.seq_cache_hits += 1
+        if self.seq_cache_size:
+            while (self._seq_cache and
+                   len(self._seq_cache) >= self.seq_cache_size):
+                self._seq_cache.popitem(last=False)
+            # most recently used last
+            self._seq_cache[key] = image
+        self.stats.add('transcribe', time.time() - start, image.num_bits)
+        return image
+
+    def seq_cache_info(self):
+        """
+        Return a dict describing the use of the compiled sequence cache.
+
+        """
+        return {
+            'hits': self.seq_cache_hits,
+            'misses': self.seq_cache_misses,
+            'size': len(self._seq_cache),
+            'max_size': self.seq_cache_size,
+        }
+
+    def clear_seq_cache(self):
+        """
+        Forget all compiled sequences.
+
+        """
+        self._seq_cache.clear()
+        self._resident_seq = None
+        self._seq_memory_valid = 0
+
+    def _start_seq(self, image, num_executions=1, enable_receiver=True,
+                   wait=0):
+        """
+        Write a `SeqImage` to the sequencer and start it.
+
+        Only the parts of the image which differ from what the sequencer
+        already holds are written (see `_dirty_ranges`), and nothing at
+        all if the image is already in the sequencer's memory.
+
+        Returns the time at which the sequencer was started.
+
+        """
+        if not 0 <= wait <= self.seq_max_wait:
+            raise ValueError("wait must be between 0 and %i cycles" %
+                             self.seq_max_wait)
+        if not 0 <= num_executions <= self.seq_max_repeat:
+            raise ValueError("num_executions must be between 0 and %i" %
+                             self.seq_max_repeat)
+        start = time.time()
         # enable receiver it work only if pixel register is enabled/clocked
         self['PIXEL_RX'].set_en(enable_receiver)
 
-        # Transcribe the blocks to self['SEQ']
-        num_bits = self._write_blocks_to_seq()
-
         # Write the sequence to the sequence generator (hw driver)
-        self['SEQ'].write(num_bits)  # write pattern to memory
+        seq_driver = self._seq_driver
+        num_bytes = 0
+        if image.key != self._resident_seq:
+            data = np.frombuffer(image.data, dtype=np.uint8)
+            for low, high in self._dirty_ranges(data):
+                # write the changed part of the pattern to memory
+                seq_driver.set_data(image.data[low:high], addr=low)
+                self._seq_memory[low:high] = data[low:high]
+                num_bytes += high - low
+            self._seq_memory_valid = max(self._seq_memory_valid, len(data))
+            self._resident_seq = image.key if self.seq_cache_size else None
+        self.last_upload_bytes = num_bytes
+
+        seq_driver.set_size(image.num_bits)  # set size
+        seq_driver.set_repeat(num_executions)  # set repeat
+        if wait != self._seq_wait:
+            seq_driver.set_wait(wait)  # set wait between repetitions
+            self._seq_wait = wait
+        seq_driver.start()  # start
+        started = time.time()
+        self.stats.add('transfer', started - start, image.num_bits, num_bytes)
+        return started
+
+    def _dirty_ranges(self, data):
+        """
+        Return the (start, stop) byte ranges where `data` differs from
+        the sequencer's memory.
 
-        self['SEQ'].set_size(num_bits)  # set size
-        self['SEQ'].set_repeat(num_executions)  # set repeat
-        self['SEQ'].start()  # start
+        Ranges separated by less than `seq_merge_gap` bytes are merged.
+        Everything beyond what is known to be in the sequencer's memory
+        counts as changed.
 
-        while not self['SEQ'].get_done():
-            time.sleep(0.01)
-            #print "Wait for done..."
-        print "done with writing seq"
+        """
+        size = len(data)
+        valid = min(self._seq_memory_valid, size)
+        changed = np.flatnonzero(data[:valid] != self._seq_memory[:valid])
+        ranges = []
+        if len(changed):
+            breaks = np.flatnonzero(np.diff(changed) > self.seq_merge_gap)
+            starts = changed[np.r_[0, breaks + 1]]
+            stops = changed[np.r_[breaks, len(changed) - 1]] + 1
+            ranges = zip(starts.tolist(), stops.tolist())
+        if valid < size:
+            if ranges and valid - ranges[-1][1] <= self.seq_merge_gap:
+                ranges[-1] = (ranges[-1][0], size)
+            else:
+                ranges.append((valid, size))
+        return ranges
+
+    def _wait_for_seq(self, num_bits, started):
+        """
+        Wait until the sequencer has played `num_bits` bits.
+
+        `started` is the time at which the sequencer was started. Sleeps
+        until `seq_wait_margin` before the predicted end of the sequence,
+        then polls the sequencer every `seq_poll_interval` seconds.
+
+        """
+        duration = num_bits / float(self.seq_clock_frequency)
+        remaining = started + duration - self.seq_wait_margin - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        seq_driver = self._seq_driver
+        while not seq_driver.get_done():
+            if self.seq_poll_interval:
+                time.sleep(self.seq_poll_interval)
 
     def _write_blocks_to_seq(self):
         """
-        Write the commands stored in _blocks to self['SEQ'].
+        Assemble the commands stored in _blocks into the SEQ image.
 
-        Includes some empty space between blocks to separate commands.
+        Each block is copied from its template and the bits to shift in
+        are patched on top. Includes some empty space between blocks to
+        separate commands.
 
         Returns the number of bits which should be sent to
         self['SEQ'].set_size.
 
         """
-        seq = self['SEQ']
-
-        # set up the INJECTION channel to be all high
-        seq['INJECTION'].setall(True)
-        # Add each block to self['SEQ']
+        image = self._seq_image
+        shift_in = self._track_masks['SHIFT_IN']
+        self._seq_image_used = len(image)
+        # Add each block to the image
         num_bits = 0
-        buffer_length = 40
+        buffer_length = self._block_gap
         start_location = 0
-        end_location = 0
-        num_bits_in_seq = 0
-        for i, block in enumerate(self._blocks):
-            # First find the type of block: pixel or global
-            # This determines the length of the block
+        for block in self._blocks:
+            # The type of block determines the length of the block
             num_bits_in_seq = self._block_lengths[block.type]
-            end_location = start_location + num_bits_in_seq
 
             # can't start a SEQ with an injection,
             # since injection signals are low, and
             # the default is high.
             # Fix by moving first block forwards by 1 injection block.
             if start_location == 0 and block.type == 'inject':
-                start_location += self._block_lengths[block.type]
-                end_location += self._block_lengths[block.type]
-                num_bits_in_seq += self._block_lengths[block.type]
-
-            # Write each of the fields of the block to self['SEQ']
-            for key, value in block.iteritems():
-                seq[key][start_location:end_location] = value
+                start_location += num_bits_in_seq
+                num_bits += num_bits_in_seq
+                image[:start_location] = self._seq_idle
+            end_location = start_location + num_bits_in_seq
+            if end_location + buffer_length > len(image):
+                raise ValueError("Commands do not fit into the SEQ memory "
+                                 "(%i bits)" % len(image))
+
+            # Copy the template and patch in the data
+            template, data_offset, data_size = self._block_template(block)
+            image[start_location:end_location] = template
+            if data_size:
+                bits = np.unpackbits(np.frombuffer(block.data,
+                                                   dtype=np.uint8))
+                data_start = start_location + data_offset
+                image[data_start:data_start + data_size] |=\
+                    bits[:data_size] * shift_in
+            image[end_location:end_location + buffer_length] = self._seq_idle
 
             # record how many bits were written
             num_bits += num_bits_in_seq + buffer_length
@@ -329,6 +853,7 @@ class T3MAPSDriver(Dut):
             # Move the next start location
             start_location = end_location + buffer_length
 
+        self._seq_image_used = num_bits
         return num_bits
 
     def reset_seq(self, fields=None):
@@ -353,14 +878,21 @@ class T3MAPSDriver(Dut):
 
         If no fields are given, resets all fields (entire register).
 
+        Only the part of the image written since the last reset is
+        cleared.
+
         """
+        used = self._seq_image_used
         if not fields:
-            fields = [track['name'] for track in self['SEQ']._conf['tracks']]
-
-        for field in fields:
-            self['SEQ'][field].setall(False)
+            self._seq_image[:used] = 0
+            self._seq_image_used = 0
+        else:
+            mask = sum(self._track_masks[field] for field in fields)
+            self._seq_image[:used] &= ~np.uint8(mask)
 
         self._blocks = []
+        self._queued_bits = 0
+        self._batch_starts = []
 
     def set_global_register(self, empty_pattern="10000001", **kwargs):
         """
@@ -413,40 +945,63 @@ class T3MAPSDriver(Dut):
         """
         self['PIXEL_REG'][:] = bitarray(value)
 
-    def _get_sr_output(self, invert=True):
+    def _get_sr_output(self, invert=True, packed=False):
         """
         Retrieve the output from the chip.
 
-        Returned as a list of (possibly inverted) bits.
+        Returned as a list of (possibly inverted) bits, or as packed bits
+        if `packed` is True.
 
         Make sure to save the return value, since this method only works
         once.
 
+        """
+        return self._decode_sr_output(self._read_fifo(), invert, packed)
+
+    def _read_fifo(self):
+        """
+        Read all words from the sram fifo.
+
+        """
+        start = time.time()
+        rxd = self['DATA'].get_data()
+        self.stats.add('fifo_read', time.time() - start, 0, rxd.nbytes)
+        return rxd
+
+    def _decode_sr_output(self, rxd, invert=True, packed=False):
+        """
+        Convert words read from the sram fifo into a list of bits.
+
+        If `packed` is True, return the bytes the bits came in instead,
+        first bit in the most significant bit.
+
         """
         # 1. Data emerges from hardware in the following form:
         # [ 0b<nonsense><byte1><byte2>, 0b<nonsense><byte3><byte4>, ...]
-        # 2. So, take last 8 bits from each item to get even-numbered entries,
-        # 3. and 2nd-to-last 8 bits to get odd-numbered entries.
-        # 4. Then, weave the lists together.
+        # 2. So, view each word as its 4 bytes (least significant first)
+        # 3. and take the 2nd and 1st byte of each word, in that order.
+        # 4. Invert (or copy) them into one array of all bytes read.
         # 5. To get the bits themselves, unpack the uint8's to a list of bits.
 
-        # 1. get data from sram fifo
-        rxd = self['DATA'].get_data()
-        # 2. Take from rxd only the last 8 bits of each element.
-        #    Do this by casting the elements of the list to uint8.
-        data0 = rxd.astype(np.uint8)
-        # 3. Rightshift rxd 8 bits and take again last 8 bits
-        data1 = np.right_shift(rxd, 8).astype(np.uint8)
-        # 4. Make data a 1 dimensional array of all bytes read from the FIFO
-        #    This magic is accomplished with "FORTRAN" order reshaping.
-        data = np.reshape(np.vstack((data1, data0)), -1, order='F')
-        # 5. make data into bits
-        bdata = np.unpackbits(data)
+        start = time.time()
+        # 2. No copy if the words are already little endian uint32
+        words = np.ascontiguousarray(rxd, dtype='<u4')
+        # 3. A strided view of byte1, byte2, byte3, ...
+        data = words.view(np.uint8).reshape(-1, 4)[:, 1::-1]
+        # 4. One pass over the data, flattening it
         if invert:
-            # treat bits as bools (default is 8-bit numbers),
-            # then recast to ints.
-            bdata = np.invert(bdata, dtype=np.bool).astype(np.uint8)
-        return bdata
+            data = np.invert(data).ravel()
+        else:
+            data = data.ravel()
+        if packed:
+            num_bits = 8 * len(data)
+        else:
+            # 5. make data into bits
+            data = np.unpackbits(data)
+            num_bits = len(data)
+        self.stats.add('decode', time.time() - start, num_bits,
+                       rxd.nbytes)
+        return data
 
     def _get_output_size(self):
         """
@@ -469,32 +1024,124 @@ class T3MAPSDriver(Dut):
         """
         Get the global register, with the bits in each field reversed.
 
-        This is necessary for input to the chip.
+        This is necessary for input to the chip. The bits are returned
+        as an array of 0s and 1s.
 
         """
-        global_register = self['GLOBAL_REG']
+        global_register = bitarray(self['GLOBAL_REG'][:], endian='big')
+        bits = np.unpackbits(np.frombuffer(global_register.tobytes(),
+                                           dtype=np.uint8))
+        return bits[self._global_reverse_index]
 
-        # reverse each field, save the result, then re-reverse
-        for field in global_register._fields:
-            global_register[field].reverse()
 
-        to_return = global_register[:]
+class PixelState(object):
+    """
+    The configuration of every pixel of a chip, as seen by the software.
+
+    `TDAC` holds the TDAC value of each pixel, indexed by (column, row).
+    `needs_update` marks the pixels whose TDAC value has been changed
+    in software but not yet sent to the chip. `latches` maps the name of
+    each strobe for a 1-bit latch (e.g. 'hit_strobe') to a boolean array
+    of the latch values.
+
+    Strobes are applied to whole columns at once by `strobe`.
+
+    """
+
+    TDAC_size = 5
+    latch_names = ('hitor_strobe', 'hit_strobe', 'inject_strobe')
 
-        # now un-reverse the fields to return to normal
-        for field in global_register._fields:
-            global_register[field].reverse()
+    def __init__(self, num_columns, num_rows):
+        self.num_columns = num_columns
+        self.num_rows = num_rows
+        shape = (num_columns, num_rows)
+        self.TDAC = np.zeros(shape, dtype=np.uint8)
+        self.needs_update = np.zeros(shape, dtype=bool)
+        self.latches = dict((name, np.zeros(shape, dtype=bool))
+                            for name in self.latch_names)
 
-        return to_return
+    def set_TDAC(self, value, columns=slice(None), rows=slice(None)):
+        """
+        Set the TDAC values of the given pixels (by default, all).
+
+        `value` can be a number or an array matching the selection. The
+        pixels are marked as needing an update.
+
+        """
+        value = np.asarray(value)
+        if value.size and value.min() < 0:
+            raise ValueError("%i is negative" % value.min())
+        if value.size and value.max() >= 2**self.TDAC_size:
+            raise ValueError("%i is too big to fit into %i bits" %
+                             (value.max(), self.TDAC_size))
+        self.TDAC[columns, rows] = value
+        self.needs_update[columns, rows] = True
+
+    def strobe(self, column, enable, strobes=(), TDAC_strobes=None):
+        """
+        Record the effect of strobing the latches of a column.
+
+        `enable` is a boolean array of the pixel shift register contents,
+        indexed by row. Every latch named in `strobes` and every TDAC bit
+        set in `TDAC_strobes` takes the value of `enable`. If
+        `TDAC_strobes` is given (even 0), the TDAC values of the column
+        are then marked as up to date.
+
+        """
+        enable = np.asarray(enable, dtype=bool)
+        for name in strobes:
+            self.latches[name][column] = enable
+        if TDAC_strobes is not None:
+            mask = np.uint8(TDAC_strobes)
+            tdac = self.TDAC[column]
+            tdac &= ~mask
+            tdac |= enable * mask
+            self.needs_update[column] = False
+
+    def TDAC_binary(self):
+        """
+        Return the TDAC values as an array of binary strings.
+
+        """
+        template = "{0:0%ib}" % self.TDAC_size
+        return np.array([[template.format(value) for value in column]
+                         for column in self.TDAC.tolist()])
+
+    def dirty_columns(self):
+        """
+        Return the indices of the columns which need a TDAC update.
+
+        """
+        return np.flatnonzero(self.needs_update.any(axis=1))
 
 
 class Pixel(object):
-    def __init__(self, column, row):
+    """
+    A view of one pixel in a `PixelState`.
+
+    Kept for code which works with single pixels, e.g.
+    `chip._pixels[column][row].TDAC += 1`.
+
+    """
+
+    def __init__(self, state, column, row):
+        self._state = state
         self.column = column
         self.row = row
-        self.needs_update = False
-        self._TDAC = 0
-        self._TDAC_binary = "00000"
-        self._TDAC_size = 5
+
+    def __eq__(self, other):
+        return (isinstance(other, Pixel) and self._state is other._state and
+                (self.column, self.row) == (other.column, other.row))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.column, self.row))
+
+    def __repr__(self):
+        return "Pixel(column=%i, row=%i, TDAC=%i)" % (self.column, self.row,
+                                                     self.TDAC)
 
     @property
     def TDAC(self):
@@ -502,19 +1149,27 @@ class Pixel(object):
         The TDAC value stored by this pixel.
 
         """
-        return self._TDAC
+        return int(self._state.TDAC[self.column, self.row])
 
     @TDAC.setter
     def TDAC(self, value):
         """
-        Set the TDAC value and update the binary version.
+        Set the TDAC value and mark the pixel as needing an update.
 
         """
-        string = "setting " + str((self.column, self.row)) + " to " + str(value)
-        #logging.debug(string)
-        self._TDAC_binary = Pixel.get_n_bit_binary(value, self._TDAC_size)
-        self._TDAC = value
-        self.needs_update = True
+        self._state.set_TDAC(value, self.column, self.row)
+
+    @property
+    def _TDAC_binary(self):
+        return Pixel.get_n_bit_binary(self.TDAC, self._state.TDAC_size)
+
+    @property
+    def needs_update(self):
+        return bool(self._state.needs_update[self.column, self.row])
+
+    @needs_update.setter
+    def needs_update(self, value):
+        self._state.needs_update[self.column, self.row] = value
 
     def update_TDAC(self, strobe_value, enable):
         """
@@ -524,19 +1179,10 @@ class Pixel(object):
         `enable` is True if the Pixel's SR bit was 1 for the strobe.
 
         """
-        TDAC_length = 5
-        enable_str = str(int(enable))
-        new_TDAC_binary = ""
-        # Get a binary representation of the strobe
-        bin_strobe = Pixel.get_n_bit_binary(strobe_value, TDAC_length)
-
-        for i in range(TDAC_length):
-            if bin_strobe[i] == "1":
-                new_TDAC_binary += enable_str
-            else:
-                new_TDAC_binary += self._TDAC_binary[i]
-
-        self.TDAC = int(new_TDAC_binary, 2)
+        tdac = self.TDAC & ~strobe_value
+        if enable:
+            tdac |= strobe_value
+        self.TDAC = tdac
 
     @staticmethod
     def get_n_bit_binary(x, n):
@@ -544,15 +1190,11 @@ class Pixel(object):
         Get the given number expressed as an n-bit binary value.
 
         """
-        binary_value = bin(x)[2:]
-        if binary_value[0] == "-":
+        if x < 0:
             raise ValueError("%i is negative" % x)
-        binary_length = len(binary_value)
-        if binary_length <= n:
-            binary_value = "0"*(n - binary_length) + binary_value
-        else:
+        if x >= 2**n:
             raise ValueError("%i is too big to fit into %i bits" % (x,n))
-        return binary_value
+        return "{0:0{1}b}".format(x, n)
 
 
 class T3MAPSChip(object):
@@ -561,12 +1203,62 @@ class T3MAPSChip(object):
 
     """
 
-    def __init__(self, config_file):
-        self._driver = T3MAPSDriver(config_file)
-        self.num_columns = 18
+    num_columns = 18
+    num_rows = 64
+    """
+    The size of the pixel matrix. Each chip takes `num_rows` from the
+    size of its PIXEL_REG.
+
+    """
+
+    def __init__(self, config_file, emulate=False):
+        self._driver = T3MAPSDriver(config_file, emulate=emulate)
         self.num_rows = len(self._driver['PIXEL_REG'])
-        self._pixels = [[Pixel(column, row) for row in range(self.num_rows)]
-                        for column in range(self.num_columns)]
+        self.pixel_state = PixelState(self.num_columns, self.num_rows)
+        self._pixel_views = None
+        self._applied_TDAC_checksum = None
+        # (PendingRun, checksum) of the TDAC map being applied
+        self._TDAC_run = None
+
+    @property
+    def _applied_TDAC_checksum(self):
+        """
+        The checksum of the TDAC map last applied in full, if still valid.
+
+        A map counts as applied once the run which sends it has finished.
+
+        """
+        if self._TDAC_run is not None and self._TDAC_run[0].done:
+            self._TDAC_checksum = self._TDAC_run[1]
+            self._TDAC_run = None
+        return self._TDAC_checksum
+
+    @_applied_TDAC_checksum.setter
+    def _applied_TDAC_checksum(self, value):
+        self._TDAC_checksum = value
+        self._TDAC_run = None
+
+    def _TDAC_applied(self, TDAC_checksum):
+        """
+        Return whether the TDAC map with this checksum is on the chip and
+        in the software pixels, so that applying it would change nothing.
+
+        """
+        return (TDAC_checksum == self._applied_TDAC_checksum and
+                TDAC_checksum == checksum(self.pixel_state.TDAC))
+
+    @property
+    def _pixels(self):
+        """
+        The pixels as `Pixel` views of `pixel_state`, indexed by
+        [column][row].
+
+        """
+        if self._pixel_views is None:
+            self._pixel_views = [[Pixel(self.pixel_state, column, row)
+                                  for row in range(self.num_rows)]
+                                 for column in range(self.num_columns)]
+        return self._pixel_views
 
     def set_bit_latches(self, column_number, rows_to_enable, *args):
         """
@@ -581,12 +1273,11 @@ class T3MAPSChip(object):
         """
         driver = self._driver
         # Construct the pixel register input
-        if rows_to_enable is None:
-            pixel_register_input = "1" * self.num_rows
-        else:
-            pixel_register_input = ["1" if i in rows_to_enable else "0" for i in
-                                    range(self.num_rows)][::-1]
-            pixel_register_input = ''.join(pixel_register_input)
+        enable = np.ones(self.num_rows, dtype=bool)
+        if rows_to_enable is not None:
+            enable[:] = False
+            enable[list(rows_to_enable)] = True
+        pixel_register_input = enable[::-1].tolist()
 
         self.set_global_register(
             column_address=column_number)
@@ -610,12 +1301,12 @@ class T3MAPSChip(object):
         # Disable the strobes. (New values are saved.)
         self.set_global_register(column_address=column_number)
 
-        # Update the saved Pixel TDAC values, maybe
-        if 'TDAC_strobes' in args:
-            for i, enable_str in enumerate(pixel_register_input[::-1]):
-                pixel = self._pixels[column_number][i]
-                pixel.update_TDAC(strobes['TDAC_strobes'], (enable_str == "1"))
-                pixel.needs_update = False
+        # Update the saved pixel latch and TDAC values
+        if 'TDAC_strobes' in strobes:
+            self._applied_TDAC_checksum = None
+        latches = [name for name in strobes if name != 'TDAC_strobes']
+        self.pixel_state.strobe(column_number, enable, latches,
+                                strobes.get('TDAC_strobes'))
         return
 
     def set_pixel_register(self, value):
@@ -642,14 +1333,57 @@ class T3MAPSChip(object):
         self._driver.set_global_register(**kwargs)
         self._driver.write_global_reg(load_DAC=load_DAC)
 
-    def run(self, get_output=True):
+    def inject(self, delay_until_rise=250):
+        """
+        Add an injection pulse, into every pixel whose inject latch is
+        set. See `T3MAPSDriver.write_injection`.
+
+        """
+        self._driver.write_injection(delay_until_rise)
+
+    def run(self, get_output=True, num_executions=1, wait=0, packed=False):
         """
         Send all commands to chip and retrieve output.
 
         Output is presented first-bit-out (usually row 63) in index 0.
 
+        To have the hardware repeat the commands, or to get the output as
+        packed bits, see `T3MAPSDriver.run`. To look at the output column
+        by column, see `output_by_column`.
+
+        """
+        return self._driver.run(get_output, num_executions, wait, packed)
+
+    def run_async(self, get_output=True, num_executions=1, wait=0):
+        """
+        Send all commands to chip without waiting for the output.
+
+        Returns a `PendingRun` whose `result` method returns the output.
+        See `T3MAPSDriver.run_async`.
+
+        """
+        return self._driver.run_async(get_output, num_executions, wait)
+
+    def flush(self):
         """
-        return self._driver.run(get_output)
+        Wait for any pending run to finish.
+
+        """
+        self._driver.flush()
+
+    def output_by_column(self, output, num_columns=None):
+        """
+        Arrange the output of a readout of whole columns by column.
+
+        Returns a view of `output` (not packed) with shape
+        (batch, column, row), where `num_columns` (by default, all
+        columns) pixel registers were read out per batch, and the last
+        index is the row number (the output starts at row 63).
+
+        """
+        if num_columns is None:
+            num_columns = self.num_columns
+        return output.reshape(-1, num_columns, self.num_rows)[:, :, ::-1]
 
     def pixel_TDAC_matrix(self, binary=False):
         """
@@ -662,82 +1396,106 @@ class T3MAPSChip(object):
 
         """
         if binary:
-            matrix = [[pixel._TDAC_binary for pixel in column] for column in self._pixels]
-        else:
-            matrix = [[pixel.TDAC for pixel in column] for column in self._pixels]
-        return np.array(matrix)
+            return self.pixel_state.TDAC_binary()
+        return self.pixel_state.TDAC.astype(int)
 
     def _import_TDAC_to_pixels(self, TDAC_matrix):
         """
-        Set the `Pixel` objects' TDAC values to match the given values.
+        Set the software pixels' TDAC values to match the given values.
 
         Note: Does not send updates to the actual hardware.
 
         """
-        for i, column in enumerate(self._pixels):
-            for j, pixel in enumerate(column):
-                pixel.TDAC = TDAC_matrix[i][j]
+        self.pixel_state.set_TDAC(TDAC_matrix)
 
-    def save_TDAC_to_file(self, filename):
+    def save_TDAC_to_file(self, filename, dac=None, description=""):
         """
-        Save the pixel TDAC values to a YAML file.
+        Save the pixel TDAC values to a YAML file, or, unless the name
+        ends in .yaml or .yml, to a binary `tdac_map.TDACMap` file.
+
+        The binary format also records the DAC settings `dac` (a dict,
+        e.g. {'vth': 60}) and a `description`.
 
         """
-        matrix = self.pixel_TDAC_matrix()
-        outfile = open(filename, 'w')
-        outfile.write(yaml.dump(matrix.tolist()))
+        TDACMap(self.pixel_state.TDAC, dac, description=description).save(
+            filename)
 
     def import_TDAC(self, filename):
         """
-        Import the pixel TDAC vlues from a YAML file.
+        Import the pixel TDAC vlues from a YAML or binary TDAC map file.
+
+        Note: Does send updates to the actual hardware, unless the map is
+        the one last applied to the chip.
 
-        Note: Does send updates to the actual hardware.
+        Returns the `tdac_map.TDACMap`.
 
         """
-        infile = open(filename, 'r')
-        matrix = yaml.load(infile.read())
-        self._import_TDAC_to_pixels(matrix)
+        tdac_map = TDACMap.load(filename)
+        if self._TDAC_applied(tdac_map.checksum):
+            logging.debug("TDAC map %s is already applied", filename)
+            return tdac_map
+        self._import_TDAC_to_pixels(tdac_map.TDAC)
         self._apply_pixel_TDAC_to_chip()
+        return tdac_map
 
     def _columns_to_update(self):
         """
         Return a set of the columns whose TDAC values need updating.
 
         """
-        pixels = (pixel for column in self._pixels for pixel in column)
-        return set(pix.column for pix in pixels if pix.needs_update)
+        return set(self.pixel_state.dirty_columns().tolist())
 
     def _apply_pixel_TDAC_to_chip(self, run=True):
         """
         Set the pixel TDAC values to those from the software pixels.
 
-        Go 1 column at a time, 1 TDAC bit at a time.
         Only update those columns which have changed since the last update.
+        The bit planes of all these columns are computed at once. TDAC
+        bits with the same bit plane in a column are strobed together,
+        and the commands for all columns are queued before running them
+        (the driver splits them into as few runs as fit the SEQ memory).
+
+        """
+        state = self.pixel_state
+        columns = state.dirty_columns()
+        bits = np.arange(state.TDAC_size)
+        # planes[i, bit, row] is 1 if bit `bit` of the TDAC is set
+        planes = (state.TDAC[columns, np.newaxis, :] >>
+                  bits[:, np.newaxis]) & 1
+        for column, column_planes in zip(columns.tolist(), planes):
+            # group the bits by their plane: {plane: strobe mask}
+            strobe_masks = OrderedDict()
+            for bit, plane in enumerate(column_planes):
+                key = plane.astype(bool).tostring()
+                strobe_masks[key] = strobe_masks.get(key, 0) | (1 << bit)
+            self._write_TDAC_strobes(column, strobe_masks)
+            state.needs_update[column] = False
+        if run and len(columns):
+            self._TDAC_run = (self.run_async(), checksum(state.TDAC))
+
+    def _write_TDAC_strobes(self, column, strobe_masks):
         """
-        matrix = self.pixel_TDAC_matrix(binary=True)
-        for column_index, column in enumerate(matrix):
-            if not column_index in self._columns_to_update():
-                continue
-            #print "Updating column " + str(column_index)
-            num_TDAC_bits = len(column[0])
-            for TDAC_bit_index in range(num_TDAC_bits):  # normally 5
-                latch_args = ('TDAC_strobes', 2**TDAC_bit_index)
-                # find out which pixels get set to 1
-                rows_to_enable = []
-                for row_index, TDAC_value in enumerate(column):
-                    # must reverse TDAC value because place values and
-                    # python indexing are in opposite orders. e.g. the
-                    # 16's place is at index 0 and the 1's place is at
-                    # index 4. When the TDAC value is reversed, the 16's
-                    # place is at index 4 (16 = 2**4), and the 1's place
-                    # is at index 0 (1 = 2**0).
-                    TDAC_value_reversed = TDAC_value[::-1]
-                    if TDAC_value_reversed[TDAC_bit_index] == "1":
-                        rows_to_enable.append(row_index)
-
-                self.set_bit_latches(column_index, rows_to_enable, *latch_args)
-                if run and TDAC_bit_index == num_TDAC_bits-1:
-                    self.run()
+        Queue the commands to strobe TDAC bits of a column.
+
+        `strobe_masks` maps each enable pattern (bool bytes, by row) to
+        the TDAC_strobes value to strobe it into. This is what
+        `set_bit_latches` does for one pattern, except that the global
+        register which turns off a strobe also selects the column for the
+        next one.
+
+        """
+        driver = self._driver
+        driver.set_global_register(column_address=column)
+        driver.write_global_reg()
+        for pattern, mask in strobe_masks.iteritems():
+            enable = np.frombuffer(pattern, dtype=bool)
+            driver.set_pixel_register(enable[::-1].tolist())
+            driver.write_pixel_reg()
+            driver.set_global_register(column_address=column,
+                                       enable_strobes=1, TDAC_strobes=mask)
+            driver.write_global_reg()
+            driver.set_global_register(column_address=column)
+            driver.write_global_reg()
 
 
 if __name__ == "__main__":
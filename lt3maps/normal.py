@@ -0,0 +1,33 @@
+"""
+Module normal.
+
+The standard normal distribution, evaluated for whole arrays at once.
+Used by the chip emulator for hit probabilities and by the S-curve fit.
+
+"""
+import numpy as np
+
+
+def normal_cdf(x):
+    """
+    Evaluate the standard normal cumulative distribution for an array.
+
+    Uses the approximation of the error function from Abramowitz and
+    Stegun (7.1.26), good to 1.5e-7, which needs only array operations.
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    z = np.abs(x) / np.sqrt(2.0)
+    t = 1.0 / (1.0 + 0.3275911 * z)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 +
+           t * (-1.453152027 + t * 1.061405429))))
+    erf = 1.0 - poly * np.exp(-z * z)
+    return 0.5 * (1.0 + np.sign(x) * erf)
+
+
+def normal_pdf(x):
+    """
+    Evaluate the standard normal probability density for an array.
+
+    """
+    return np.exp(-0.5 * np.square(x)) / np.sqrt(2 * np.pi)
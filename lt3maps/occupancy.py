@@ -0,0 +1,182 @@
+"""
+Module occupancy.
+
+Running per-pixel statistics of the hits found by scans.
+
+An `OccupancyAccumulator` is fed the hit bitmap of every scan, with the
+time the chip was integrating, and keeps for each pixel:
+
+- counts: in how many scan cycles the pixel was hit
+- rates: counts divided by the total integration time (Hz)
+- decayed_rates: the hit rate, averaged with an exponential decay of
+  `time_constant` seconds of integration time, for live displays
+- noisy: pixels hit far more often than the typical pixel
+
+For example,
+
+>>> scanner.scan(0.5, 10)
+>>> stats = scanner.accumulator.snapshot()
+>>> stats.rates[3, 12]            # hit rate of pixel (3, 12)
+>>> np.argwhere(stats.noisy)      # (column, row) of the noisy pixels
+
+`snapshot` and `reset` do not copy anything: `add` never changes the
+arrays of a snapshot, it makes new ones. The accumulator can be fed in
+one thread and read in another.
+
+"""
+import threading
+import time
+import numpy as np
+
+
+class OccupancySnapshot(object):
+    """
+    The statistics of an `OccupancyAccumulator` at one moment.
+
+    Do not change the arrays; they are shared with the accumulator.
+
+    """
+
+    def __init__(self, counts, num_cycles, exposure, decayed_rates,
+                 last_time, noise_sigma):
+        self.counts = counts
+        self.num_cycles = num_cycles
+        self.exposure = exposure
+        self.decayed_rates = decayed_rates
+        self.last_time = last_time
+        self.noise_sigma = noise_sigma
+
+    @property
+    def occupancy(self):
+        """
+        The fraction of scan cycles each pixel was hit in.
+
+        """
+        if self.num_cycles == 0:
+            return np.zeros(self.counts.shape)
+        return self.counts / float(self.num_cycles)
+
+    @property
+    def rates(self):
+        """
+        The hit rate of each pixel in Hz, over all integration time.
+
+        """
+        if self.exposure <= 0:
+            return np.zeros(self.counts.shape)
+        return self.counts / self.exposure
+
+    @property
+    def noise_limit(self):
+        """
+        The count above which a pixel is noisy.
+
+        The typical pixel is hit median(counts) times. If hits are
+        Poisson distributed, a pixel with more than `noise_sigma`
+        standard deviations above that is unlikely to be a normal pixel.
+
+        """
+        expected = np.median(self.counts) if self.counts.size else 0
+        return expected + self.noise_sigma * np.sqrt(max(expected, 1))
+
+    @property
+    def noisy(self):
+        """
+        A boolean array of the pixels hit more than `noise_limit` times.
+
+        """
+        return self.counts > self.noise_limit
+
+
+class OccupancyAccumulator(object):
+    """
+    Accumulate per-pixel hit counts and rates over many scans.
+
+    Arrays are indexed by (column, row). See `OccupancySnapshot` for
+    the statistics.
+
+    """
+
+    def __init__(self, num_columns=18, num_rows=64, time_constant=10.0,
+                 noise_sigma=5.0):
+        self.num_columns = num_columns
+        self.num_rows = num_rows
+        self.time_constant = time_constant
+        self.noise_sigma = noise_sigma
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all hits.
+
+        """
+        shape = (self.num_columns, self.num_rows)
+        with self._lock:
+            self._snapshot = OccupancySnapshot(np.zeros(shape, dtype=np.int64),
+                                               0, 0.0, np.zeros(shape), None,
+                                               self.noise_sigma)
+
+    def add(self, hits, exposure, num_cycles=None, timestamp=None):
+        """
+        Add the hits of some scan cycles.
+
+        `hits` is either an occupancy bitmap indexed by (cycle, column,
+        row) or by (column, row) for a single cycle, or a list, by
+        column, of the rows hit in a single cycle. `exposure` is the
+        total integration time of the cycles in seconds. `num_cycles`
+        can be given to add hit counts, indexed by (column, row), summed
+        over that many cycles.
+
+        """
+        if isinstance(hits, np.ndarray) and hits.ndim == 3:
+            counts = hits.sum(axis=0)
+            num_cycles = len(hits)
+        elif isinstance(hits, np.ndarray) and hits.ndim == 2:
+            counts = hits.astype(np.int64)
+            num_cycles = 1 if num_cycles is None else num_cycles
+        else:
+            counts = np.zeros((self.num_columns, self.num_rows), np.int64)
+            for column, rows in enumerate(hits):
+                counts[column, list(rows)] = 1
+            num_cycles = 1
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            old = self._snapshot
+            decayed_rates = old.decayed_rates
+            if exposure > 0:
+                weight = np.exp(-exposure / self.time_constant)
+                decayed_rates = (decayed_rates * weight +
+                                 counts * ((1 - weight) / exposure))
+            self._snapshot = OccupancySnapshot(old.counts + counts,
+                                               old.num_cycles + num_cycles,
+                                               old.exposure + max(exposure, 0),
+                                               decayed_rates, timestamp,
+                                               self.noise_sigma)
+
+    def snapshot(self):
+        """
+        Return the statistics so far, as an `OccupancySnapshot`.
+
+        """
+        return self._snapshot
+
+    @property
+    def counts(self):
+        return self._snapshot.counts
+
+    @property
+    def num_cycles(self):
+        return self._snapshot.num_cycles
+
+    @property
+    def rates(self):
+        return self._snapshot.rates
+
+    @property
+    def decayed_rates(self):
+        return self._snapshot.decayed_rates
+
+    @property
+    def noisy(self):
+        return self._snapshot.noisy
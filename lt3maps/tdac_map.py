@@ -0,0 +1,138 @@
+"""
+Module tdac_map.
+
+Storage for the TDAC values of all pixels of a chip.
+
+A binary TDAC map file is a 128-byte header followed by the TDAC
+values, one byte per pixel, column by column (18 x 64 = 1152 bytes for
+a T3MAPS chip). The header holds:
+
+- magic: "T3MTDAC\\0"
+- version, num_columns, num_rows (uint16)
+- checksum: CRC-32 of the TDAC values (uint32)
+- created: when the map was made (float64, from time.time())
+- the DAC settings the map was made with (uint16 each, see
+  `DAC_FIELDS`; 0xffff if unknown)
+- description: where the map came from (64 bytes of text)
+
+All numbers are little endian. Maps can also be read from and written
+to YAML, as a list of columns of TDAC values, which is the format
+`T3MAPSChip.save_TDAC_to_file` has always used.
+
+"""
+import time
+import zlib
+import numpy as np
+import yaml
+
+MAGIC = "T3MTDAC\0"
+VERSION = 1
+
+DAC_FIELDS = ('vth', 'VbpThStep', 'PrmpVbp', 'PrmpVbf', 'DisVbn',
+              'PrmpVbnFol')
+"""
+The DAC settings stored in the header of a TDAC map.
+
+"""
+UNKNOWN_DAC = 0xffff
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u2'),
+    ('num_columns', '<u2'),
+    ('num_rows', '<u2'),
+    ('reserved_0', 'V2'),
+    ('checksum', '<u4'),
+    ('reserved_1', 'V4'),
+    ('created', '<f8'),
+    ('dac', '<u2', (len(DAC_FIELDS),)),
+    ('reserved_2', 'V20'),
+    ('description', 'S64'),
+])
+"""
+The layout of the file header.
+
+"""
+
+
+def checksum(TDAC):
+    """
+    Return the CRC-32 of a TDAC matrix, as stored in a TDAC map.
+
+    """
+    return zlib.crc32(np.ascontiguousarray(TDAC, dtype=np.uint8)
+                      .tostring()) & 0xffffffff
+
+
+class TDACMap(object):
+    """
+    The TDAC values of every pixel, with the settings they go with.
+
+    `TDAC` is a uint8 array indexed by (column, row), `dac` a dict of
+    DAC settings (any of `DAC_FIELDS`), `created` a time stamp and
+    `description` a short text.
+
+    """
+
+    def __init__(self, TDAC, dac=None, created=None, description=""):
+        self.TDAC = np.array(TDAC, dtype=np.uint8)
+        self.dac = dict(dac or {})
+        self.created = time.time() if created is None else created
+        self.description = description
+
+    @property
+    def checksum(self):
+        return checksum(self.TDAC)
+
+    def save(self, filename):
+        """
+        Write the map to a file, as YAML if the name ends in .yaml or
+        .yml, or in the binary format otherwise.
+
+        """
+        if filename.endswith(('.yaml', '.yml')):
+            with open(filename, 'w') as outfile:
+                outfile.write(yaml.dump(self.TDAC.tolist()))
+            return
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['num_columns'], header['num_rows'] = self.TDAC.shape
+        header['checksum'] = self.checksum
+        header['created'] = self.created
+        header['dac'] = [self.dac.get(field, UNKNOWN_DAC)
+                         for field in DAC_FIELDS]
+        header['description'] = self.description[:64]
+        with open(filename, 'wb') as outfile:
+            outfile.write(header.tostring())
+            outfile.write(self.TDAC.tostring())
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a map from a binary or YAML file.
+
+        Raises ValueError if a binary map is damaged.
+
+        """
+        with open(filename, 'rb') as infile:
+            data = infile.read()
+        if not data.startswith(MAGIC):
+            return cls(yaml.load(data, Loader=yaml.SafeLoader))
+
+        header = np.fromstring(data[:HEADER_DTYPE.itemsize],
+                               dtype=HEADER_DTYPE)
+        if len(header) != 1 or header['version'][0] != VERSION:
+            raise ValueError("%s is not a version %i TDAC map" %
+                             (filename, VERSION))
+        shape = (int(header['num_columns'][0]), int(header['num_rows'][0]))
+        TDAC = np.fromstring(data[HEADER_DTYPE.itemsize:], dtype=np.uint8)
+        if TDAC.size != shape[0] * shape[1]:
+            raise ValueError("%s is truncated" % filename)
+        TDAC = TDAC.reshape(shape)
+        if checksum(TDAC) != header['checksum'][0]:
+            raise ValueError("%s has a bad checksum" % filename)
+        dac = dict((field, int(value)) for field, value in
+                   zip(DAC_FIELDS, header['dac'][0]) if value != UNKNOWN_DAC)
+        return cls(TDAC, dac, float(header['created'][0]),
+                   header['description'][0])
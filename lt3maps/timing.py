@@ -0,0 +1,157 @@
+"""
+Module timing.
+
+Low-overhead latency bookkeeping for T3MAPSDriver.
+
+Every T3MAPSDriver has a `stats` attribute holding a `RunStats` object.
+The driver adds one sample per phase of each command and run:
+
+- build: creating a block in `write_global_reg`, `write_pixel_reg` or
+  `write_injection`
+- transcribe: assembling the blocks into the SEQ image
+- transfer: writing the SEQ image to the sequencer and starting it
+- wait: waiting for the sequencer to finish
+- fifo_read: reading the SRAM FIFO
+- decode: turning the FIFO words into bits
+- run: the whole of `T3MAPSDriver.run`
+
+For example,
+
+>>> driver.stats.reset()
+>>> scanner.scan(0, 10)
+>>> print driver.stats.summary()
+
+"""
+import numpy as np
+
+
+class PhaseStats(object):
+    """
+    Accumulated timings and data volume of one phase.
+
+    Durations are in seconds. If `bin_edges` is given, a histogram of the
+    durations is kept in `histogram`, with `histogram[i]` counting the
+    samples between `bin_edges[i-1]` and `bin_edges[i]` (the first and
+    last bins collect everything below and above the edges).
+
+    """
+
+    def __init__(self, name, bin_edges=None):
+        self.name = name
+        self.bin_edges = bin_edges
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.bits = 0
+        self.bytes = 0
+        self.histogram = None
+        if self.bin_edges is not None:
+            self.histogram = np.zeros(len(self.bin_edges) + 1, dtype=np.int64)
+
+    def add(self, duration, bits=0, num_bytes=0):
+        """
+        Record one sample.
+
+        """
+        self.count += 1
+        self.total += duration
+        if duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+        self.bits += bits
+        self.bytes += num_bytes
+        if self.histogram is not None:
+            self.histogram[np.searchsorted(self.bin_edges, duration)] += 1
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def as_dict(self):
+        """
+        Return the statistics as a dict of plain Python values.
+
+        """
+        result = {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'bits': self.bits,
+            'bytes': self.bytes,
+        }
+        if self.histogram is not None:
+            result['bin_edges'] = self.bin_edges.tolist()
+            result['histogram'] = self.histogram.tolist()
+        return result
+
+
+class RunStats(object):
+    """
+    Timings of all phases of T3MAPSDriver runs.
+
+    If `histograms` is True, each phase also keeps a histogram of its
+    durations over logarithmic bins from 1 us to 100 s (or over
+    `bin_edges`, if given).
+
+    """
+
+    phases = ('build', 'transcribe', 'transfer', 'wait', 'fifo_read',
+              'decode', 'run')
+    """
+    The phases recorded by T3MAPSDriver, in execution order.
+
+    """
+
+    def __init__(self, histograms=False, bin_edges=None):
+        if histograms and bin_edges is None:
+            bin_edges = np.logspace(-6, 2, 81)
+        self._phases = {}
+        for name in self.phases:
+            self._phases[name] = PhaseStats(name, bin_edges)
+
+    def __getitem__(self, name):
+        return self._phases[name]
+
+    def add(self, name, duration, bits=0, num_bytes=0):
+        """
+        Record one sample for the phase `name`.
+
+        """
+        self._phases[name].add(duration, bits, num_bytes)
+
+    def reset(self):
+        for phase in self._phases.itervalues():
+            phase.reset()
+
+    def as_dict(self):
+        """
+        Return a dict mapping each phase name to its statistics.
+
+        """
+        return dict((name, phase.as_dict()) for name, phase in
+                    self._phases.iteritems())
+
+    def summary(self):
+        """
+        Return a table of the statistics as a string.
+
+        """
+        lines = ["%-10s %8s %10s %10s %10s %10s %10s" %
+                 ("phase", "count", "total ms", "mean us", "max us",
+                  "bits", "bytes")]
+        for name in self.phases:
+            phase = self._phases[name]
+            lines.append("%-10s %8i %10.2f %10.1f %10.1f %10i %10i" %
+                         (name, phase.count, 1e3 * phase.total,
+                          1e6 * phase.mean, 1e6 * phase.max, phase.bits,
+                          phase.bytes))
+        return "\n".join(lines)
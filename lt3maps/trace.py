@@ -0,0 +1,230 @@
+"""
+Module trace.
+
+Count the transactions between the host and the board.
+
+Every call of a hardware driver (e.g. `SEQ_GEN.set_size`, `DATA.get_data`)
+and every read or write of a transfer layer (e.g. SiTcp) of a
+T3MAPSDriver can be recorded by a `TransactionTracer`, together with its
+duration, the number of bytes moved and the high-level operation it was
+made for. Operations are named by the methods given to `trace_methods`
+(by default the main methods of `Scanner` and `T3MAPSChip`), or with
+the `operation` context manager. Nested operations are recorded as a
+path, e.g. "scan/run_async".
+
+For example,
+
+>>> tracer = TransactionTracer(scanner.chip._driver)
+>>> tracer.trace_methods(scanner)
+>>> tracer.trace_methods(scanner.chip)
+>>> with tracer:
+...     scanner.scan(0, 10)
+>>> print tracer.summary()
+>>> tracer.save("trace.txt")
+
+Tracing is off until `start` is called (or the `with` block entered),
+and `stop` removes every wrapper again.
+
+"""
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
+
+Transaction = namedtuple('Transaction', ['time', 'operation', 'layer',
+                                         'module', 'method', 'num_bytes',
+                                         'duration'])
+"""
+One recorded call. `layer` is 'HL' for hardware drivers and 'TL' for
+transfer layers, `module` the name of the driver or interface in the
+configuration file, and `operation` the path of high-level operations
+it was made in (empty if there was none).
+
+"""
+
+DEFAULT_OPERATIONS = ('scan', 'set_all_TDACs', 'initialize_all_latches',
+                      'import_TDAC', '_apply_pixel_TDAC_to_chip',
+                      'set_bit_latches', 'run', 'run_async', 'flush')
+"""
+The methods which `trace_methods` names operations after by default,
+where the object has them.
+
+"""
+
+_NOT_TRACED = frozenset(['init', 'close', 'get_configuration',
+                         'set_configuration', 'add_property'])
+
+
+class TransactionTracer(object):
+    """
+    Record the hardware driver calls and transfer layer transactions of
+    a T3MAPSDriver.
+
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.transactions = []
+        self._stack = []
+        # hardware driver calls in progress
+        self._driver_calls = 0
+        self._wrapped = []
+        self._methods = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @contextmanager
+    def operation(self, name):
+        """
+        Attribute the transactions made in a `with` block to `name`.
+
+        """
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+
+    def trace_methods(self, obj, names=DEFAULT_OPERATIONS):
+        """
+        Name the operations after these methods of `obj`, while tracing.
+
+        """
+        methods = [(obj, name) for name in names if hasattr(obj, name)]
+        self._methods.extend(methods)
+        if self._wrapped:
+            self._wrap_operations(methods)
+
+    def reset(self):
+        self.transactions = []
+
+    def start(self):
+        """
+        Start recording.
+
+        """
+        if self._wrapped:
+            return
+        for module_name, module in self.driver._hardware_layer.iteritems():
+            self._wrap_module(module, 'HL', module_name)
+        for module_name, module in self.driver._transfer_layer.iteritems():
+            self._wrap_module(module, 'TL', module_name)
+        self._wrap_operations(self._methods)
+
+    def stop(self):
+        """
+        Stop recording and remove the wrappers.
+
+        """
+        for obj, name in self._wrapped:
+            try:
+                delattr(obj, name)
+            except AttributeError:
+                pass
+        self._wrapped = []
+
+    def _wrap(self, obj, name, wrapper):
+        setattr(obj, name, wrapper)
+        self._wrapped.append((obj, name))
+
+    def _wrap_module(self, module, layer, module_name):
+        for name, _ in inspect.getmembers(type(module), inspect.ismethod):
+            if name.startswith('_') or name in _NOT_TRACED:
+                continue
+            if name in vars(module):
+                # already wrapped
+                continue
+            method = getattr(module, name)
+            self._wrap(module, name,
+                       self._transaction_wrapper(method, layer, module_name,
+                                                 name))
+
+    def _wrap_operations(self, methods):
+        for obj, name in methods:
+            if name in vars(obj):
+                continue
+            self._wrap(obj, name,
+                       self._operation_wrapper(getattr(obj, name), name))
+
+    def _operation_wrapper(self, method, name):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with self.operation(name):
+                return method(*args, **kwargs)
+        return wrapper
+
+    def _transaction_wrapper(self, method, layer, module_name, name):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if layer == 'HL' and self._driver_calls:
+                # a driver calling its own methods: count the outer call
+                return method(*args, **kwargs)
+            start = time.time()
+            if layer == 'HL':
+                self._driver_calls += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                duration = time.time() - start
+                if layer == 'HL':
+                    self._driver_calls -= 1
+                if layer == 'TL' and name == 'read' and len(args) > 1:
+                    num_bytes = args[1]
+                elif layer == 'TL' and name == 'write' and len(args) > 1:
+                    num_bytes = len(args[1])
+                else:
+                    num_bytes = 0
+                self.transactions.append(Transaction(
+                    start, "/".join(self._stack), layer, module_name, name,
+                    num_bytes, duration))
+        return wrapper
+
+    def totals(self, layer=None):
+        """
+        Return the number of calls, bytes and total time, by (outermost
+        operation, layer, module, method).
+
+        """
+        totals = OrderedDict()
+        for transaction in self.transactions:
+            if layer is not None and transaction.layer != layer:
+                continue
+            key = (transaction.operation.split("/")[0], transaction.layer,
+                   transaction.module, transaction.method)
+            count, num_bytes, duration = totals.get(key, (0, 0, 0.0))
+            totals[key] = (count + 1, num_bytes + transaction.num_bytes,
+                           duration + transaction.duration)
+        return totals
+
+    def summary(self):
+        """
+        Return a table of the calls, by operation, as a string.
+
+        """
+        lines = ["%-24s %-2s %-10s %-18s %7s %10s %10s" %
+                 ("operation", "", "module", "method", "calls", "bytes",
+                  "total ms")]
+        for key, (count, num_bytes, duration) in sorted(
+                self.totals().iteritems()):
+            operation, layer, module, method = key
+            lines.append("%-24s %-2s %-10s %-18s %7i %10i %10.2f" %
+                         (operation or "-", layer, module, method, count,
+                          num_bytes, 1e3 * duration))
+        return "\n".join(lines)
+
+    def save(self, filename):
+        """
+        Write every transaction to a tab-separated text file.
+
+        """
+        with open(filename, 'w') as outfile:
+            outfile.write("\t".join(Transaction._fields) + "\n")
+            for transaction in self.transactions:
+                outfile.write("%.6f\t%s\t%s\t%s\t%s\t%i\t%.9f\n" %
+                              transaction)
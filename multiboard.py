@@ -0,0 +1,334 @@
+"""
+Run several boards at once.
+
+Each board is driven by its own worker process, with its own
+`Scanner` (and so its own T3MAPSDriver), built from the board's
+configuration file, e.g. a copy of lt3maps/lt3maps.yaml with the board's
+SiTcp address. A `MultiBoard` sends the same command to every worker
+and collects the results, keyed by device ID. Since the boards work in
+parallel, a command takes about as long for many boards as for one.
+
+Scans on all boards start integrating at the same time: the command
+carries a start time, a little in the future, which every worker waits
+for once its board is configured for the scan.
+
+For example,
+
+>>> with MultiBoard({'A': "board_a.yaml", 'B': "board_b.yaml"}) as boards:
+...     boards.upload_TDAC({'A': "tdac_a.tdac", 'B': "tdac_b.tdac"})
+...     results = boards.scan(0.5, 10, 60)
+>>> results['A'].hit_store.pixel_counts()
+
+"""
+import scan_inject as scan
+from lt3maps.tdac_map import checksum
+from collections import namedtuple
+import argparse
+import logging
+import multiprocessing
+import Queue
+import time
+import traceback
+
+BoardScan = namedtuple('BoardScan', ['device_id', 'start_time', 'end_time',
+                                     'hit_store'])
+"""
+The result of a scan on one board.
+
+"""
+
+
+def _scan(scanner, device_id, sleep, cycles, global_threshold=150,
+          hardware_repeat=False, start_at=None):
+    scanner.reset()
+    start_time, end_time = scanner.scan(sleep, cycles, global_threshold,
+                                        hardware_repeat, start_at)
+    return BoardScan(device_id, start_time, end_time, scanner.hit_store)
+
+
+def _tune(scanner, device_id, method='binary', results_file=None):
+    import tune
+    tuner = tune.Tuner(view=False, method=method, scanner=scanner)
+    tuner.results_file = results_file or "tune_results_%s" % device_id
+    tuner.tune()
+    return scanner.chip.pixel_TDAC_matrix()
+
+
+def _upload_TDAC(scanner, device_id, TDAC):
+    chip = scanner.chip
+    if isinstance(TDAC, basestring):
+        chip.import_TDAC(TDAC)
+    else:
+        # a TDACMap or a matrix
+        TDAC = getattr(TDAC, 'TDAC', TDAC)
+        if not chip._TDAC_applied(checksum(TDAC)):
+            chip._import_TDAC_to_pixels(TDAC)
+            chip._apply_pixel_TDAC_to_chip()
+    chip.flush()
+    return chip._applied_TDAC_checksum
+
+
+def _set_all_TDACs(scanner, device_id, value):
+    scanner.set_all_TDACs(value)
+    scanner.chip.flush()
+
+
+COMMANDS = {
+    'scan': _scan,
+    'tune': _tune,
+    'upload_TDAC': _upload_TDAC,
+    'set_all_TDACs': _set_all_TDACs,
+}
+"""
+What a worker can do, by command name. Each function is called with the
+worker's scanner, its device ID and the arguments of the command.
+Synchronised commands also get their start time as `start_at`, to wait
+for just before the part which has to line up across boards.
+
+"""
+
+
+def _worker(device_id, config_file, emulate, commands, results):
+    """
+    Serve commands for one board until None is received.
+
+    Every command is a (name, start time, args, kwargs) tuple. Every
+    result is sent back as a (device ID, ok, value) tuple, where value
+    is the exception and its formatted traceback if ok is False.
+
+    """
+    try:
+        scanner = scan.Scanner(config_file, emulate=emulate)
+    except Exception as e:
+        results.put((device_id, False, (e, traceback.format_exc())))
+        return
+    results.put((device_id, True, None))
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        name, start_at, args, kwargs = command
+        if start_at is not None:
+            kwargs = dict(kwargs, start_at=start_at)
+        try:
+            value = COMMANDS[name](scanner, device_id, *args, **kwargs)
+        except Exception as e:
+            results.put((device_id, False, (e, traceback.format_exc())))
+        else:
+            results.put((device_id, True, value))
+
+
+class MultiBoard(object):
+    """
+    Drive several boards in parallel, one worker process per board.
+
+    `boards` maps each device ID to the configuration file of its board
+    (a list of files is numbered from 0). `emulate` is passed on to
+    every `Scanner`.
+
+    """
+
+    start_delay = 0.5
+    """
+    How far in the future (in s) synchronised commands are started, so
+    that every worker has received the command and configured its board
+    by then.
+
+    """
+
+    poll_interval = 1.0
+    """
+    How often (in s) to check that the workers are still alive while
+    waiting for their results.
+
+    """
+
+    stop_timeout = 10.0
+    """
+    How long (in s) `stop` waits for the workers to finish their
+    current command before terminating them.
+
+    """
+
+    def __init__(self, boards, emulate=False):
+        if not isinstance(boards, dict):
+            boards = dict(enumerate(boards))
+        self.boards = boards
+        self.emulate = emulate
+        self._workers = {}
+        self._commands = {}
+        self._results = None
+
+    def start(self):
+        """
+        Start the workers and wait until every board is set up.
+
+        """
+        self._results = multiprocessing.Queue()
+        for device_id, config_file in self.boards.iteritems():
+            commands = multiprocessing.Queue()
+            worker = multiprocessing.Process(
+                target=_worker, name="board %s" % (device_id,),
+                args=(device_id, config_file, self.emulate, commands,
+                      self._results))
+            worker.daemon = True
+            worker.start()
+            self._workers[device_id] = worker
+            self._commands[device_id] = commands
+        try:
+            self._collect(self.boards.keys())
+        except:
+            self.stop()
+            raise
+
+    def stop(self):
+        """
+        Stop the workers after their current command.
+
+        Workers which are still busy after `stop_timeout` seconds are
+        terminated.
+
+        """
+        for commands in self._commands.values():
+            commands.put(None)
+        deadline = time.time() + self.stop_timeout
+        for device_id, worker in self._workers.iteritems():
+            worker.join(max(deadline - time.time(), 0))
+            if worker.is_alive():
+                logging.error("board %s: worker did not stop, terminating it",
+                              device_id)
+                worker.terminate()
+                worker.join()
+        self._workers = {}
+        self._commands = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _collect(self, device_ids):
+        """
+        Wait for a result from each of the given boards.
+
+        If a board failed, or its worker died without a result, an
+        exception is raised once all boards are done.
+
+        """
+        values = {}
+        error = None
+        missing = set(device_ids)
+        while missing:
+            try:
+                device_id, ok, value = self._results.get(
+                    timeout=self.poll_interval)
+            except Queue.Empty:
+                for device_id in list(missing):
+                    worker = self._workers[device_id]
+                    if not worker.is_alive():
+                        missing.discard(device_id)
+                        logging.error("board %s: worker died (exit code %s)",
+                                      device_id, worker.exitcode)
+                        error = error or RuntimeError(
+                            "the worker of board %s died (exit code %s)" %
+                            (device_id, worker.exitcode))
+                continue
+            missing.discard(device_id)
+            if ok:
+                values[device_id] = value
+            else:
+                exception, text = value
+                logging.error("board %s failed:\n%s", device_id, text)
+                error = error or exception
+        if error is not None:
+            raise error
+        return values
+
+    def call(self, name, args=(), kwargs=None, args_by_device=None,
+             synchronise=False, device_ids=None):
+        """
+        Run a command (see `COMMANDS`) on the boards and return the
+        results by device ID.
+
+        The command runs on every board, or on those in `device_ids`,
+        with `args` and `kwargs`, or, for boards in `args_by_device`,
+        with the arguments given there instead. If `synchronise` is
+        True, all boards start at the same time.
+
+        """
+        if not self._workers:
+            raise ValueError("the boards have not been started")
+        if device_ids is None:
+            device_ids = self._commands.keys()
+        start_at = None
+        if synchronise:
+            start_at = time.time() + self.start_delay
+        args_by_device = args_by_device or {}
+        for device_id in device_ids:
+            device_args = args_by_device.get(device_id, args)
+            self._commands[device_id].put((name, start_at, tuple(device_args),
+                                           kwargs or {}))
+        return self._collect(device_ids)
+
+    def scan(self, sleep, cycles, global_threshold=150,
+             hardware_repeat=False):
+        """
+        Scan on all boards at once. See `Scanner.scan`.
+
+        Returns a `BoardScan` for each device ID.
+
+        """
+        return self.call('scan', (sleep, cycles, global_threshold,
+                                  hardware_repeat), synchronise=True)
+
+    def tune(self, method='binary'):
+        """
+        Tune all boards. Each board's results are saved to
+        tune_results_<device ID>.yaml and .tdac.
+
+        Returns the TDAC matrix of each device ID.
+
+        """
+        return self.call('tune', (method,))
+
+    def upload_TDAC(self, TDAC_maps):
+        """
+        Apply a TDAC map to each board.
+
+        `TDAC_maps` maps device IDs to a TDAC map file, a
+        `lt3maps.tdac_map.TDACMap` or a TDAC matrix. Boards which are not
+        listed are left alone. Returns the checksum of each board's map.
+
+        """
+        args_by_device = dict((device_id, (TDAC,)) for device_id, TDAC
+                              in TDAC_maps.iteritems())
+        return self.call('upload_TDAC', args_by_device=args_by_device,
+                         device_ids=TDAC_maps.keys())
+
+    def set_all_TDACs(self, value):
+        self.call('set_all_TDACs', (value,))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_files", nargs="+",
+                        help="one board configuration file per board")
+    parser.add_argument("--sleep", type=float, default=0.5)
+    parser.add_argument("--cycles", type=int, default=1)
+    parser.add_argument("--threshold", type=int, default=150)
+    parser.add_argument("--tune", choices=["linear", "binary"], default=None,
+                        help="tune every board first")
+    parser.add_argument("--emulate", action="store_true")
+    args = parser.parse_args()
+
+    with MultiBoard(args.config_files, emulate=args.emulate) as boards:
+        if args.tune:
+            boards.tune(args.tune)
+        results = boards.scan(args.sleep, args.cycles, args.threshold)
+    for device_id, result in sorted(results.iteritems()):
+        print "board %s (%s): %i hits, started %.3f" % (
+            device_id, args.config_files[device_id],
+            result.hit_store.num_hits(), result.start_time)
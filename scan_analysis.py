@@ -1,4 +1,6 @@
 import scan_inject as scan
+from lt3maps.history import HistoryWriter
+from lt3maps.occupancy import OccupancyAccumulator
 import logging
 import numpy as np
 import pprint
@@ -8,11 +10,23 @@ import random
 import curses
 import functools
 import argparse
+import threading
+import Queue
+import sys
 # Unicode support for curses
 import locale
 locale.setlocale(locale.LC_ALL, '')
 code = locale.getpreferredencoding()
 
+# symbols for 0 (no hit) up to full occupancy, encoded once
+try:
+    SYMBOLS = np.array([symbol.encode(code) for symbol in
+                        (u" ", u"\u2591", u"\u2592", u"\u2593", u"\u2588")],
+                       dtype=object)
+except UnicodeEncodeError:
+    SYMBOLS = np.array([" ", ".", ":", "*", "#"], dtype=object)
+BINARY_SYMBOLS = SYMBOLS[[0, -1]]
+
 class ScanFunctionReturn(object):
     """
     Manage return values from the scan function.
@@ -25,16 +39,133 @@ class ScanFunctionReturn(object):
         self.column_hits = column_hits
         self.keep_going = keep_going
 
+def heatmap_levels(counts, num_levels=len(SYMBOLS)):
+    """
+    Map hit counts to levels 0 to num_levels - 1.
+
+    Pixels without hits are level 0, the most hit pixels the top level,
+    and every pixel with hits at least level 1.
+
+    """
+    counts = np.asarray(counts)
+    top = counts.max() if counts.size else 0
+    if top <= 0:
+        return np.zeros(counts.shape, dtype=int)
+    levels = np.ceil(counts * (num_levels - 1) / float(top))
+    return np.clip(levels, 0, num_levels - 1).astype(int)
+
+class ChipRenderer(object):
+    """
+    Draw a (column, row) array of symbol levels on a curses window.
+
+    The last frame drawn is kept, and only the part of each line that
+    changed is written again. The screen is updated at most `max_rate`
+    times per second: `show` only stores a frame, and `update` draws the
+    latest stored frame when it is time to.
+
+    """
+
+    def __init__(self, window, y_offset, x_offset, symbols=SYMBOLS,
+                 max_rate=10):
+        self.window = window
+        self.y_offset = y_offset
+        self.x_offset = x_offset
+        self.symbols = symbols
+        self.max_rate = max_rate
+        self.cells_written = 0
+        self._previous = None
+        self._pending = None
+        self._last_update = 0
+
+    def show(self, levels):
+        self._pending = np.asarray(levels, dtype=int)
+
+    def clear(self):
+        """
+        Forget the last frame, so the next one is drawn in full.
+
+        """
+        self._previous = None
+
+    def update(self, now=None):
+        """
+        Draw the latest frame if one is waiting and it is time to.
+
+        Returns True if the screen was updated.
+
+        """
+        now = time.time() if now is None else now
+        if (self._pending is None or
+                now - self._last_update < 1.0 / self.max_rate):
+            return False
+        levels = self._pending
+        self._pending = None
+        if self._previous is None or self._previous.shape != levels.shape:
+            changed = np.ones(levels.shape, dtype=bool)
+        else:
+            changed = levels != self._previous
+        for line in np.flatnonzero(changed.any(axis=1)):
+            columns = np.flatnonzero(changed[line])
+            first, last = columns[0], columns[-1] + 1
+            self.window.addstr(line + self.y_offset, first + self.x_offset,
+                               "".join(self.symbols[levels[line,
+                                                           first:last]]))
+            self.cells_written += last - first
+        self.window.refresh()
+        self._previous = levels
+        self._last_update = now
+        return True
+
 class ChipViewer(object):
     """
     A curses application for real-time data from a chip.
 
+    Scans run in a thread of their own and are handed to the display
+    through a queue of `queue_size` frames. The display is redrawn at
+    most `frame_rate` times per second. If it falls behind, the oldest
+    frames are dropped (see `dropped_frames`), so that neither side ever
+    waits for the other.
+
+    Every scan is added to `accumulator`, a
+    `lt3maps.occupancy.OccupancyAccumulator`, in the acquisition thread.
+    Persistence shows the pixels it has counted, and with `heatmap`,
+    each pixel is shaded by its count. If an `accumulator` is given,
+    such as a `Scanner`'s, the scan function is expected to feed it, and
+    the viewer only reads from it.
+
     """
     
-    def __init__(self):
-        self.persistence_history = np.zeros((18,64))
+    frame_rate = 10
+    queue_size = 4
+
+    def __init__(self, accumulator=None):
+        self._add_scans = accumulator is None
+        if accumulator is None:
+            accumulator = OccupancyAccumulator(scan.T3MAPSChip.num_columns,
+                                               scan.T3MAPSChip.num_rows)
+        self.accumulator = accumulator
+        # the counts when the persistence was last cleared
+        self._cleared_counts = 0
         self.event_history = []
         self.history_file = None
+        # scans are also appended to this lt3maps.history file, if set
+        self.binary_history_file = None
+        self.dropped_frames = 0
+        self._last_frame = None
+        self._acquisition_error = None
+
+    @property
+    def counts(self):
+        """
+        The hits of each pixel since the start, or since the
+        persistence was last cleared.
+
+        """
+        return np.maximum(self.accumulator.counts - self._cleared_counts, 0)
+
+    @property
+    def persistence_history(self):
+        return (self.counts > 0).astype(int)
 
     def _save_history(self):
         if self.history_file is not None:
@@ -60,16 +191,7 @@ class ChipViewer(object):
 
     @staticmethod
     def _present_array(array):
-        symbols = {
-            0: u" ",
-            1: u"\u2588",
-        }
-        symbols = {key: value.encode(code) for key, value in symbols.iteritems()}
-        result = ""
-
-        for number in array:
-            result += symbols[number]
-        return result
+        return "".join(BINARY_SYMBOLS[np.asarray(array, dtype=int)])
 
     @staticmethod
     def _get_offset(height, width):
@@ -88,14 +210,10 @@ class ChipViewer(object):
         scanner.chip.import_TDAC("tune_results.yaml")
         start_time, end_time = scanner.scan(0.5, 1, 60)
         # make a matrix of pixel hits
-        for i in range(len(scanner.hits[0]['data'])):
-            col_hits.append(scanner.hits[0]['data'][i]['hit_rows'])
-        num_hits = 0
-        for index, column in enumerate(col_hits):
-            for row in column:
-                pixel = scanner.chip._pixels[index][row]
-                num_hits += 1
-        logging.debug("%i hits", num_hits)
+        store = scanner.hit_store
+        for i in range(store.num_columns):
+            col_hits.append(store.column_hits(0, i).tolist())
+        logging.debug("%i hits", store.num_hits(0))
         return ScanFunctionReturn(start_time, end_time, col_hits, True)
 
     @staticmethod
@@ -107,42 +225,133 @@ class ChipViewer(object):
         return ScanFunctionReturn(time.time(), time.time(), col_hits, True)
 
 
-    def _get_application(self, scan_function, persistence):
+    def _occupancy(self, column_hits):
+        """
+        Return a (column, row) bitmap of the hits in a scan.
+
+        """
+        occupancy = np.zeros(self.accumulator.counts.shape, dtype=bool)
+        for i, col_hit in enumerate(column_hits):
+            occupancy[i, col_hit] = True
+        return occupancy
+
+    def _push_frame(self, frames, frame):
+        """
+        Queue a frame for display without ever waiting.
+
+        If the queue is full, the oldest frame is dropped.
+
+        """
+        while True:
+            try:
+                frames.put_nowait(frame)
+                return
+            except Queue.Full:
+                pass
+            try:
+                frames.get_nowait()
+            except Queue.Empty:
+                continue
+            self.dropped_frames += 1
+
+    def _acquire(self, scan_function, frames, stop):
+        """
+        Run scans until `stop` is set or the scan function says so.
+
+        Each scan is added to the history and the accumulator, and
+        queued for display as a (scan results, hits) tuple. None is
+        queued at the end.
+
+        """
+        writer = None
+        try:
+            if self.binary_history_file is not None:
+                writer = HistoryWriter(self.binary_history_file)
+            keep_going = True
+            while keep_going and not stop.is_set():
+                # run the scan
+                scan_results = scan_function()
+                self.event_history.append(scan_results)
+                if writer is not None:
+                    writer.append(scan_results.start_timestamp,
+                                  scan_results.end_timestamp,
+                                  scan_results.column_hits)
+                keep_going = scan_results.keep_going
+                occupancy = self._occupancy(scan_results.column_hits)
+                if self._add_scans:
+                    self.accumulator.add(occupancy,
+                                         scan_results.end_timestamp -
+                                         scan_results.start_timestamp,
+                                         timestamp=scan_results.end_timestamp)
+                self._push_frame(frames, (scan_results, occupancy))
+        except Exception:
+            self._acquisition_error = sys.exc_info()
+        finally:
+            if writer is not None:
+                writer.close()
+            self._push_frame(frames, None)
+
+    def _get_application(self, scan_function, persistence, heatmap=False):
         def application(stdscr):
             curses.curs_set(0)
-            stdscr.nodelay(1)
+            # wait for keys for at most one frame
+            stdscr.timeout(int(1000 / self.frame_rate))
             # calculate the offset of the screen
             y_offset, x_offset = ChipViewer._get_offset(*stdscr.getmaxyx())
             stdscr.addstr(y_offset - 2, x_offset, "q to quit")
             stdscr.addstr(y_offset - 3, x_offset,
             "x to clear persistence. does not affect history")
             stdscr.refresh()
-            stay_in_loop = True
-            while stay_in_loop:
-                # run the scan
-                scan_results = scan_function()
-                self.event_history.append(scan_results)
-                stay_in_loop = scan_results.keep_going
-                # process the results
-                for i, col_hit in enumerate(scan_results.column_hits):
-                    col_diagram = np.zeros(64)
-                    col_diagram[col_hit] = 1
-                    if persistence:
-                        col_diagram = np.logical_or(col_diagram,
-                            self.persistence_history[i]).astype(int)
-                        self.persistence_history[i] = col_diagram
-                    # display the results
-                    result_str = ChipViewer._present_array(col_diagram)
-                    stdscr.addstr(i+y_offset, x_offset, result_str)
-                stdscr.refresh()
+            symbols = SYMBOLS if heatmap else BINARY_SYMBOLS
+            renderer = ChipRenderer(stdscr, y_offset, x_offset, symbols,
+                                    self.frame_rate)
+
+            frames = Queue.Queue(self.queue_size)
+            stop = threading.Event()
+            acquisition = threading.Thread(target=self._acquire,
+                                           args=(scan_function, frames, stop),
+                                           name="viewer acquisition")
+            acquisition.daemon = True
+            acquisition.start()
+
+            finished = False
+            while not finished:
+                # take everything that arrived since the last frame
+                latest = None
+                while True:
+                    try:
+                        frame = frames.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if frame is None:
+                        finished = True
+                        break
+                    latest = frame
                 c = stdscr.getch()
                 if c == ord('q'):
-                    stay_in_loop = False
+                    finished = True
                 if c == ord('x'):
-                    self.persistence_history = np.zeros((18,64))
+                    # leave the (maybe shared) accumulator alone
+                    self._cleared_counts = self.accumulator.counts
+                    latest = latest or self._last_frame
+                # process the results
+                if latest is not None:
+                    self._last_frame = latest
+                    if heatmap:
+                        renderer.show(heatmap_levels(self.counts))
+                    elif persistence:
+                        renderer.show(self.persistence_history)
+                    else:
+                        renderer.show(latest[1])
+                renderer.update()
+            stop.set()
+            stdscr.addstr(y_offset - 2, x_offset, "stopping...")
+            stdscr.refresh()
+            acquisition.join()
         return application
 
-    def run_curses(self, scan_function=None, persistence=False):
+    def run_curses(self, scan_function=None, persistence=False,
+                   emulate=False, heatmap=False):
         """
         Run the curses application with the given scanning function.
 
@@ -153,13 +362,18 @@ class ChipViewer(object):
         which is True if the program should repeat, False if the program
         should stop running. It will be run in an infinite loop until
         the 2nd item of the tuple is False.
+
+        If `emulate` is True, the default scan function uses the chip
+        emulator instead of hardware. If `heatmap` is True, pixels are
+        shaded by how often they were hit instead of shown as hit or not.
         """
         # Do this by default, if no function is specified
         if scan_function is None:
             self.scanner = None
             self._have_hardware = True
             try:
-                self.scanner = scan.Scanner("lt3maps/lt3maps.yaml")
+                self.scanner = scan.Scanner("lt3maps/lt3maps.yaml",
+                                            emulate=emulate)
             except:
                 raise
                 self._have_hardware = False
@@ -173,6 +387,10 @@ class ChipViewer(object):
                         time.sleep(1/18.0)
                 self.scanner = random_generator()
             if self._have_hardware:
+                # the scanner counts its scans itself
+                self.accumulator = self.scanner.accumulator
+                self._add_scans = False
+                self._cleared_counts = self.accumulator.counts
                 scan_function = ChipViewer._get_scan_results_hardware
                 scan_function = functools.partial(scan_function, self.scanner)
             else:
@@ -180,14 +398,23 @@ class ChipViewer(object):
                 scan_function = functools.partial(scan_function, self.scanner)
 
         # Do this always
-        curses.wrapper(self._get_application(scan_function, persistence))
+        self._acquisition_error = None
+        curses.wrapper(self._get_application(scan_function, persistence,
+                                             heatmap))
         self._save_history()
+        if self._acquisition_error is not None:
+            error_type, error, traceback = self._acquisition_error
+            raise error_type, error, traceback
 
 if __name__ == "__main__":
     logging.basicConfig(filename="tuning.log", level=logging.DEBUG)
     parser = argparse.ArgumentParser()
     parser.add_argument("--persist", action="store_true")
+    parser.add_argument("--emulate", action="store_true")
+    parser.add_argument("--heatmap", action="store_true")
     clargs = parser.parse_args()
     app = ChipViewer()
     app.history_file = "history.txt"
-    app.run_curses(persistence=clargs.persist)
+    app.binary_history_file = "history.t3h"
+    app.run_curses(persistence=clargs.persist, emulate=clargs.emulate,
+                   heatmap=clargs.heatmap)
@@ -9,6 +9,9 @@ generator.
 """
 
 from lt3maps.lt3maps import *
+from lt3maps.hits import HitStore
+from lt3maps.occupancy import OccupancyAccumulator
+from lt3maps.trace import TransactionTracer
 import numpy as np
 import time
 import yaml
@@ -19,13 +22,23 @@ class Scanner(object):
     """
     Scan for hits on the LT3MAPS chip.
 
+    The hits of all scans since the last `reset` are kept in
+    `hit_store`, a `lt3maps.hits.HitStore`. `hits` shows them in the
+    older format of one dict per cycle. `cycle_start_times` lists when
+    the integration window of each of those cycles started.
+
+    Every scan is also added to `accumulator`, a
+    `lt3maps.occupancy.OccupancyAccumulator`, which keeps running
+    per-pixel statistics until it is reset itself.
+
     """
 
-    def __init__(self, config_file_location):
-        self.chip = T3MAPSChip(config_file_location)
+    def __init__(self, config_file_location, emulate=False):
+        self.chip = T3MAPSChip(config_file_location, emulate=emulate)
+        self.accumulator = OccupancyAccumulator(self.chip.num_columns,
+                                                self.chip.num_rows)
         self.initialize_all_latches()
-        self.hits = []
-        self._outputs = []
+        self.reset()
 
     def _reset_hit_configuration(self, column_number):
         """
@@ -86,8 +99,6 @@ class Scanner(object):
 
         # Remove the bits from setting the strobes
         chip.set_pixel_register("0" * chip.num_rows)
-
-        chip.run(get_output=False)
         return
 
     def reset(self):
@@ -95,8 +106,24 @@ class Scanner(object):
         Reset the scanner to prepare to take a new scan.
 
         """
-        self.hits = []
-        self._outputs = []
+        self.hit_store = HitStore(self.chip.num_columns, self.chip.num_rows)
+        self.cycle_start_times = []
+        self._hits = None
+        self._hits_size = 0
+
+    @property
+    def hits(self):
+        """
+        The hits as a list with one dict per cycle.
+
+        Built from `hit_store` when it is first asked for after a scan.
+        See `HitStore.as_dicts`.
+
+        """
+        if self._hits is None or self._hits_size != len(self.hit_store):
+            self._hits = self.hit_store.as_dicts()
+            self._hits_size = len(self.hit_store)
+        return self._hits
 
     def initialize_all_latches(self):
         for column_number in range(self.chip.num_columns):
@@ -107,8 +134,7 @@ class Scanner(object):
 
             # Remove the bits from setting the strobes
             self.chip.set_pixel_register("0" * self.chip.num_rows)
-            if column_number % 2 == 1:
-                self.chip.run()
+        self.chip.run_async()
 
     def set_all_TDACs(self, value):
         for column_number in range(self.chip.num_columns):
@@ -117,16 +143,25 @@ class Scanner(object):
 
             # Remove the bits from setting the strobes
             self.chip.set_pixel_register("0" * self.chip.num_rows)
-            if column_number % 2 == 1:
-                self.chip.run()
+        self.chip.run_async()
 
-    def scan(self, sleep, cycles, global_threshold=150):
+    def scan(self, sleep, cycles, global_threshold=150, hardware_repeat=False,
+             start_at=None):
         """
         Perform a source scan and record all hits.
 
+        If `start_at` (a `time.time()` value) is given, the first
+        integration window does not start before then, though the chip
+        is configured right away.
+
+        If `hardware_repeat` is True, the readout and reset commands are
+        sent to the chip once, and the sequencer repeats them `cycles`
+        times, using its wait time between repetitions as the integration
+        time. This avoids a round trip from the host for every cycle, but
+        `sleep` is limited to what the sequencer can wait (a few ms).
+
         """
         NUM_COLUMNS = self.chip.num_columns
-        NUM_ROWS = self.chip.num_rows
         # set up the global dac register
         logging.debug("global threshold = " + str(global_threshold))
         self.chip.set_global_register(
@@ -139,49 +174,112 @@ class Scanner(object):
             load_DAC=True
         )
 
-        self.chip.run(get_output=False)
-
         for i in range(NUM_COLUMNS):
             self._set_latches_for_scan(i)
+        self.chip.run_async(get_output=False)
+        if start_at is not None:
+            self.chip.flush()
+            time.sleep(max(start_at - time.time(), 0))
+
+        if hardware_repeat:
+            return self._scan_hardware_repeat(sleep, cycles)
 
-        num_cols_together = 9
         for _ in range(cycles):
             self._reset_hit_configuration(0)
             self.chip.run()
             start_time = time.time()
             time.sleep(sleep)
             end_time = time.time()
-            for i in range(0, NUM_COLUMNS, num_cols_together):
-                self._read_column_hits(i, i + num_cols_together)
-                output = self.chip.run()
-                read_time = time.time()
-                starts = range(0, num_cols_together * NUM_ROWS, NUM_ROWS)
-                outputs = [(output[i:i+NUM_ROWS], read_time) for i in starts]
-                self._outputs.extend(outputs)
-
-        cycle_num = 0
-        for i, (output, read_time) in enumerate(self._outputs):
-            if i % NUM_COLUMNS == 0:
-                cycle_num = i/NUM_COLUMNS
-                self.hits.append({'cycle': cycle_num, 'data': []})
-            hits = np.nonzero(output[::-1])[0]
-            self.hits[cycle_num]['data'].append({
-                "column": i % NUM_COLUMNS,
-                "num_hits": len(hits),
-                "hit_rows": hits.tolist(),
-                "time": read_time
-            })
+            # the driver splits the readout if it is too long for one run
+            self._read_column_hits(0, NUM_COLUMNS)
+            pending = self.chip.run_async()
+            columns = self.chip.output_by_column(pending.result())
+            self.hit_store.append(columns, pending.end_time)
+            self.cycle_start_times.append(start_time)
+            self.accumulator.add(columns, end_time - start_time,
+                                 timestamp=pending.end_time)
+
+        return start_time, end_time
+
+    def _scan_hardware_repeat(self, sleep, cycles):
+        """
+        Take `cycles` scans with a single, hardware-repeated sequence.
+
+        The first integration window is started, and the last one read
+        out, by runs of their own, so that every window lasts `sleep`.
+
+        Returns the start of the first and the end of the last
+        integration window.
+
+        """
+        NUM_COLUMNS = self.chip.num_columns
+        driver = self.chip._driver
+        wait = int(round(sleep * driver.seq_clock_frequency))
+        if wait > driver.seq_max_wait:
+            raise ValueError("sleep must be <= %g s with hardware repeat" %
+                             (driver.seq_max_wait /
+                              float(driver.seq_clock_frequency)))
+        if not 1 <= cycles <= driver.seq_max_repeat:
+            raise ValueError("cycles must be between 1 and %i with hardware "
+                             "repeat" % driver.seq_max_repeat)
+
+        # start the first integration window, and integrate while the
+        # sequencer waits
+        self._reset_hit_configuration(0)
+        start_time = time.time()
+        runs = [self.chip.run_async(wait=wait)]
+
+        if cycles > 1:
+            # one cycle: read out every column, then start integrating
+            # again, then integrate while the sequencer waits
+            self._read_column_hits(0, NUM_COLUMNS)
+            self._reset_hit_configuration(0)
+            runs.append(self.chip.run_async(num_executions=cycles - 1,
+                                            wait=wait))
+
+        # read out the last integration window
+        self._read_column_hits(0, NUM_COLUMNS)
+        runs.append(self.chip.run_async())
+        end_time = runs[-1].start_time
+        output = np.concatenate([run.result() for run in runs[1:]])
+
+        cycle_time = (end_time - start_time) / cycles
+        read_times = start_time + np.arange(1, cycles + 1) * cycle_time
+        columns = self.chip.output_by_column(output)
+        self.hit_store.append(columns, read_times)
+        # each window starts as the previous one is read out
+        self.cycle_start_times.extend([start_time] +
+                                      read_times[:-1].tolist())
+        self.accumulator.add(columns,
+                             cycles * wait / float(driver.seq_clock_frequency),
+                             timestamp=runs[-1].end_time)
         return start_time, end_time
 
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--sleep", type=float, default=0)
     parser.add_argument("--cycles", type=int, default=1)
+    parser.add_argument("--emulate", action="store_true")
+    parser.add_argument("--hardware-repeat", action="store_true")
+    parser.add_argument("--trace", default=None,
+                        help="file to record the driver transactions in")
     args = parser.parse_args()
-    scanner = Scanner("lt3maps/lt3maps.yaml")
-
+    scanner = Scanner("lt3maps/lt3maps.yaml", emulate=args.emulate)
+
+    tracer = None
+    if args.trace:
+        tracer = TransactionTracer(scanner.chip._driver)
+        tracer.trace_methods(scanner)
+        tracer.trace_methods(scanner.chip)
+        tracer.start()
     scanner.set_all_TDACs(0)
-    scanner.scan(args.sleep, args.cycles)
+    scanner.scan(args.sleep, args.cycles,
+                 hardware_repeat=args.hardware_repeat)
+    if tracer is not None:
+        tracer.stop()
+        print tracer.summary()
+        tracer.save(args.trace)
     print "time: ", scanner.hits[-1]['data'][-1]["time"] -\
         scanner.hits[0]['data'][0]["time"]
     outfile = open("out.yaml", "w")
@@ -0,0 +1,272 @@
+"""
+Threshold S-curve scans.
+
+A fixed charge is injected into every pixel `num_injections` times at
+each value of the global threshold (vth), and the hits of each pixel
+are counted. As vth rises past a pixel's threshold, the fraction of
+injections it sees falls from 1 to 0 along an error function (an
+S-curve):
+
+    fraction(vth) = 1 - normal_cdf((vth - threshold) / noise)
+
+`fit_scurves` finds the threshold and noise (in vth units) of all
+pixels at once, and `ThresholdMap` stores them.
+
+All injections of one vth step are a single sequence, which the
+sequencer repeats: inject, read out every column, start integrating
+again. The host only sends one such sequence per step.
+
+Run it with
+
+    $ python scurve.py --start 80 --stop 180 --injections 100 \\
+          --output thresholds.npz
+
+"""
+import scan_inject as scan
+from lt3maps.normal import normal_cdf, normal_pdf
+import argparse
+import logging
+import time
+import numpy as np
+import yaml
+
+DEFAULT_DAC = {
+    'PrmpVbp': 142,
+    'PrmpVbf': 15,
+    'DisVbn': 49,
+    'VbpThStep': 25,
+    'PrmpVbnFol': 150,
+}
+"""
+The DAC settings, other than vth, used for a scan. The same as
+`Scanner.scan` uses.
+
+"""
+
+
+def fit_scurves(vth_values, counts, num_injections, iterations=10):
+    """
+    Fit an S-curve to the hit counts of every pixel.
+
+    `counts` is indexed by (vth step, column, row). Returns the
+    threshold and noise of each pixel, by (column, row), in vth units.
+    Pixels which do not go from mostly hit to mostly not hit within
+    the scanned range get NaN.
+
+    The fit starts from the estimates given by the area under each
+    curve (threshold) and the spread of its slope (noise), then takes
+    `iterations` damped Gauss-Newton steps, for all pixels together.
+
+    """
+    vth = np.asarray(vth_values, dtype=np.float64)
+    order = np.argsort(vth)
+    vth = vth[order]
+    fraction = np.asarray(counts, dtype=np.float64)[order] / num_injections
+    shape = fraction.shape[1:]
+    # one row per pixel, one column per vth step
+    fraction = fraction.reshape(len(vth), -1).T
+    step = np.median(np.diff(vth)) if len(vth) > 1 else 1.0
+
+    # first guess: the area under the curve, and the width of its slope
+    threshold = vth[0] + step * (fraction.sum(axis=1) - 0.5)
+    slope = np.clip(-np.diff(fraction, axis=1), 0, None)
+    middle = (vth[1:] + vth[:-1]) / 2
+    weight = slope.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spread = (slope * np.square(middle - threshold[:, np.newaxis])
+                  ).sum(axis=1) / weight
+    noise = np.sqrt(np.where(weight > 0, spread, 0))
+    noise = np.maximum(noise, step / 2)
+    valid = ((fraction[:, 0] > 0.5) & (fraction[:, -1] < 0.5) &
+             (weight > 0))
+
+    damping = 1e-3
+    for _ in range(iterations):
+        z = (vth - threshold[:, np.newaxis]) / noise[:, np.newaxis]
+        residual = fraction - (1 - normal_cdf(z))
+        # derivatives of the model by threshold and noise
+        d_threshold = normal_pdf(z) / noise[:, np.newaxis]
+        d_noise = d_threshold * z
+        a11 = (d_threshold * d_threshold).sum(axis=1) * (1 + damping)
+        a22 = (d_noise * d_noise).sum(axis=1) * (1 + damping)
+        a12 = (d_threshold * d_noise).sum(axis=1)
+        b1 = (d_threshold * residual).sum(axis=1)
+        b2 = (d_noise * residual).sum(axis=1)
+        det = a11 * a22 - a12 * a12
+        ok = valid & (det > 0)
+        det[~ok] = 1
+        threshold += np.where(ok, (a22 * b1 - a12 * b2) / det, 0)
+        noise += np.where(ok, (a11 * b2 - a12 * b1) / det, 0)
+        noise = np.maximum(noise, step / 10)
+
+    threshold[~valid] = np.nan
+    noise[~valid] = np.nan
+    return threshold.reshape(shape), noise.reshape(shape)
+
+
+class ThresholdMap(object):
+    """
+    The fitted threshold and noise of every pixel, in vth units.
+
+    `threshold` and `noise` are indexed by (column, row). The raw data
+    of the scan, `vth` and `counts` (by vth step, column, row), is kept
+    too, so that it can be fit again.
+
+    """
+
+    def __init__(self, threshold, noise, vth=None, counts=None,
+                 num_injections=0, dac=None, created=None):
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.noise = np.asarray(noise, dtype=np.float64)
+        self.vth = None if vth is None else np.asarray(vth)
+        self.counts = None if counts is None else np.asarray(counts)
+        self.num_injections = num_injections
+        self.dac = dict(dac or {})
+        self.created = time.time() if created is None else created
+
+    @classmethod
+    def from_scan(cls, vth, counts, num_injections, dac=None):
+        threshold, noise = fit_scurves(vth, counts, num_injections)
+        return cls(threshold, noise, vth, counts, num_injections, dac)
+
+    def save(self, filename):
+        """
+        Write the map to a file, as YAML if the name ends in .yaml or
+        .yml (without the raw data), or as a NumPy .npz file otherwise.
+
+        """
+        if filename.endswith(('.yaml', '.yml')):
+            # NaN is written as .nan, which YAML reads back
+            data = {
+                'threshold': self.threshold.tolist(),
+                'noise': self.noise.tolist(),
+                'num_injections': self.num_injections,
+                'dac': self.dac,
+                'created': self.created,
+            }
+            with open(filename, 'w') as outfile:
+                outfile.write(yaml.dump(data))
+            return
+        arrays = {}
+        if self.vth is not None:
+            arrays['vth'] = self.vth
+            arrays['counts'] = self.counts
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile, threshold=self.threshold, noise=self.noise,
+                     num_injections=self.num_injections,
+                     dac=yaml.dump(self.dac), created=self.created,
+                     **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a map from a file written by `save`.
+
+        """
+        if filename.endswith(('.yaml', '.yml')):
+            with open(filename) as infile:
+                data = yaml.load(infile, Loader=yaml.SafeLoader)
+            return cls(data['threshold'], data['noise'],
+                       num_injections=data['num_injections'],
+                       dac=data['dac'], created=data['created'])
+        data = np.load(filename)
+        return cls(data['threshold'], data['noise'],
+                   data['vth'] if 'vth' in data else None,
+                   data['counts'] if 'counts' in data else None,
+                   int(data['num_injections']),
+                   yaml.load(str(data['dac']), Loader=yaml.SafeLoader),
+                   float(data['created']))
+
+
+class SCurveScan(object):
+    """
+    Scan the global threshold while injecting into every pixel.
+
+    """
+
+    def __init__(self, scanner, num_injections=100, injection_delay=250,
+                 dac=None):
+        self.scanner = scanner
+        self.num_injections = num_injections
+        self.injection_delay = injection_delay
+        self.dac = dict(DEFAULT_DAC)
+        self.dac.update(dac or {})
+
+    def run(self, vth_values):
+        """
+        Inject `num_injections` times at each vth and count the hits.
+
+        Returns the counts, indexed by (vth step, column, row).
+
+        """
+        scanner = self.scanner
+        chip = scanner.chip
+        vth_values = list(vth_values)
+        counts = np.zeros((len(vth_values), chip.num_columns, chip.num_rows),
+                          int)
+        for column in range(chip.num_columns):
+            scanner._set_latches_for_scan(column)
+        # read the output, so that it does not end up in the next one
+        chip.run_async()
+
+        previous = None
+        for step, vth in enumerate(vth_values):
+            logging.debug("S-curve scan: vth = %i", vth)
+            # load the threshold and start integrating
+            chip.set_global_register(vth=vth, load_DAC=True, **self.dac)
+            scanner._reset_hit_configuration(0)
+            chip.run_async()
+            # one cycle: inject, read out every column, start integrating
+            # again. The readout of the last step is decoded meanwhile.
+            chip.inject(self.injection_delay)
+            scanner._read_column_hits(0, chip.num_columns)
+            scanner._reset_hit_configuration(0)
+            pending = chip.run_async(num_executions=self.num_injections)
+            if previous is not None:
+                counts[step - 1] = self._count(previous)
+            previous = pending
+        if previous is not None:
+            counts[-1] = self._count(previous)
+        return counts
+
+    def _count(self, pending):
+        return self.scanner.chip.output_by_column(pending.result()).sum(axis=0)
+
+    def scan(self, vth_values):
+        """
+        Run the scan and fit it. Returns a `ThresholdMap`.
+
+        """
+        vth_values = list(vth_values)
+        counts = self.run(vth_values)
+        return ThresholdMap.from_scan(vth_values, counts,
+                                      self.num_injections, self.dac)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start", type=int, default=80)
+    parser.add_argument("--stop", type=int, default=180)
+    parser.add_argument("--step", type=int, default=1)
+    parser.add_argument("--injections", type=int, default=100)
+    parser.add_argument("--tdac", default=None,
+                        help="TDAC map to apply before scanning")
+    parser.add_argument("--output", default="thresholds.npz")
+    parser.add_argument("--emulate", action="store_true")
+    args = parser.parse_args()
+
+    scanner = scan.Scanner("lt3maps/lt3maps.yaml", emulate=args.emulate)
+    if args.tdac:
+        scanner.chip.import_TDAC(args.tdac)
+    start = time.time()
+    result = SCurveScan(scanner, args.injections).scan(
+        range(args.start, args.stop, args.step))
+    result.save(args.output)
+    fitted = np.isfinite(result.threshold)
+    print "%i of %i pixels fitted in %.1f s" % (fitted.sum(), fitted.size,
+                                                time.time() - start)
+    if fitted.any():
+        print "threshold: mean %.2f, dispersion %.2f; noise: mean %.2f" % (
+            result.threshold[fitted].mean(), result.threshold[fitted].std(),
+            result.noise[fitted].mean())
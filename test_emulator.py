@@ -0,0 +1,531 @@
+"""
+Test the lt3maps software against the chip emulator.
+
+These tests need no hardware.
+
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+from lt3maps.lt3maps import *
+import scan_inject
+import tune
+import acquire
+import scurve
+import multiboard
+import benchmark
+from lt3maps.history import History
+from lt3maps.occupancy import OccupancyAccumulator
+from lt3maps.trace import TransactionTracer
+
+
+class FakeSeq(object):
+    """
+    A sequencer which is done after `done_after` polls.
+
+    """
+    def __init__(self, done_after):
+        self.done_after = done_after
+        self.polls = 0
+
+    def get_done(self):
+        self.polls += 1
+        return self.polls >= self.done_after
+
+
+class TestEmulator(unittest.TestCase):
+    def setUp(self):
+        self.chip = T3MAPSChip("lt3maps/lt3maps.yaml", emulate={'seed': 0})
+        self.model = self.chip._driver['inf'].chip
+
+    def test_columns(self):
+        chip = self.chip
+        for i in range(16):
+            chip.set_global_register(column_address=i)
+
+            chip.set_pixel_register('1' + '0'*i + '1' + '0' * (64-i-2))
+
+            chip.set_pixel_register('1'*(i+1) + '0'*(16-(i+1)) + '0'*48)
+
+        output = chip.run()
+
+        for i in range(16):
+            column_output = output[(128*i):(128*(i+1))]
+            desired_output = [0]*64 + [1] + [0]*i + [1] + [0]*(64-i-2)
+            self.assertTrue(all(column_output[64:] == desired_output[64:]))
+
+    def test_run_async(self):
+        chip = self.chip
+        chip.set_global_register(column_address=2)
+        chip.set_pixel_register('10' * 32)
+        chip.set_pixel_register('1100' * 16)
+        first = chip.run_async()
+        chip.set_pixel_register('0' * 64)
+        second = chip.run_async()
+        self.assertTrue(all(second.result() == [1, 1, 0, 0] * 16))
+        self.assertTrue(all(first.result()[64:] == [1, 0] * 32))
+        self.assertTrue(first.done and second.done)
+
+    def test_packed_output(self):
+        chip = self.chip
+        chip.set_global_register(column_address=2)
+        chip.set_pixel_register('1100' * 16)
+        chip.set_pixel_register('0' * 64)
+        packed = chip.run(packed=True)
+        self.assertEqual(packed.dtype, np.uint8)
+        self.assertTrue(all(packed[8:] == [0xcc] * 8))
+        columns = chip.output_by_column(np.unpackbits(packed)[64:],
+                                        num_columns=1)
+        self.assertEqual(columns.shape, (1, 1, 64))
+        self.assertTrue(all(columns[0, 0] == [0, 0, 1, 1] * 16))
+
+    def test_global_register(self):
+        chip = self.chip
+        chip.set_global_register(vth=60, VbpThStep=25, load_DAC=True)
+        chip.run(get_output=False)
+        self.assertEqual(self.model.dac['vth'], 60)
+        self.assertEqual(self.model.dac['VbpThStep'], 25)
+
+    def test_TDAC(self):
+        chip = self.chip
+        chip.set_bit_latches(3, [0, 5, 63], 'TDAC_strobes', 31)
+        chip.run(get_output=False)
+        expected = np.zeros(64)
+        expected[[0, 5, 63]] = 31
+        self.assertTrue(all(self.model.tdac[3] == expected))
+        self.assertTrue(all(chip.pixel_TDAC_matrix()[3] == expected))
+
+    def test_apply_TDAC(self):
+        chip = self.chip
+        tdac = np.random.RandomState(0).randint(32, size=(18, 64))
+        tdac[:, 5] = 31
+        chip._import_TDAC_to_pixels(tdac)
+        runs = chip._driver.stats['transfer'].count
+        chip._apply_pixel_TDAC_to_chip()
+        chip.flush()
+        self.assertTrue((self.model.tdac == tdac).all())
+        self.assertEqual(chip._columns_to_update(), set())
+        self.assertTrue(chip._driver.stats['transfer'].count - runs < 18)
+
+    def test_TDAC_map(self):
+        chip = self.chip
+        directory = tempfile.mkdtemp()
+        try:
+            tdac = np.random.RandomState(1).randint(32, size=(18, 64))
+            chip._import_TDAC_to_pixels(tdac)
+            for name in ("map.tdac", "map.yaml"):
+                chip.save_TDAC_to_file(os.path.join(directory, name),
+                                       dac={'vth': 60})
+            transfer = chip._driver.stats['transfer']
+            tdac_map = chip.import_TDAC(os.path.join(directory, "map.tdac"))
+            chip.flush()
+            self.assertEqual(tdac_map.dac, {'vth': 60})
+            self.assertTrue((self.model.tdac == tdac).all())
+            runs = transfer.count
+            # already on the chip: nothing is sent
+            chip.import_TDAC(os.path.join(directory, "map.yaml"))
+            self.assertEqual(transfer.count, runs)
+            # changed in software only: the map is sent again
+            chip._pixels[2][5].TDAC = (tdac[2][5] + 1) % 32
+            chip.import_TDAC(os.path.join(directory, "map.tdac"))
+            self.assertEqual(chip._pixels[2][5].TDAC, tdac[2][5])
+            chip._apply_pixel_TDAC_to_chip()
+            chip.flush()
+            self.assertTrue((self.model.tdac == tdac).all())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_apply_unchanged_TDAC(self):
+        chip = self.chip
+        chip._pixels[6][20].TDAC = 9
+        chip._apply_pixel_TDAC_to_chip()
+        chip.flush()
+        transfer = chip._driver.stats['transfer']
+        runs = transfer.count
+        # nothing changed: no sequence is started
+        chip._apply_pixel_TDAC_to_chip()
+        chip.flush()
+        self.assertEqual(transfer.count, runs)
+        self.assertEqual(self.model.tdac[6][20], 9)
+
+    def test_pixel_state(self):
+        chip = self.chip
+        chip._pixels[4][10].TDAC = 7
+        self.assertEqual(chip._columns_to_update(), set([4]))
+        self.assertRaises(ValueError, setattr, chip._pixels[4][10], 'TDAC',
+                          32)
+        # strobing no TDAC bits still counts as an update
+        chip.pixel_state.strobe(4, np.zeros(64, dtype=bool), TDAC_strobes=0)
+        self.assertEqual(chip._columns_to_update(), set())
+        chip._pixels[4][10].TDAC = 7
+        chip.set_bit_latches(4, [10, 11], 'TDAC_strobes', 0b11000,
+                             'hit_strobe')
+        self.assertEqual(chip._columns_to_update(), set())
+        self.assertEqual(chip._pixels[4][10].TDAC, 0b11111)
+        self.assertEqual(chip._pixels[4][11].TDAC, 0b11000)
+        self.assertEqual(chip.pixel_TDAC_matrix(binary=True)[4][11], "11000")
+        self.assertEqual(np.flatnonzero(
+            chip.pixel_state.latches['hit_strobe'][4]).tolist(), [10, 11])
+
+    def test_wait_for_seq(self):
+        driver = self.chip._driver
+        seq = FakeSeq(done_after=1)
+        driver._seq_driver = seq
+        # 50 ms at the sequencer's clock
+        num_bits = int(0.05 * driver.seq_clock_frequency)
+        started = time.time()
+        driver._wait_for_seq(num_bits, started)
+        elapsed = time.time() - started
+        self.assertTrue(0.05 - driver.seq_wait_margin <= elapsed < 0.1)
+        # slept through the sequence instead of polling
+        self.assertEqual(seq.polls, 1)
+
+        # the prediction is too short: polls until done
+        seq = FakeSeq(done_after=5)
+        driver._seq_driver = seq
+        driver._wait_for_seq(0, time.time())
+        self.assertEqual(seq.polls, 5)
+
+    def test_stats(self):
+        chip = self.chip
+        chip.set_global_register(column_address=1)
+        chip.set_pixel_register("0" * 64)
+        output = chip.run()
+        stats = chip._driver.stats
+        self.assertEqual(stats['build'].count, 2)
+        self.assertEqual(stats['run'].count, 1)
+        self.assertEqual(stats['decode'].bits, len(output))
+        self.assertEqual(stats['transfer'].bytes, stats['transcribe'].bits)
+
+    def test_seq_cache(self):
+        chip = self.chip
+        driver = chip._driver
+        outputs = []
+        for i in range(3):
+            chip.set_global_register(column_address=4)
+            chip.set_pixel_register("01" * 32)
+            chip.set_pixel_register("0" * 64)
+            outputs.append(chip.run())
+        info = driver.seq_cache_info()
+        self.assertEqual((info['misses'], info['hits']), (1, 2))
+        # the sequence is only written to the sequencer once
+        transfer = driver.stats['transfer']
+        self.assertEqual(transfer.bytes, transfer.bits / 3)
+        self.assertTrue(all(outputs[2][64:] == [0, 1] * 32))
+
+    def test_no_seq_cache(self):
+        chip = self.chip
+        driver = chip._driver
+        driver.seq_cache_size = 0
+        for i in range(2):
+            chip.set_global_register(column_address=4)
+            chip.set_pixel_register("01" * 32)
+            chip.set_pixel_register("0" * 64)
+            output = chip.run()
+            self.assertTrue(all(output[64:] == [0, 1] * 32))
+        self.assertEqual(driver.seq_cache_info()['size'], 0)
+        self.assertEqual(driver._blocks, [])
+
+    def test_partial_upload(self):
+        chip = self.chip
+        driver = chip._driver
+        outputs = []
+        for column in (4, 5):
+            chip.set_global_register(column_address=column)
+            chip.set_pixel_register("01" * 32)
+            chip.set_pixel_register("0" * 64)
+            outputs.append(chip.run())
+            image = driver._seq_cache.values()[-1]
+            self.assertTrue(all(driver['SEQ_GEN'].get_data(image.num_bits) ==
+                                np.frombuffer(image.data, dtype=np.uint8)))
+        # only the column address changed
+        self.assertEqual(driver.last_upload_bytes, 1)
+        self.assertTrue(all(outputs[1][64:] == [0, 1] * 32))
+
+    def test_auto_batch(self):
+        chip = self.chip
+        driver = chip._driver
+        patterns = [np.random.RandomState(i).randint(2, size=64)
+                    for i in range(80)]
+        chip.set_global_register(column_address=7)
+        for pattern in patterns:
+            chip.set_pixel_register(''.join(str(bit) for bit in pattern))
+        # read out the last pattern
+        chip.set_pixel_register("0" * 64)
+        pending = chip.run_async()
+        self.assertEqual(len(pending.batches), 1)
+        output = pending.result()
+        self.assertEqual(len(output), 81 * 64)
+        for i, pattern in enumerate(patterns):
+            self.assertTrue(all(output[64 * (i + 1):64 * (i + 2)] ==
+                                pattern))
+        self.assertEqual(driver.stats['transfer'].count, 2)
+
+    def test_no_auto_batch(self):
+        chip = self.chip
+        chip._driver.auto_batch = False
+        chip.set_global_register(column_address=7)
+        def queue_too_much():
+            for _ in range(100):
+                chip.set_pixel_register("01" * 32)
+        self.assertRaises(ValueError, queue_too_much)
+        # the blocks which fit can still be run, and so can later ones
+        self.assertTrue(len(chip.run()) > 0)
+        chip.set_global_register(column_address=7)
+        chip.set_pixel_register("0" * 64)
+        self.assertEqual(len(chip.run()), 64)
+
+    def test_batches_wait_for_run(self):
+        chip = self.chip
+        driver = chip._driver
+        tdac = np.random.RandomState(2).randint(32, size=(18, 64))
+        chip._import_TDAC_to_pixels(tdac)
+        chip._apply_pixel_TDAC_to_chip(run=False)
+        # too much for one run, but nothing has been started yet
+        self.assertTrue(driver._batch_starts)
+        self.assertEqual(driver.stats['transfer'].count, 0)
+        self.assertFalse(self.model.tdac.any())
+        driver.reset_seq()
+        chip.set_global_register(column_address=3)
+        chip.set_pixel_register("0" * 64)
+        output = chip.run()
+        self.assertEqual(len(output), 64)
+        self.assertEqual(driver.stats['transfer'].count, 1)
+        self.assertFalse(self.model.tdac.any())
+
+
+class TestEmulatedScan(unittest.TestCase):
+    def setUp(self):
+        self.scanner = scan_inject.Scanner("lt3maps/lt3maps.yaml",
+                                           emulate={'seed': 0})
+
+    def test_quiet_at_high_threshold(self):
+        self.scanner.scan(0, 1, 150)
+        num_hits = sum(column['num_hits'] for column in
+                       self.scanner.hits[0]['data'])
+        self.assertEqual(num_hits, 0)
+
+    def test_hits_match_model(self):
+        self.scanner.scan(0, 1, 60)
+        model = self.scanner.chip._driver['inf'].chip
+        for column in self.scanner.hits[0]['data']:
+            expected = np.nonzero(model.hits[column['column']])[0].tolist()
+            self.assertEqual(column['hit_rows'], expected)
+        self.assertTrue(model.hits.any())
+
+    def test_hardware_repeat(self):
+        self.scanner.scan(0, 3, 60, hardware_repeat=True)
+        hits = self.scanner.hits
+        self.assertEqual(len(hits), 3)
+        for cycle in hits:
+            self.assertEqual(len(cycle['data']), 18)
+            # every pixel is enabled with TDAC 0, so most are noisy
+            num_hits = sum(column['num_hits'] for column in cycle['data'])
+            self.assertTrue(num_hits > 1000)
+
+    def test_hardware_repeat_timing(self):
+        self.scanner.scan(0.002, 3, 150, hardware_repeat=True)
+        self.assertEqual(len(self.scanner.hits), 3)
+        self.assertAlmostEqual(self.scanner.accumulator.snapshot().exposure,
+                               0.006)
+        self.assertRaises(ValueError, self.scanner.scan, 0, 0x10000, 150,
+                          True)
+
+    def test_hit_store(self):
+        self.scanner.scan(0, 3, 60)
+        store = self.scanner.hit_store
+        self.assertEqual(len(store), 3)
+        hits = store.hits
+        self.assertEqual(len(hits), store.num_hits())
+        self.assertEqual(store.pixel_counts().sum(), len(hits))
+        last = store.cycles(2)
+        self.assertEqual(last.num_hits(), store.num_hits(2))
+        self.assertEqual(last.column_hits(2, 5).tolist(),
+                         self.scanner.hits[2]['data'][5]['hit_rows'])
+        self.assertEqual(hits[hits['cycle'] == 2]['row'].tolist(),
+                         last.hits['row'].tolist())
+
+    def test_accumulator(self):
+        self.scanner.accumulator.reset()
+        self.scanner.scan(0.01, 3, 60)
+        stats = self.scanner.accumulator.snapshot()
+        self.assertEqual(stats.num_cycles, 3)
+        self.assertTrue((stats.counts ==
+                         self.scanner.hit_store.pixel_counts()).all())
+        self.assertTrue(stats.exposure >= 0.03)
+        self.assertTrue(np.allclose(stats.rates,
+                                    stats.counts / stats.exposure))
+        # snapshots do not change when more scans are added
+        self.scanner.scan(0.01, 1, 60)
+        self.assertEqual(stats.num_cycles, 3)
+        self.assertEqual(self.scanner.accumulator.num_cycles, 4)
+
+    def test_noisy_pixels(self):
+        accumulator = OccupancyAccumulator(2, 4, time_constant=1.0)
+        occupancy = np.zeros((100, 2, 4), dtype=bool)
+        occupancy[::10] = True
+        occupancy[:, 1, 2] = True
+        accumulator.add(occupancy, 10.0)
+        self.assertEqual(np.argwhere(accumulator.noisy).tolist(), [[1, 2]])
+        self.assertEqual(accumulator.rates[1, 2], 10.0)
+        # the decayed rate follows the latest scans
+        accumulator.add(np.zeros((2, 4), dtype=bool), 10.0)
+        self.assertTrue(accumulator.decayed_rates[1, 2] < 0.01)
+        self.assertEqual(accumulator.rates[1, 2], 5.0)
+
+    def test_acquisition(self):
+        directory = tempfile.mkdtemp()
+        try:
+            acquisition = acquire.Acquisition(
+                self.scanner, directory, sleep=0, cycles=2,
+                global_threshold=60, scans_per_file=5, queue_size=2)
+            acquisition.run(max_scans=6)
+            self.assertEqual(acquisition.num_written, 6)
+            histories = [History(name) for name in acquisition.files]
+            # 12 cycles, 5 to a file
+            self.assertEqual([len(history) for history in histories],
+                             [5, 5, 2])
+            self.assertTrue(histories[1].num_hits.all())
+            for history in histories:
+                self.assertTrue((history.start <= history.end).all())
+            self.assertTrue((histories[-1].occupancy(-1) ==
+                             self.scanner.hit_store.occupancy[-1]).all())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_scurve(self):
+        scan = scurve.SCurveScan(self.scanner, num_injections=20)
+        result = scan.scan(range(100, 150, 3))
+        model = self.scanner.chip._driver['inf'].chip
+        # all TDACs are 0
+        expected = model.vth_offset + ((model.injection_charge -
+                                        model.threshold_offset) /
+                                       model.vth_gain)
+        self.assertTrue(np.isfinite(result.threshold).all())
+        self.assertTrue(np.abs(result.threshold - expected).mean() < 1)
+        self.assertTrue(abs(np.median(result.noise) -
+                            model.noise / model.vth_gain) < 0.5)
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ("thresholds.npz", "thresholds.yaml"):
+                filename = os.path.join(directory, name)
+                result.save(filename)
+                loaded = scurve.ThresholdMap.load(filename)
+                self.assertTrue((loaded.threshold == result.threshold).all())
+                self.assertEqual(loaded.dac, result.dac)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_benchmarks(self):
+        transfer = self.scanner.chip._driver.stats['transfer']
+        runs = transfer.count
+        benchmark.run_benchmarks(self.scanner, ['TDAC_planning'], repeat=1,
+                                 number=2)
+        # planned, but never run
+        self.assertEqual(transfer.count, runs)
+        results = benchmark.run_benchmarks(self.scanner, repeat=1, number=1)
+        self.assertEqual(results.keys(), benchmark.BENCHMARKS.keys())
+        self.assertEqual(results['decode_sr_output']['items'],
+                         10 * 18 * 64)
+        baseline = dict((name, {'best': result['best'] / 2})
+                        for name, result in results.iteritems())
+        table, slower = benchmark.compare(results, baseline)
+        self.assertEqual(slower, results.keys())
+
+    def test_trace(self):
+        seq_gen = self.scanner.chip._driver['SEQ_GEN']
+        tracer = TransactionTracer(self.scanner.chip._driver)
+        tracer.trace_methods(self.scanner)
+        with tracer:
+            self.scanner.scan(0, 2, 150)
+        self.assertNotIn('set_size', vars(seq_gen))
+        self.assertNotIn('scan', vars(self.scanner))
+        totals = tracer.totals('HL')
+        num_starts = totals[('scan', 'HL', 'SEQ_GEN', 'start')][0]
+        self.assertGreater(num_starts, 0)
+        # every sequencer start runs the emulated chip once
+        self.assertEqual(tracer.totals('TL')[('scan', 'TL', 'inf',
+                                              'execute')][0], num_starts)
+        self.assertIn(('scan', 'HL', 'DATA', 'get_data'), totals)
+        # nothing is recorded once stopped
+        num_transactions = len(tracer.transactions)
+        self.scanner.scan(0, 1, 150)
+        self.assertEqual(len(tracer.transactions), num_transactions)
+
+    def test_hardware_repeat_quiet(self):
+        self.scanner.scan(0, 2, 150, hardware_repeat=True)
+        for cycle in self.scanner.hits:
+            num_hits = sum(column['num_hits'] for column in cycle['data'])
+            self.assertEqual(num_hits, 0)
+
+
+class TestMultiBoard(unittest.TestCase):
+    def test_scan_and_upload(self):
+        config_file = "lt3maps/lt3maps.yaml"
+        with multiboard.MultiBoard({'A': config_file, 'B': config_file},
+                                   emulate=True) as boards:
+            TDAC = np.zeros((18, 64), dtype=int)
+            TDAC[3, 4] = 31
+            checksums = boards.upload_TDAC({'A': TDAC})
+            self.assertEqual(checksums.keys(), ['A'])
+            results = boards.scan(0, 2, 60)
+            self.assertEqual(sorted(results), ['A', 'B'])
+            for device_id, result in results.iteritems():
+                self.assertEqual(result.device_id, device_id)
+                self.assertEqual(len(result.hit_store), 2)
+            # every pixel is enabled with TDAC 0, so most are noisy
+            self.assertFalse(results['A'].hit_store.occupancy[:, 3, 4].any())
+            self.assertTrue(results['B'].hit_store.occupancy[:, 3, 4].all())
+            self.assertRaises(TypeError, boards.call, 'scan', ('x',))
+            # configured first, then lined up for integration
+            start_times = [result.start_time for result in results.values()]
+            self.assertTrue(max(start_times) - min(start_times) < 0.05)
+
+    def test_dead_worker(self):
+        boards = multiboard.MultiBoard(["lt3maps/lt3maps.yaml"], emulate=True)
+        boards.poll_interval = 0.1
+        with boards:
+            boards._workers[0].terminate()
+            boards._workers[0].join()
+            self.assertRaises(RuntimeError, boards.set_all_TDACs, 0)
+
+    def test_stuck_worker(self):
+        multiboard.COMMANDS['hang'] = lambda scanner, device_id: time.sleep(60)
+        try:
+            boards = multiboard.MultiBoard(["lt3maps/lt3maps.yaml"],
+                                           emulate=True)
+            boards.stop_timeout = 0.2
+            boards.start()
+            worker = boards._workers[0]
+            boards._commands[0].put(('hang', None, (), {}))
+            start = time.time()
+            boards.stop()
+            self.assertTrue(time.time() - start < 5)
+            self.assertFalse(worker.is_alive())
+        finally:
+            del multiboard.COMMANDS['hang']
+
+
+class TestEmulatedTuning(unittest.TestCase):
+    def test_binary_search(self):
+        tuner = tune.Tuner(view=False, emulate={'seed': 0}, method='binary')
+        tuner.integration_time = 0
+        tuner.calm_down_time = 0
+        model = tuner.scanner.chip._driver['inf'].chip
+        spread = model.thresholds()[1:17].std()
+        tuner._tune_loop(tuner.get_binary_search_function(range(1, 17)))
+        # 5 bits and a refinement, 4 scans each
+        self.assertEqual(tuner.scanner.chip._driver.stats['run'].count, 24)
+        # the scanner's accumulator keeps every scan
+        self.assertEqual(tuner.scanner.accumulator.num_cycles, 24)
+        self.assertTrue(model.thresholds()[1:17].std() < spread / 2)
+        self.assertTrue((model.tdac[[0, 17]] == 0).all())
+
+
+if __name__ == "__main__":
+    # Run the test
+    # 'buffer = True' causes prints to only go through if test fails.
+    unittest.main(buffer=True)
@@ -0,0 +1,95 @@
+"""
+Test the binary scan history format and its converters.
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import yaml
+from lt3maps.history import *
+
+HISTORY_TXT = """BEGIN SCAN #0
+1406916597.5
+%sEND SCAN #0
+BEGIN SCAN #1
+START TIME
+1406916599.0
+END TIME
+1406916600.5
+%sEND SCAN #1
+""" % ("1 2 \n" + "\n" * 17, "\n" * 17 + "0 63 \n")
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "history.t3h")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_convert_history_txt(self):
+        text_filename = os.path.join(self.directory, "history.txt")
+        with open(text_filename, "w") as outfile:
+            outfile.write(HISTORY_TXT)
+        self.assertEqual(convert_history_txt(text_filename, self.filename), 2)
+        history = History(self.filename)
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history.num_hits.tolist(), [2, 2])
+        self.assertEqual(history.start[0], history.end[0])
+        self.assertEqual(history.end[1], 1406916600.5)
+        self.assertEqual(history.column_hits(0)[0], [1, 2])
+        self.assertEqual(history.column_hits(1)[17], [0, 63])
+        self.assertEqual(history.occupancy(slice(None)).sum(), 4)
+
+    def test_convert_out_yaml(self):
+        yaml_filename = os.path.join(self.directory, "out.yaml")
+        cycles = [{'cycle': 0, 'data': [
+            {'column': i, 'hit_rows': [i], 'num_hits': 1, 'time': 10.0 + i}
+            for i in range(18)]}]
+        with open(yaml_filename, "w") as outfile:
+            outfile.write(yaml.dump(cycles))
+        self.assertEqual(convert_out_yaml(yaml_filename, self.filename), 1)
+        history = History(self.filename)
+        self.assertEqual((history.start[0], history.end[0]), (10.0, 27.0))
+        self.assertTrue((history.occupancy(0) == np.eye(18, 64)).all())
+
+    def test_iter_history_txt(self):
+        text_filename = os.path.join(self.directory, "history.txt")
+        with open(text_filename, "w") as outfile:
+            for i in range(2000):
+                outfile.write("BEGIN SCAN #%i\n%i.5\n%s\n" % (i, i, i % 64))
+                outfile.write("\n" * 17 + "END SCAN #%i\n" % i)
+        scans = list(iter_history_txt(text_filename))
+        self.assertEqual(len(scans), 2000)
+        self.assertEqual(scans[3], (3, 3.5, 3.5, [[3]] + [[]] * 17))
+        for first in (1, 1234, 1999):
+            scan = next(iter_history_txt(text_filename, first))
+            self.assertEqual(scan, scans[first])
+        self.assertEqual(list(iter_history_txt(text_filename, 2000)), [])
+
+    def test_iter_out_yaml(self):
+        yaml_filename = os.path.join(self.directory, "out.yaml")
+        cycles = [{'cycle': i, 'data': [
+            {'column': 0, 'hit_rows': [i % 64], 'num_hits': 1, 'time': 1.5}]}
+            for i in range(1000)]
+        with open(yaml_filename, "w") as outfile:
+            outfile.write(yaml.dump(cycles))
+        self.assertEqual(list(iter_out_yaml(yaml_filename)), cycles)
+        self.assertEqual(list(iter_out_yaml(yaml_filename, 998)), cycles[998:])
+
+    def test_append(self):
+        occupancy = np.random.RandomState(0).rand(18, 64) > 0.5
+        for i in range(3):
+            with HistoryWriter(self.filename) as writer:
+                writer.append(i, i + 1, occupancy)
+        history = History(self.filename)
+        self.assertEqual(history.start.tolist(), [0, 1, 2])
+        self.assertTrue((history.occupancy(2) == occupancy).all())
+        self.assertRaises(ValueError, HistoryWriter, self.filename, 17)
+
+
+if __name__ == "__main__":
+    unittest.main(buffer=True)
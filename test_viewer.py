@@ -0,0 +1,171 @@
+"""
+Test the drawing code and the acquisition thread of the chip viewer,
+without a terminal.
+
+"""
+import threading
+import unittest
+import numpy as np
+import scan_analysis
+from scan_analysis import *
+from lt3maps.occupancy import OccupancyAccumulator
+
+
+class FakeWindow(object):
+    def __init__(self):
+        self.writes = []
+
+    def addstr(self, y, x, text):
+        self.writes.append((y, x, text))
+
+    def refresh(self):
+        pass
+
+
+class FakeScreen(FakeWindow):
+    """
+    A curses screen which returns the given keys, then none.
+
+    """
+    def __init__(self, keys=()):
+        FakeWindow.__init__(self)
+        self.keys = list(keys)
+
+    def timeout(self, delay):
+        pass
+
+    def getmaxyx(self):
+        return 40, 100
+
+    def getch(self):
+        if self.keys:
+            return ord(self.keys.pop(0))
+        time.sleep(0.01)
+        return -1
+
+
+def scan_results(keep_going=True):
+    column_hits = [[] for _ in range(18)]
+    column_hits[2] = [5, 6]
+    return ScanFunctionReturn(time.time(), time.time() + 0.1, column_hits,
+                              keep_going)
+
+
+class TestRenderer(unittest.TestCase):
+    def test_heatmap_levels(self):
+        counts = np.array([[0, 1, 50, 100]])
+        self.assertEqual(heatmap_levels(counts).tolist(), [[0, 1, 2, 4]])
+        self.assertEqual(heatmap_levels(np.zeros((2, 2))).tolist(),
+                         [[0, 0], [0, 0]])
+
+    def test_only_changes_drawn(self):
+        window = FakeWindow()
+        renderer = ChipRenderer(window, 2, 3, BINARY_SYMBOLS, max_rate=10)
+        levels = np.zeros((18, 64), dtype=int)
+        renderer.show(levels)
+        self.assertTrue(renderer.update(now=100))
+        self.assertEqual(len(window.writes), 18)
+        self.assertEqual(renderer.cells_written, 18 * 64)
+
+        window.writes = []
+        levels = levels.copy()
+        levels[5, 10] = levels[5, 12] = 1
+        renderer.show(levels)
+        # too soon after the last update
+        self.assertFalse(renderer.update(now=100.05))
+        self.assertTrue(renderer.update(now=100.2))
+        self.assertEqual(window.writes, [(7, 13, BINARY_SYMBOLS[1] +
+                                          BINARY_SYMBOLS[0] +
+                                          BINARY_SYMBOLS[1])])
+        # nothing new to draw
+        self.assertFalse(renderer.update(now=200))
+
+    def test_present_array(self):
+        self.assertEqual(ChipViewer._present_array([0, 1, 0]),
+                         BINARY_SYMBOLS[0] + BINARY_SYMBOLS[1] +
+                         BINARY_SYMBOLS[0])
+
+
+class TestAcquisition(unittest.TestCase):
+    def setUp(self):
+        self._curs_set = scan_analysis.curses.curs_set
+        self._wrapper = scan_analysis.curses.wrapper
+        scan_analysis.curses.curs_set = lambda visibility: None
+        self.screen = FakeScreen()
+        scan_analysis.curses.wrapper = lambda function: function(self.screen)
+        self.viewer = ChipViewer()
+
+    def tearDown(self):
+        scan_analysis.curses.curs_set = self._curs_set
+        scan_analysis.curses.wrapper = self._wrapper
+
+    def assertStopped(self):
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if thread.name == "viewer acquisition"])
+
+    def test_scan_function_stops(self):
+        calls = []
+        def scan_function():
+            calls.append(None)
+            return scan_results(keep_going=len(calls) < 3)
+        self.viewer.run_curses(scan_function)
+        self.assertStopped()
+        self.assertEqual(len(self.viewer.event_history), 3)
+        self.assertEqual(self.viewer.accumulator.num_cycles, 3)
+        self.assertEqual(self.viewer.persistence_history[2].tolist(),
+                         [0] * 5 + [1, 1] + [0] * 57)
+
+    def test_shared_accumulator(self):
+        accumulator = OccupancyAccumulator()
+        accumulator.add(np.ones((18, 64), dtype=bool), 1.0)
+        viewer = ChipViewer(accumulator)
+        calls = []
+        def scan_function():
+            calls.append(None)
+            results = scan_results(keep_going=len(calls) < 2)
+            # the scan function feeds the accumulator, not the viewer
+            accumulator.add(results.column_hits, 0.1)
+            return results
+        self.screen.keys = ['x']
+        viewer.run_curses(scan_function)
+        self.assertEqual(accumulator.num_cycles, 3)
+        # clearing the persistence leaves the accumulator alone
+        self.assertEqual(accumulator.counts[0, 0], 1)
+        self.assertTrue((viewer.counts <= accumulator.counts).all())
+
+    def test_error_is_raised(self):
+        calls = []
+        def scan_function():
+            calls.append(None)
+            if len(calls) == 2:
+                raise RuntimeError("scan failed")
+            return scan_results()
+        self.assertRaises(RuntimeError, self.viewer.run_curses,
+                          scan_function)
+        self.assertStopped()
+        self.assertEqual(len(self.viewer.event_history), 1)
+
+    def test_quit(self):
+        self.screen.keys = ['q']
+        calls = []
+        def scan_function():
+            calls.append(None)
+            time.sleep(0.01)
+            return scan_results()
+        self.viewer.run_curses(scan_function)
+        self.assertStopped()
+        num_calls = len(calls)
+        time.sleep(0.05)
+        self.assertEqual(len(calls), num_calls)
+        self.assertEqual(len(self.viewer.event_history), num_calls)
+
+    def test_frames_dropped(self):
+        frames = Queue.Queue(2)
+        for i in range(4):
+            self.viewer._push_frame(frames, i)
+        self.assertEqual(self.viewer.dropped_frames, 2)
+        self.assertEqual([frames.get_nowait(), frames.get_nowait()], [2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
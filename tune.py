@@ -6,46 +6,83 @@ A module for tuning the T3MAPS chip.
 import scan_inject as scan
 import scan_analysis
 import lt3maps
+from lt3maps.occupancy import OccupancyAccumulator
+import numpy as np
 import logging
 import struct
 import time
+import argparse
 
 class Tuner(object):
     """
     Manages a chip tuning.
 
+    `method` is either 'linear', to walk every pixel's TDAC down one
+    step at a time (see `get_scan_function`), or 'binary', to search
+    for all pixels' TDACs bit by bit (see `get_binary_search_function`).
+
+    A `scanner` which is already connected to a chip can be given
+    instead of creating one. The hits of each round are counted in the
+    tuner's own `accumulator`, which is reset every round, so that the
+    scanner's shared accumulator is left alone.
+
     """
-    def __init__(self, view=True):
+    def __init__(self, view=True, emulate=False, method='linear',
+                 scanner=None):
+        if method not in ('linear', 'binary'):
+            raise ValueError("unknown tuning method: %s" % method)
+        self.method = method
         self.global_threshold = 60
-        self.scanner = scan.Scanner("lt3maps/lt3maps.yaml")
+        self.integration_time = 2
+        self.calm_down_time = 5
+        self.TDAC_margin = 5
+        self.num_iterations = 4
+        # the results are saved to <results_file>.yaml and .tdac
+        self.results_file = "tune_results"
+        if scanner is None:
+            scanner = scan.Scanner("lt3maps/lt3maps.yaml", emulate=emulate)
+        self.scanner = scanner
         self.scanner.set_all_TDACs(0)
+        self.iteration = 1
+        self.num_pixels_total = (self.scanner.chip.num_columns *
+                                 self.scanner.chip.num_rows)
+        self.accumulator = OccupancyAccumulator(
+            self.scanner.chip.num_columns, self.scanner.chip.num_rows)
         self.viewer = None
         if view:
             self.viewer = scan_analysis.ChipViewer()
 
     def tune(self):
-        # Initialize all TDAC values to 31
-        self.scanner.set_all_TDACs(24)
-
-        # Mark all pixels as untuned
-        self.untuned_pixels = [pixel for column in self.scanner.chip._pixels
-                               for pixel in column]
-        self.num_pixels_total = len(self.untuned_pixels)
-        self.tuned_pixels = []
         self.iteration = 1
-        self.num_iterations = 4
+        if self.method == 'binary':
+            scan_function = self.get_binary_search_function(range(1,17))
+        else:
+            # Initialize all TDAC values to 31
+            self.scanner.set_all_TDACs(24)
+
+            # Mark all pixels as untuned
+            self.untuned_pixels = [pixel for column in
+                                   self.scanner.chip._pixels
+                                   for pixel in column]
+            self.tuned_pixels = []
+            scan_function = self.get_scan_function(range(1,17))
 
         if self.viewer is None:
-            self._tune_loop()
+            self._tune_loop(scan_function)
         else:
-            self.viewer.run_curses(self.get_scan_function(range(1,17)))
-        self.scanner.chip.save_TDAC_to_file("tune_results.yaml")
-
-    def _tune_loop(self):
+            self.viewer.run_curses(scan_function)
+        self.scanner.chip.save_TDAC_to_file(self.results_file + ".yaml")
+        self.scanner.chip.save_TDAC_to_file(
+            self.results_file + ".tdac",
+            dac={'vth': self.global_threshold, 'VbpThStep': 25},
+            description="tune.py, %s method" % self.method)
+
+    def _tune_loop(self, scan_function):
         keep_going = True
         while keep_going:
-            col_hits, keep_going = self.get_scan_function(range(1,17))()
-            hit_pixels = self._get_hit_pixels(col_hits)
+            scan_results = scan_function()
+            keep_going = scan_results.keep_going
+            hit_pixels = self._get_hit_pixels(scan_results.column_hits)
             print "(", self.global_threshold, ",", len(hit_pixels), ")"
 
     @staticmethod
@@ -92,7 +129,8 @@ class Tuner(object):
               
                   - If it registers a hit:
 
-                      - Increase its TDAC value by 1.
+                      - Increase its TDAC value by `TDAC_margin` (at
+                        most to 31).
 
                       - Mark it as tuned.
 
@@ -108,31 +146,33 @@ class Tuner(object):
 
             logging.info("number of pixels left to tune: %i",
             len(self.untuned_pixels))
+            if self.iteration == 1:
+                self.accumulator.reset()
             # Scan
-            start_time, end_time = self.scanner.scan(2, 1, self.global_threshold)
+            start_time, end_time = self.scanner.scan(self.integration_time, 1,
+                                                     self.global_threshold)
+            self.accumulator.add(self.scanner.hit_store.occupancy,
+                                 self.integration_time)
 
             # find out which pixels were hit
             col_hits = self._get_column_hits_list(columns_to_scan)
             hit_pixels = self._get_hit_pixels(col_hits)
             logging.debug("number of hit pixels: " + str(len(hit_pixels)))
 
-            if self.iteration == 1:
-                self.hit_count = {}
-            for pixel_address in hit_pixels:
-                prev_hit_count = self.hit_count.get(pixel_address, 0)
-                self.hit_count[pixel_address] = prev_hit_count + 1
             if self.iteration < self.num_iterations:
                 self.iteration += 1
-                return col_hits, True
+                return scan_analysis.ScanFunctionReturn(start_time,
+                        end_time, col_hits, True)
             else:
                 self.iteration = 1
 
             # analyze results
+            self.hit_count = self._get_hit_counts(columns_to_scan)
             for pixel in self.untuned_pixels[:]:
-                if (self.hit_count.get((pixel.column, pixel.row),0) >
+                if (self.hit_count[pixel.column, pixel.row] >
                     self.num_iterations/2.0):
                     try:
-                        for _ in range(5):
+                        for _ in range(self.TDAC_margin):
                             pixel.TDAC += 1
                         if (pixel.column, pixel.row) == (1, 58):
                             logging.debug(str(pixel))
@@ -157,23 +197,130 @@ class Tuner(object):
 
             logging.debug(self.scanner.chip.pixel_TDAC_matrix()[1][:10])
             if len(hit_pixels) > self.num_pixels_total/2:
-                wait = 5
+                wait = self.calm_down_time
                 logging.info("waiting %is to calm down", wait)
                 time.sleep(wait)
             return scan_analysis.ScanFunctionReturn(start_time,
                     end_time, col_hits, keep_going)
         return scan_function
 
+    def get_binary_search_function(self, columns_to_scan=range(18)):
+        """
+        Tune the chip by searching for all pixels' TDACs at once.
+
+        Produces the same kind of result as `get_scan_function`: each
+        pixel's TDAC is set `TDAC_margin` above the highest TDAC at which
+        it still fires, but takes one round per TDAC bit instead of one
+        round per TDAC step. Columns not in `columns_to_scan` are left
+        alone.
+
+        Algorithm:
+
+            Start with all TDACs (of the scanned columns) at 0.
+
+            For each TDAC bit, most significant first:
+
+              - Set each pixel's TDAC to its value so far plus the bit.
+
+              - Scan `num_iterations` times. A pixel fires if it is hit
+                in more than half of the scans.
+
+              - Keep the bit for the pixels which fire.
+
+            Refine: scan at the values found. Pixels which do not fire
+            (because of noise in the earlier rounds) move down by 1.
+
+            Pixels which do not fire even at TDAC 0 stay at 0. All
+            others get their value plus `TDAC_margin` (at most 31).
+
+        """
+        chip = self.scanner.chip
+        columns = list(columns_to_scan)
+        num_bits = chip.pixel_state.TDAC_size
+        max_TDAC = 2**num_bits - 1
+        # the TDAC bit to try in each round, 0 for the refinement
+        self._search_bits = [1 << bit for bit in reversed(range(num_bits))]
+        self._search_bits.append(0)
+        self._search_value = np.zeros((len(columns), chip.num_rows), int)
+
+        def scan_function():
+            bit = self._search_bits[0]
+            if self.iteration == 1:
+                self.accumulator.reset()
+                TDAC = chip.pixel_TDAC_matrix()
+                TDAC[columns] = self._search_value | bit
+                chip._import_TDAC_to_pixels(TDAC)
+                chip._apply_pixel_TDAC_to_chip()
+                logging.info("binary search: trying TDAC bit %i", bit)
+
+            self.scanner.reset()
+            start_time, end_time = self.scanner.scan(self.integration_time, 1,
+                                                     self.global_threshold)
+            self.accumulator.add(self.scanner.hit_store.occupancy,
+                                 self.integration_time)
+            col_hits = self._get_column_hits_list(columns_to_scan)
+            hit_matrix = self.scanner.hit_store.occupancy[0]
+            logging.debug("number of hit pixels: %i", hit_matrix.sum())
+
+            if self.iteration < self.num_iterations:
+                self.iteration += 1
+                return scan_analysis.ScanFunctionReturn(start_time,
+                        end_time, col_hits, True)
+            self.iteration = 1
+
+            # analyze results
+            self.hit_count = self.accumulator.counts[columns]
+            fires = self.hit_count > self.num_iterations/2.0
+            self._search_bits.pop(0)
+            if bit:
+                self._search_value[fires] |= bit
+            else:
+                moved_down = ~fires & (self._search_value > 0)
+                self._search_value[moved_down] -= 1
+                never_fires = ~fires & ~moved_down
+                final = np.minimum(self._search_value + self.TDAC_margin,
+                                   max_TDAC)
+                final[never_fires] = 0
+                TDAC = chip.pixel_TDAC_matrix()
+                TDAC[columns] = final
+                chip._import_TDAC_to_pixels(TDAC)
+                chip._apply_pixel_TDAC_to_chip()
+
+            if hit_matrix.sum() > self.num_pixels_total/2:
+                wait = self.calm_down_time
+                logging.info("waiting %is to calm down", wait)
+                time.sleep(wait)
+            return scan_analysis.ScanFunctionReturn(start_time,
+                    end_time, col_hits, bool(self._search_bits))
+        return scan_function
+
+    def _get_hit_counts(self, columns_to_scan):
+        """
+        Return the hit counts of the scanned columns since the last
+        reset of the tuner's accumulator, by (column, row).
+
+        """
+        counts = np.zeros(self.accumulator.counts.shape, int)
+        columns = list(columns_to_scan)
+        counts[columns] = self.accumulator.counts[columns]
+        return counts
+
     def _get_column_hits_list(self, columns_to_scan):
+        store = self.scanner.hit_store
         col_hits = []
-        for i in range(len(self.scanner.hits[0]['data'])):
+        for i in range(store.num_columns):
             if i in columns_to_scan:
-                col_hits.append(self.scanner.hits[0]['data'][i]['hit_rows'])
+                col_hits.append(store.column_hits(0, i).tolist())
             else:
                  col_hits.append([])
         return col_hits
 
 if __name__ == "__main__":
     logging.basicConfig(filename="tuning.log", level=logging.DEBUG)
-    tuner = Tuner(view=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emulate", action="store_true")
+    parser.add_argument("--method", choices=["linear", "binary"],
+                        default="linear")
+    clargs = parser.parse_args()
+    tuner = Tuner(view=True, emulate=clargs.emulate, method=clargs.method)
     tuner.tune()